@@ -0,0 +1,237 @@
+import asyncio
+import heapq
+import itertools
+import math
+import re
+import time
+import orjson
+from cache import LRUCache
+from metrics import ADMISSION_WAIT
+from settings import settings
+
+# Priorities of routes, lower is more important. Routes not listed here are not limited.
+CHECKOUT, CART, CATALOG = 0, 1, 2
+PRIORITY_NAMES = {CHECKOUT: "checkout", CART: "cart", CATALOG: "catalog"}
+ROUTE_PRIORITIES = [
+    (re.compile(r"^/order/(pay|create)/$|^/order/[^/]+/return/$"), CHECKOUT),
+    (re.compile(r"^/(cart|order)/"), CART),
+    (re.compile(r"^/(products|analytics)/"), CATALOG),
+]
+PATH_UID = re.compile(r"^/cart/(?:remove/)?([0-9a-f]{24})/|^/order/([0-9a-f]{24})/$")
+BODY_UID_PATHS = {"/cart/add/", "/cart/bulk/", "/order/create/"}
+
+
+def route_priority(path: str) -> int | None:
+    """
+    Return priority of request with that path or None if it is not limited.
+    """
+    for pattern, priority in ROUTE_PRIORITIES:
+        if pattern.match(path):
+            return priority
+
+
+class TokenBuckets:
+    """
+    Token buckets of users, bucket gets rate tokens per second up to burst tokens.
+
+    Buckets are kept in LRU cache with ttl of full refill, so expired bucket is the same as full one.
+    """
+
+    def __init__(self, max_size: int, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.buckets = LRUCache(max_size, burst / rate if rate else 0)
+
+    def take(self, key: str) -> float:
+        """
+        Take token from bucket of key, return 0 if it is taken or seconds until next token.
+        """
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+
+        if tokens < 1:
+            return (1 - tokens) / self.rate
+
+        self.buckets.set(key, (tokens - 1, now))
+        return 0.0
+
+
+class AdmissionController:
+    """
+    Limit of requests handled at the same time with bounded queue of waiting requests.
+
+    Waiting requests are admitted by priority. If queue is full, request of higher priority
+    takes place of the least important waiting request, which is rejected.
+    """
+
+    def __init__(self) -> None:
+        self.in_flight = 0
+        self.waiters = []
+        self.rejected = {}
+        self._counter = itertools.count()
+
+    def reject(self, reason: str, priority: int) -> None:
+        key = (reason, PRIORITY_NAMES[priority])
+        self.rejected[key] = self.rejected.get(key, 0) + 1
+
+    async def acquire(self, priority: int) -> bool:
+        """
+        Wait for place of request, return False if request is rejected.
+        """
+        if self.in_flight < settings.ADMISSION_MAX_IN_FLIGHT:
+            self.in_flight += 1
+            return True
+
+        if len(self.waiters) >= settings.ADMISSION_QUEUE_SIZE:
+            worst = max(self.waiters, default=None)
+
+            if worst is None or worst[0] <= priority:
+                self.reject("queue_full", priority)
+                return False
+
+            self._remove(worst)
+            worst[2].set_result(False)
+            self.reject("evicted", worst[0])
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._counter), future)
+        heapq.heappush(self.waiters, entry)
+        start = time.perf_counter()
+
+        try:
+            admitted = await asyncio.wait_for(future, settings.ADMISSION_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._remove(entry)
+            self.reject("timeout", priority)
+            return False
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.result():
+                self.release()
+            else:
+                self._remove(entry)
+            raise
+
+        ADMISSION_WAIT.observe(time.perf_counter() - start, PRIORITY_NAMES[priority])
+        return admitted
+
+    def release(self) -> None:
+        """
+        Pass place of finished request to the most important waiting request.
+        """
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+
+            if not future.done():
+                future.set_result(True)
+                return
+
+        self.in_flight -= 1
+
+    def _remove(self, entry: tuple) -> None:
+        if entry in self.waiters:
+            self.waiters.remove(entry)
+            heapq.heapify(self.waiters)
+
+
+async def send_error(send, status: int, error: str, retry_after: float) -> None:
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": orjson.dumps({"error": error})})
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware rejecting excess requests fast instead of queueing them in event loop.
+
+    Requests of cart and order routes take tokens from bucket of their uid, requests without tokens
+    get 429. All limited routes wait for place among ADMISSION_MAX_IN_FLIGHT requests, requests
+    rejected by full queue or timeout get 503. Both responses have Retry-After header.
+    """
+
+    def __init__(self, app, controller: AdmissionController = None) -> None:
+        self.app = app
+        self.controller = controller or ADMISSION
+        self.buckets = TokenBuckets(
+            settings.ADMISSION_USER_BUCKETS,
+            settings.ADMISSION_USER_RATE,
+            settings.ADMISSION_USER_BURST,
+        )
+
+    async def __call__(self, scope, receive, send) -> None:
+        priority = route_priority(scope["path"]) if scope["type"] == "http" else None
+
+        if priority is None:
+            return await self.app(scope, receive, send)
+
+        if self.buckets.rate and priority != CATALOG:
+            uid, receive = await self.request_uid(scope, receive)
+
+            if uid:
+                retry_after = self.buckets.take(uid)
+
+                if retry_after:
+                    self.controller.reject("rate_limited", priority)
+                    return await send_error(
+                        send, 429, f"Too many requests of user {uid}", retry_after
+                    )
+
+        if not settings.ADMISSION_MAX_IN_FLIGHT:
+            return await self.app(scope, receive, send)
+
+        if not await self.controller.acquire(priority):
+            return await send_error(
+                send, 503, "Service is overloaded", settings.ADMISSION_RETRY_AFTER
+            )
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release()
+
+    async def request_uid(self, scope, receive) -> tuple:
+        """
+        Return uid of request from path or JSON body and receive replaying read body.
+        """
+        match = PATH_UID.match(scope["path"])
+
+        if match:
+            return match.group(1) or match.group(2), receive
+
+        if scope["path"] not in BODY_UID_PATHS:
+            return None, receive
+
+        messages = []
+
+        while True:
+            message = await receive()
+            messages.append(message)
+
+            if message["type"] != "http.request" or not message.get("more_body"):
+                break
+
+        async def replay():
+            return messages.pop(0) if messages else await receive()
+
+        try:
+            data = orjson.loads(b"".join(m.get("body", b"") for m in messages))
+            uid = data.get("uid") if isinstance(data, dict) else None
+        except orjson.JSONDecodeError:
+            uid = None
+
+        return uid if isinstance(uid, str) else None, replay
+
+
+ADMISSION = AdmissionController()
@@ -0,0 +1,118 @@
+"""
+Rollups of sales and returns by product and day.
+
+Rollups are incremented when orders are paid and products are returned, reports are read
+from rollups only. Rollups are rebuilt from orders by backfill:
+python analytics.py
+"""
+
+import argparse
+import asyncio
+import logging
+from datetime import date
+import indexes
+from settings import settings
+from storage import ROLLUP_FIELDS, STORAGE, sale_increments
+
+logger = logging.getLogger(__name__)
+
+
+async def record_payment(order: dict, pay_date: str) -> None:
+    """
+    Add units, gross and discount of products of paid order to rollups of day of payment.
+    """
+    day = pay_date[:10] if pay_date else date.today().isoformat()
+
+    try:
+        await STORAGE.inc_rollups(day, sale_increments(order))
+    except Exception:
+        logger.exception("Rollups of payment of order %s are not updated", order["_id"])
+
+
+async def record_return(
+    pid: str, quantity: int, refund: float, return_date: str
+) -> None:
+    """
+    Add returned quantity and refund of product to rollups of day of return.
+    """
+    try:
+        await STORAGE.inc_rollups(
+            return_date[:10],
+            {pid: {"returned_units": quantity, "refunds": refund}},
+        )
+    except Exception:
+        logger.exception("Rollups of return of product %s are not updated", pid)
+
+
+def check_period(start: date, end: date) -> str | None:
+    """
+    Return error if period from start to end is not allowed.
+    """
+    if start > end:
+        return f"Start {start} is after end {end}"
+    elif (end - start).days >= settings.ANALYTICS_MAX_DAYS:
+        return f"Period is longer than {settings.ANALYTICS_MAX_DAYS} days"
+
+
+async def sales_report(start: date, end: date, pid: str = None) -> list[dict] | dict:
+    """
+    Return rollups of products by day from start to end inclusive with net revenue.
+    """
+    error = check_period(start, end)
+
+    if error:
+        return {"error": error}
+
+    report = []
+
+    for rollup in await STORAGE.find_rollups(start.isoformat(), end.isoformat(), pid):
+        row = {"day": rollup["day"], "pid": rollup["pid"]}
+        row.update((name, rollup.get(name, 0)) for name in ROLLUP_FIELDS)
+        row["net"] = row["gross"] - row["discount"] - row["refunds"]
+        report += [row]
+
+    return report
+
+
+async def products_report(start: date, end: date) -> list[dict] | dict:
+    """
+    Return totals of products from start to end inclusive with net revenue and return rate.
+    """
+    rows = await sales_report(start, end)
+
+    if isinstance(rows, dict):
+        return rows
+
+    totals = {}
+
+    for row in rows:
+        total = totals.setdefault(
+            row["pid"], {"pid": row["pid"], **dict.fromkeys(ROLLUP_FIELDS, 0)}
+        )
+
+        for name in ROLLUP_FIELDS:
+            total[name] += row[name]
+
+    for total in totals.values():
+        total["net"] = total["gross"] - total["discount"] - total["refunds"]
+        total["return_rate"] = (
+            total["returned_units"] / total["units"] if total["units"] else 0.0
+        )
+
+    return sorted(totals.values(), key=lambda total: total["pid"])
+
+
+async def main() -> int:
+    if settings.STORAGE == "motor":
+        await indexes.ensure_indexes()
+
+    print(f"Rebuilt {await STORAGE.rebuild_rollups()} rollups")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replace all rollups of sales and returns with rollups aggregated from orders."
+    )
+    parser.parse_args()
+    raise SystemExit(asyncio.run(main()))
@@ -0,0 +1,278 @@
+import asyncio
+import time
+import zlib
+from collections import OrderedDict
+from serializers import dumps
+from settings import settings
+from snapshot import SNAPSHOT, Snapshot
+from storage import STORAGE
+
+
+class LRUCache:
+    """
+    Bounded key-value cache with least recently used eviction and time to live for entries.
+    """
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._loading = {}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """
+        Return value for key or default if key is missing or expired.
+        """
+        entry = self._data.get(key)
+
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value) -> None:
+        """
+        Store value for key, evict least recently used keys over max_size.
+        """
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    async def get_or_load(self, key, load):
+        """
+        Return value for key, missing value is loaded with await load(key).
+
+        Concurrent callers of missing key wait for the same load, None values are not stored.
+        """
+        value = self.get(key)
+
+        if value is not None:
+            return value
+
+        task = self._loading.get(key)
+
+        if task is None:
+            task = asyncio.create_task(self._load(key, load))
+            self._loading[key] = task
+
+        return await asyncio.shield(task)
+
+    async def _load(self, key, load):
+        try:
+            value = await load(key)
+
+            if value is not None:
+                self.set(key, value)
+
+            return value
+        finally:
+            del self._loading[key]
+
+    def invalidate(self, key=None) -> None:
+        """
+        Remove key from cache, or all keys if key is None.
+        """
+        if key is None:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+
+    def stats(self) -> dict:
+        """
+        Return size and hit/miss counters of cache.
+        """
+        requests = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / requests if requests else 0.0,
+        }
+
+
+def product_snapshot(product: dict) -> dict:
+    """
+    Return snapshot of product kept in lines of carts.
+
+    Version is taken from product or computed from its fields, so any change of product changes it.
+    """
+    snapshot = {
+        "name": product.get("name"),
+        "color": product.get("color"),
+        "price": product["price"],
+    }
+    snapshot["version"] = (
+        product["version"] if "version" in product else zlib.crc32(dumps(snapshot))
+    )
+    return snapshot
+
+
+class ProductCatalog:
+    """
+    In-memory cache of products collection.
+
+    Products returned by that cache are shared between requests and must not be changed.
+    If snapshot is given, products are read from it and only products missed in snapshot are cached.
+    """
+
+    def __init__(self, max_size: int, ttl: float, snapshot: Snapshot = None) -> None:
+        self.products = LRUCache(max_size, ttl)
+        self.snapshot = snapshot
+        self.ttl = ttl
+        self._all_json = None
+        self._all_expires = 0.0
+        self._lock = asyncio.Lock()
+
+    async def get(self, pid: str) -> dict | None:
+        """
+        Return product with that pid.
+        """
+        product = self._cached(pid)
+
+        if product is None:
+            products = await STORAGE.find_products([pid])
+
+            if products:
+                product = products[0]
+                self.products.set(pid, product)
+
+        return product
+
+    async def get_many(self, pids: list[str]) -> dict:
+        """
+        Return products with that pids as dict by pid, products missed in cache are read with one query.
+        """
+        result = {}
+        missed = []
+
+        for pid in dict.fromkeys(pids):
+            product = self._cached(pid)
+
+            if product is None:
+                missed += [pid]
+            else:
+                result[pid] = product
+
+        if missed:
+            for product in await STORAGE.find_products(missed):
+                self.products.set(product["id"], product)
+                result[product["id"]] = product
+
+        return result
+
+    def _cached(self, pid: str) -> dict | None:
+        if self.snapshot and self.snapshot.refresh():
+            product = self.snapshot.product(pid)
+
+            if product is not None:
+                return product
+
+        return self.products.get(pid)
+
+    async def all_json(self) -> bytes | memoryview:
+        """
+        Return serialized to JSON list of all products.
+        """
+        if self.snapshot and self.snapshot.refresh():
+            return self.snapshot.products_json()
+
+        if self._all_json is not None and self._all_expires > time.monotonic():
+            self.products.hits += 1
+            return self._all_json
+
+        async with self._lock:
+            if self._all_json is None or self._all_expires <= time.monotonic():
+                self.products.misses += 1
+                products = await STORAGE.find_products()
+
+                for product in products[: self.products.max_size]:
+                    self.products.set(product["id"], product)
+
+                self._all_json = dumps(products)
+                self._all_expires = time.monotonic() + self.ttl
+
+        return self._all_json
+
+    def invalidate(self, pid: str = None) -> None:
+        """
+        Drop product with that pid, or all products if pid is None, from cache.
+        """
+        self.products.invalidate(pid)
+        self._all_json = None
+
+    def stats(self) -> dict:
+        """
+        Return size and hit/miss counters of cache.
+        """
+        return self.products.stats()
+
+
+class ProductLoader:
+    """
+    Per request loader of products.
+
+    Products requested in the same iteration of event loop are loaded together with one query,
+    loaded products are kept until the end of request.
+    """
+
+    def __init__(self, catalog: ProductCatalog = None) -> None:
+        self.catalog = catalog or CATALOG
+        self._futures = {}
+        self._queue = []
+        self._task = None
+
+    def load(self, pid: str) -> asyncio.Future:
+        """
+        Return future with product for that pid or None if product not found.
+        """
+        future = self._futures.get(pid)
+
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._futures[pid] = future
+            self._queue += [pid]
+
+            if len(self._queue) == 1:
+                loop.call_soon(self._schedule)
+
+        return future
+
+    async def load_many(self, pids: list[str]) -> list[dict | None]:
+        """
+        Return products for that pids in the same order.
+        """
+        return await asyncio.gather(*[self.load(pid) for pid in pids])
+
+    def _schedule(self) -> None:
+        self._task = asyncio.create_task(self._dispatch())
+
+    async def _dispatch(self) -> None:
+        pids, self._queue = self._queue, []
+
+        try:
+            products = await self.catalog.get_many(pids)
+        except Exception as e:
+            for pid in pids:
+                self._futures.pop(pid).set_exception(e)
+            return
+
+        for pid in pids:
+            self._futures[pid].set_result(products.get(pid))
+
+
+CATALOG = ProductCatalog(settings.CATALOG_MAX_SIZE, settings.CATALOG_TTL, SNAPSHOT)
+USER_CIDS = LRUCache(settings.USER_CID_CACHE_SIZE, settings.USER_CID_TTL)
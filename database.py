@@ -1,10 +1,155 @@
+import asyncio
+import threading
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+from metrics import InstrumentedCollection
 from settings import settings
 
-CLIENT = AsyncIOMotorClient(settings.DB_URI)
-DB = CLIENT.minishop
-USERS_COLLECTION = DB.users
-PRODUCTS_COLLECTION = DB.products
-CARTS_COLLECTION = DB.carts
-ORDER_COLLECTION = DB.orders
-PROMOCODES_COLLECTION = DB.promocodes
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """
+    Listener of connection pools counting open, checked out connections and waiting checkouts.
+
+    Events are sent from threads of driver, so counters are changed under lock.
+    """
+
+    def __init__(self) -> None:
+        self.open = 0
+        self.checked_out = 0
+        self.waiting = 0
+        self._lock = threading.Lock()
+
+    def _add(self, **changes) -> None:
+        with self._lock:
+            for name, change in changes.items():
+                setattr(self, name, getattr(self, name) + change)
+
+    def stats(self) -> dict:
+        """
+        Return counters of connections and part of maximum pool size checked out.
+        """
+        return {
+            "open": self.open,
+            "checked_out": self.checked_out,
+            "waiting": self.waiting,
+            "max_size": settings.MONGO_MAX_POOL_SIZE,
+            "saturation": self.checked_out / settings.MONGO_MAX_POOL_SIZE,
+        }
+
+    def connection_created(self, event) -> None:
+        self._add(open=1)
+
+    def connection_closed(self, event) -> None:
+        self._add(open=-1)
+
+    def connection_check_out_started(self, event) -> None:
+        self._add(waiting=1)
+
+    def connection_checked_out(self, event) -> None:
+        self._add(waiting=-1, checked_out=1)
+
+    def connection_check_out_failed(self, event) -> None:
+        self._add(waiting=-1)
+
+    def connection_checked_in(self, event) -> None:
+        self._add(checked_out=-1)
+
+    def pool_created(self, event) -> None:
+        pass
+
+    def pool_ready(self, event) -> None:
+        pass
+
+    def pool_cleared(self, event) -> None:
+        pass
+
+    def pool_closed(self, event) -> None:
+        pass
+
+    def connection_ready(self, event) -> None:
+        pass
+
+
+def seconds_to_ms(value: float | None) -> int | None:
+    return None if value is None else int(value * 1000)
+
+
+def client_options() -> dict:
+    """
+    Return options of client from settings, options which are not set are left to driver defaults.
+    """
+    w = settings.MONGO_WRITE_CONCERN
+    options = {
+        "maxPoolSize": settings.MONGO_MAX_POOL_SIZE,
+        "minPoolSize": settings.MONGO_MIN_POOL_SIZE,
+        "maxConnecting": settings.MONGO_MAX_CONNECTING,
+        "serverSelectionTimeoutMS": seconds_to_ms(
+            settings.MONGO_SERVER_SELECTION_TIMEOUT
+        ),
+        "connectTimeoutMS": seconds_to_ms(settings.MONGO_CONNECT_TIMEOUT),
+        "socketTimeoutMS": seconds_to_ms(settings.MONGO_SOCKET_TIMEOUT),
+        "timeoutMS": seconds_to_ms(settings.MONGO_TIMEOUT),
+        "compressors": settings.MONGO_COMPRESSORS,
+        "w": int(w) if w and w.isdigit() else w,
+        "journal": settings.MONGO_JOURNAL,
+    }
+    return {name: value for name, value in options.items() if value is not None}
+
+
+class Mongo:
+    """
+    Client of minishop database.
+
+    Client is created by connect() in lifespan of application, or on first use by scripts and tests,
+    and is closed on shutdown.
+    """
+
+    def __init__(self, uri: str) -> None:
+        self.uri = uri
+        self.client = None
+        self.pool = PoolMonitor()
+
+    def connect(self) -> AsyncIOMotorClient:
+        if self.client is None:
+            self.client = AsyncIOMotorClient(
+                self.uri, event_listeners=[self.pool], **client_options()
+            )
+
+        return self.client
+
+    @property
+    def db(self):
+        return self.connect().minishop
+
+    async def warm_up(self, connections: int) -> None:
+        """
+        Open that number of connections of pool by concurrent pings.
+        """
+        await asyncio.gather(
+            *[self.db.command("ping") for _ in range(max(connections, 1))]
+        )
+
+    def close(self) -> None:
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+
+MONGO = Mongo(settings.DB_URI)
+
+
+def collection(name: str) -> InstrumentedCollection:
+    """
+    Return collection of minishop database bound to current client.
+    """
+    return InstrumentedCollection(name, lambda: MONGO.db[name])
+
+
+USERS_COLLECTION = collection("users")
+PRODUCTS_COLLECTION = collection("products")
+CARTS_COLLECTION = collection("carts")
+ORDER_COLLECTION = collection("orders")
+ARCHIVE_COLLECTION = collection("orders_archive")
+PROMOCODES_COLLECTION = collection("promocodes")
+IDEMPOTENCY_COLLECTION = collection("idempotency_keys")
+ROLLUPS_COLLECTION = collection("sales_daily")
@@ -1,63 +1,80 @@
-from fastapi import BackgroundTasks
-import asyncio
-from datetime import datetime as dt
+import copy
+import logging
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime as dt, timedelta
+from uuid import uuid4
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
-from database import (
-    USERS_COLLECTION,
-    ORDER_COLLECTION,
-    CARTS_COLLECTION,
-    PRODUCTS_COLLECTION,
-    PROMOCODES_COLLECTION,
-)
-from models import Cart, Order, ProductReturn
-import paysystem_mock
+from cache import CATALOG, USER_CIDS, ProductLoader, product_snapshot
+from models import Cart, CartBulk, Order, ProductReturn
+from promocodes import PROMOCODES, apply_discounts
+from settings import settings
+from scheduler import expires_at, utcnow
+from storage import CART_UPDATE_ATTEMPTS, ORDER_LINE_DEFAULTS, STORAGE
+import analytics
+import payments
 
+logger = logging.getLogger(__name__)
 
-def product_helper(product) -> dict:
+ORDER_UPDATE_ATTEMPTS = 3
+
+
+async def load_user_cid(uid: str) -> str | None:
     """
-    Return product with converted to str _id.
+    Return cid of cart for user with that uid from database.
     """
-    product["id"] = str(product.pop("_id"))
-    return product
+    return await STORAGE.user_cid(uid)
 
 
 async def get_user_cid(data: Cart | Order = None, _uid: str = None) -> str | None:
     """
     Return cid of cart for user with that uid.
+
+    If carts are addressed by uid, cid is the same as uid and no lookup is needed.
     """
     uid = _uid if _uid else data.uid
-    user = await USERS_COLLECTION.find_one({"_id": ObjectId(uid)})
-    if user:
-        return user["cid"]
 
+    if settings.CARTS_BY_UID:
+        return uid
 
-async def order_pay_timer(seconds: int, oid: str) -> None:
-    """
-    Wait number of seconds and check order oid, if order not paid, set status "Expired".
-    """
-    await asyncio.sleep(seconds)
-    order = await ORDER_COLLECTION.find_one({"_id": ObjectId(oid)})
-    if order["status"] == "Created":
-        order["status"] = "Expired"
-        await ORDER_COLLECTION.update_one({"_id": ObjectId(oid)}, {"$set": order})
+    return await USER_CIDS.get_or_load(uid, load_user_cid)
 
 
-async def cart_helper(cid: str) -> dict:
+async def cart_helper(cid: str, loader: ProductLoader = None) -> dict:
     """
     Return cart for that uid.
+
+    Lines carry snapshots of products, only lines added before snapshots were introduced are joined with products.
     """
-    cart = await CARTS_COLLECTION.find_one({"_id": ObjectId(cid)})
+    cart = await STORAGE.get_cart(cid)
+
+    if not cart:
+        return {"error": f"Cart {cid} not found"}
+
     result = {"id": str(cart["_id"]), "products": [], "total": cart["total"]}
+    missed = [item["pid"] for item in cart["products"] if "product" not in item]
+    products = {}
+
+    if missed:
+        loader = loader or ProductLoader()
+        products = dict(zip(missed, await loader.load_many(missed)))
 
     for item in cart["products"]:
-        pid = item["pid"]
-        quantity = item["quantity"]
-        summ = item["summ"]
-        product = await PRODUCTS_COLLECTION.find_one({"_id": ObjectId(pid)})
-        product = product_helper(product)
-        product["quantity"] = quantity
-        product["summ"] = summ
-        result["products"] += [product]
+        snapshot = item.get("product")
+
+        if snapshot:
+            product = {
+                "name": snapshot["name"],
+                "color": snapshot["color"],
+                "price": snapshot["price"],
+                "id": item["pid"],
+            }
+        else:
+            product = products.get(item["pid"]) or {"id": item["pid"]}
+
+        result["products"] += [
+            {**product, "quantity": item["quantity"], "summ": item["summ"]}
+        ]
 
     return result
 
@@ -67,112 +84,142 @@ async def cart_add_helper(data: Cart, cid: str) -> dict:
     Add to cart of user with uid quantity of products with pid.
     """
     uid, pid, quantity = data.model_dump().values()
-    cart = await CARTS_COLLECTION.find_one({"_id": ObjectId(cid)})
-    product = await PRODUCTS_COLLECTION.find_one({"_id": ObjectId(pid)})
+    product = await CATALOG.get(pid)
 
-    if product:
-        price = product["price"]
-        products = cart["products"]
-        total = cart["total"]
-        pids_list = [p["pid"] for p in products]
+    if not product:
+        return {"error": f"Product {pid} not found!"}
 
-        if pid in pids_list:
-            product_index = pids_list.index(pid)
-            products[product_index]["price"] = price
-            products[product_index]["quantity"] += quantity
-            products[product_index]["summ"] += quantity * price
-        else:
-            products += [
-                {
-                    "pid": pid,
-                    "price": price,
-                    "quantity": quantity,
-                    "summ": quantity * price,
-                }
-            ]
+    if await STORAGE.cart_add(
+        cid, pid, product["price"], quantity, product_snapshot(product)
+    ):
+        return {"status": f"Products {pid} added to cart of user {uid}"}
+    else:
+        return {"error": f"Products {pid} not added to cart of user {uid}"}
 
-        total += price * quantity
-        result = await CARTS_COLLECTION.update_one(
-            {"_id": ObjectId(cid)}, {"$set": {"products": products, "total": total}}
-        )
 
-        if result.acknowledged:
-            return {"status": f"Products {pid} added to cart of user {uid}"}
-        else:
-            return {"error": f"Products {pid} not added to cart of user {uid}"}
+async def cart_del_helper(uid, cid, pid, quantity) -> dict:
+    """
+    Remove product with pid from cart for user with uid.
+    """
+    product = await CATALOG.get(pid)
 
-    else:
+    if not product:
         return {"error": f"Product {pid} not found!"}
 
+    status = await STORAGE.cart_remove(cid, pid, product["price"], quantity)
 
-async def cart_del_helper(uid, cid, pid, quantity) -> dict:
+    if status == "ok":
+        return {
+            "status": f"Products {pid} with {quantity} removed from cart of user {uid}"
+        }
+    elif status == "not in cart":
+        return {"error": f"Product {pid} not found in cart for user {uid}"}
+    elif status == "insufficient quantity":
+        return {
+            "error": f"Quantity {quantity} of product {pid} is greater than quantity in cart of user {uid}"
+        }
+
+    return {"error": f"Products {pid} not removed from cart of user {uid}"}
+
+
+def apply_cart_line(
+    lines: dict, op: str, pid: str, quantity: int, product: dict
+) -> str:
     """
-    Remove product with pid from cart for user with uid.
+    Add or remove quantity of product in lines of cart by pid, return status of operation.
+    """
+    line = lines.get(pid)
+    price = product["price"]
+    summ = price * quantity
+
+    if op == "add":
+        if line:
+            line["price"] = price
+            line["quantity"] += quantity
+            line["summ"] += summ
+        else:
+            line = lines[pid] = {
+                "pid": pid,
+                "price": price,
+                "quantity": quantity,
+                "summ": summ,
+            }
+
+        line["product"] = product_snapshot(product)
+    elif not line:
+        return "not in cart"
+    elif line["quantity"] < quantity:
+        return "insufficient quantity"
+    elif line["quantity"] == quantity:
+        del lines[pid]
+    else:
+        line["quantity"] -= quantity
+        line["summ"] -= summ
+
+    return "ok"
+
+
+async def cart_bulk_helper(data: CartBulk, cid: str) -> dict:
     """
-    cart = await CARTS_COLLECTION.find_one({"_id": ObjectId(cid)})
-    product = await PRODUCTS_COLLECTION.find_one({"_id": ObjectId(pid)})
+    Add and remove many products in cart of user with uid by one write.
+    """
+    operations = [("add", line) for line in data.add] + [
+        ("remove", line) for line in data.remove
+    ]
+    products = await CATALOG.get_many([line.pid for _, line in operations])
+
+    # Cart is replaced only if it was not changed after reading,
+    # otherwise operations are applied again to new state of cart.
+    for _ in range(CART_UPDATE_ATTEMPTS):
+        cart = await STORAGE.get_cart(cid)
+
+        if not cart:
+            return {"error": f"Cart {cid} not found"}
 
-    if product:
-        price = product["price"]
-        products = cart["products"]
+        lines = {line["pid"]: dict(line) for line in cart["products"]}
         total = cart["total"]
-        pids_list = [p["pid"] for p in products]
+        results = {"add": [], "remove": []}
 
-        if pid in pids_list:
-            product_index = pids_list.index(pid)
+        for op, line in operations:
+            product = products.get(line.pid)
 
-            if products[product_index]["quantity"] < quantity:
-                return {
-                    "error": f"Quantity {quantity} of product {pid} is greater than quantity in cart of user {uid}"
-                }
-            elif products[product_index]["quantity"] == quantity:
-                products.pop(product_index)
+            if product:
+                status = apply_cart_line(lines, op, line.pid, line.quantity, product)
             else:
-                products[product_index]["quantity"] -= quantity
-                products[product_index]["summ"] -= price * quantity
-            total -= price * quantity
-            result = await CARTS_COLLECTION.update_one(
-                {"_id": ObjectId(cid)}, {"$set": {"products": products, "total": total}}
-            )
-
-            if result.acknowledged:
-                return {
-                    "status": f"Products {pid} with {quantity} removed from cart of user {uid}"
-                }
-            else:
-                return {"error": f"Products {pid} not removed from cart of user {uid}"}
+                status = "not found"
 
-        else:
-            return {"error": f"Product {pid} not found in cart for user {uid}"}
+            if status == "ok":
+                summ = product["price"] * line.quantity
+                total += summ if op == "add" else -summ
 
-    else:
-        return {"error": f"Product {pid} not found!"}
+            results[op] += [
+                {"pid": line.pid, "quantity": line.quantity, "status": status}
+            ]
 
+        if total == cart["total"] and list(lines.values()) == cart["products"]:
+            return {"status": f"Cart of user {data.uid} is not changed", **results}
 
-async def order_add_helper(
-    data: Order, cid: str, background_task: BackgroundTasks
-) -> dict:
+        if await STORAGE.replace_cart(cid, cart, list(lines.values()), total):
+            return {"status": f"Cart of user {data.uid} is changed", **results}
+
+    return {"error": f"Cart of user {data.uid} is not changed"}
+
+
+async def order_add_helper(data: Order, cid: str) -> dict:
     """
     Create order from cart for user with that uid.
     """
-    global_discount = 0
     uid, promocodes, pay_timeout = data.model_dump().values()
-    cart = await CARTS_COLLECTION.find_one({"_id": ObjectId(cid)})
+    cart = await STORAGE.get_cart(cid)
+
+    if not cart:
+        return {"error": f"Cart {cid} not found"}
+
     products = cart["products"]
-    extra_fields = {
-        "discount": 0,
-        "discount_summ": 0,
-        "summ_with_discount": 0,
-        "return_quantity": 0,
-        "return_summ": 0,
-        "return_status": None,
-        "return_dates": [],
-    }
 
     if not products:
         return {"error": f"Cart {cid} is empty."}
 
-    pids_list = [p["pid"] for p in products]
     order = {
         "uid": uid,
         "date": dt.now().isoformat(),
@@ -183,6 +230,7 @@ async def order_add_helper(
         "total": cart["total"],
         "total_with_discount": cart["total"],
         "status": "Created",
+        "expires_at": expires_at(pay_timeout),
         "pay_date": None,
         "pay_id": None,
         "pay_status": None,
@@ -190,132 +238,234 @@ async def order_add_helper(
     }
 
     for product in products:
-        product.update(extra_fields)
-
-    for promocode in promocodes:
-        code = await PROMOCODES_COLLECTION.find_one({"code": promocode})
-
-        if code:
-            pid = code["pid"]
-
-            if pid == "Global":
-                global_discount = code["discount"]
-            elif pid in pids_list:
-                product = products[pids_list.index(pid)]
-                discount = code["discount"]
-                product["discount"] = discount
-                product["discount_summ"] = product["summ"] * discount
-                product["summ_with_discount"] = (
-                    product["summ"] - product["discount_summ"]
-                )
-                order["total"] -= product["discount_summ"]
-            else:
-                pass
+        # Snapshot of product is needed only for view of cart.
+        product.pop("product", None)
+        product.update(copy.deepcopy(ORDER_LINE_DEFAULTS))
 
-            order["global_discount"] = global_discount
-            order["global_discount_summ"] = order["total"] * global_discount
-            order["total_with_discount"] = (
-                order["total"] - order["global_discount_summ"]
-            )
+    rules, missed = await PROMOCODES.resolve(promocodes)
 
-        else:
-            return {"error": f"Promocode {promocode} not found"}
+    if missed:
+        return {"error": f"Promocode {missed[0]} not found"}
 
-    result_order = await ORDER_COLLECTION.insert_one(order)
+    apply_discounts(order, rules)
 
-    if result_order:
-        await CARTS_COLLECTION.update_one(
-            {"_id": ObjectId(cid)}, {"$set": {"products": [], "total": 0}}
-        )
-        oid = result_order.inserted_id
-
-        if pay_timeout:
-            background_task.add_task(order_pay_timer, pay_timeout, oid)
+    oid = await STORAGE.insert_order(order)
 
+    if oid:
+        await STORAGE.clear_cart(cid)
         return {"status": f"Order {oid} created."}
     else:
         return {"error": f"Order for {cid} not created."}
 
 
+async def order_create_helper(data: Order) -> dict:
+    """
+    Create order from cart for user with that uid.
+    """
+    cid = await get_user_cid(data)
+
+    if cid:
+        return await order_add_helper(data, cid)
+    else:
+        return {"error": f"User {data.uid} not found"}
+
+
+def encode_order_cursor(order: dict) -> str:
+    """
+    Return cursor pointing after that order in history of orders.
+    """
+    return urlsafe_b64encode(f"{order['date']}|{order['id']}".encode()).decode()
+
+
+def decode_order_cursor(cursor: str) -> tuple[str, str]:
+    """
+    Return (date, oid) of order that cursor points after.
+    """
+    date, oid = urlsafe_b64decode(cursor.encode()).decode().split("|")
+    return date, str(ObjectId(oid))
+
+
+async def order_history_helper(
+    uid: str, limit: int, cursor: str = None, summary: bool = False, status: str = None
+) -> dict:
+    """
+    Return page of orders for that uid sorted from newest to oldest and cursor of next page.
+    """
+    after = None
+
+    if cursor:
+        try:
+            after = decode_order_cursor(cursor)
+        except (InvalidId, ValueError):
+            return {"error": f"Bad cursor {cursor}"}
+
+    orders, last = await STORAGE.order_page(uid, limit, after, status, summary)
+
+    if not orders and not cursor:
+        return {"error": f"No orders found for user {uid}"}
+
+    next_cursor = encode_order_cursor(last) if last else None
+    return {"orders": orders, "next_cursor": next_cursor}
+
+
 async def order_pay_helper(oid: str, pay_system: str) -> dict:
     """
     Pay order with that data.
     """
-    order = await ORDER_COLLECTION.find_one({"_id": ObjectId(oid)})
+    order = await STORAGE.get_order(
+        oid,
+        ["status", "expires_at", "total_with_discount", "global_discount", "products"],
+    )
 
-    if order["status"] in ("Paid", "Returned"):
+    if not order:
+        return {"error": f"Order {oid} not found."}
+    elif order["status"] in ("Paid", "Returned"):
         return {"error": f"Order {oid} already paid."}
+    elif order["status"] == "Paying":
+        return {"error": f"Order {oid} is being paid."}
     elif order["status"] == "Expired":
         return {"error": f"Order {oid} expired."}
+    elif order.get("expires_at") and order["expires_at"] <= utcnow():
+        await STORAGE.set_order_fields(oid, "Created", {"status": "Expired"})
+        return {"error": f"Order {oid} expired."}
+
+    # Order is reserved before payment, so concurrent payments and sweeper of not paid orders
+    # can't change it until payment is finished or reservation is cancelled. Reservation is
+    # changed only by its owner, as it can be released by sweeper and taken by other request.
+    owner = {"paying_id": uuid4().hex}
+    reservation = {
+        "status": "Paying",
+        "paying_until": utcnow() + timedelta(seconds=settings.PAY_RESERVATION),
+        **owner,
+    }
+
+    if not await STORAGE.set_order_fields(oid, "Created", reservation):
+        return {"error": f"Order {oid} not paid."}
 
     pay_summ = order["total_with_discount"]
-    pay_result = paysystem_mock.send_payment(oid, pay_summ, pay_system)
-
-    if pay_result["pay_status"] == "Successful":
-        result = {
-            "status": "Paid",
-            "pay_id": pay_result["pay_id"],
-            "pay_date": pay_result["pay_date"],
-            "pay_system": pay_system,
-            "pay_status": pay_result["pay_status"],
-        }
-        await ORDER_COLLECTION.update_one({"_id": ObjectId(oid)}, {"$set": result})
-        return {"status": f"Order {oid} is paid."}
-    else:
+    result = None
+
+    try:
+        pay_result = await payments.get_client().send_payment(oid, pay_summ, pay_system)
+
+        if pay_result["pay_status"] == "Successful":
+            result = {
+                "status": "Paid",
+                "pay_id": pay_result["pay_id"],
+                "pay_date": pay_result["pay_date"],
+                "pay_system": pay_system,
+                "pay_status": pay_result["pay_status"],
+            }
+    except payments.PaymentError:
+        return {"error": f"Payment system {pay_system} is not available."}
+    finally:
+        if result is None:
+            await STORAGE.set_order_fields(oid, "Paying", {"status": "Created"}, owner)
+
+    if result is None:
         return {"error": f"Order {oid} not paid."}
 
+    # Reservation released by sweeper and not taken by other request is still of this payment.
+    for status in ("Paying", "Created"):
+        if await STORAGE.set_order_fields(oid, status, result, owner):
+            await analytics.record_payment(order, result["pay_date"])
+            return {"status": f"Order {oid} is paid."}
+
+    await refund_payment(oid, result, pay_summ)
+    return {"error": f"Order {oid} not paid."}
+
+
+async def refund_payment(oid: str, result: dict, pay_summ: float) -> None:
+    """
+    Return payment which is not recorded in order, so order is not charged twice.
+
+    Payment which is not returned is recorded in unrefunded payments of order.
+    """
+    try:
+        refund = await payments.get_client().return_payment(
+            result["pay_id"], pay_summ, result["pay_system"], f"{oid}-payment"
+        )
+    except payments.PaymentError:
+        refund = {"pay_status": "Failed"}
+
+    if refund["pay_status"] != "Successful":
+        logger.error(
+            "Payment %s of order %s in summ %s is not returned",
+            result["pay_id"],
+            oid,
+            pay_summ,
+        )
+        await STORAGE.add_unrefunded_payment(
+            oid,
+            {
+                "pay_id": result["pay_id"],
+                "pay_summ": pay_summ,
+                "pay_system": result["pay_system"],
+                "pay_date": result["pay_date"],
+            },
+        )
+
 
 async def order_return_helper(oid: str, data: ProductReturn) -> dict:
     """
     Return products from order with that oid.
+
+    Return is written to order before refund and cancelled if refund fails,
+    so concurrent returns can't refund more than quantity in order.
     """
     pid, quantity = data.model_dump().values()
-    order = await ORDER_COLLECTION.find_one({"_id": ObjectId(oid)})
-
-    if order["status"] not in ("Paid", "Returned"):
-        return {"error": f"Order {oid} is not paid."}
 
-    products = order["products"]
-    order_pids = [product["pid"] for product in products]
+    for _ in range(ORDER_UPDATE_ATTEMPTS):
+        order = await STORAGE.order_line(oid, pid)
+
+        if not order:
+            return {"error": f"Order {oid} not found."}
+        elif order["status"] not in ("Paid", "Returned"):
+            return {"error": f"Order {oid} is not paid."}
+        elif not order.get("products"):
+            return {"error": f"Product {pid} not in order {oid}."}
+
+        product = order["products"][0]
+        return_quantity = product.get("return_quantity", 0)
+
+        if quantity > product["quantity"] - return_quantity:
+            return {
+                "error": f"Quantity {quantity} of product {pid} more then in order {oid}."
+            }
+
+        return_summ = (
+            quantity
+            * product["price"]
+            * (1 - product.get("discount", 0))
+            * (1 - order["global_discount"])
+        )
+        return_date = dt.now().isoformat()
 
-    if pid not in order_pids:
-        return {"error": f"Product {pid} not in order {oid}."}
+        if await STORAGE.add_return(
+            oid, pid, return_quantity, quantity, return_summ, return_date
+        ):
+            break
     else:
-        returned_product = products[order_pids.index(pid)]
-
-    if quantity > returned_product["quantity"] - returned_product["return_quantity"]:
-        return {
-            "error": f"Quantity {quantity} of product {pid} more then in order {oid}."
-        }
-
-    returned_product["return_quantity"] += quantity
-    returned_product["return_summ"] += (
-        quantity
-        * returned_product["price"]
-        * (1 - returned_product["discount"])
-        * (1 - order["global_discount"])
-    )
-    returned_product["return_status"] = "Returned"
-    returned_product["return_dates"] += [dt.now().isoformat()]
-    order["status"] = "Returned"
-
-    if (
-        paysystem_mock.return_payment(
-            order["pay_id"], returned_product["return_summ"], order["pay_system"]
-        )["pay_status"]
-        == "Successful"
-    ):
-        result = await ORDER_COLLECTION.update_one(
-            {"_id": ObjectId(oid)}, {"$set": order}
+        return {"error": f"Product {pid} in quantity {quantity} is not returned"}
+
+    try:
+        return_result = await payments.get_client().return_payment(
+            order["pay_id"],
+            return_summ,
+            order["pay_system"],
+            f"{oid}-{pid}-{return_date}",
         )
+    except payments.PaymentError:
+        return_result = {"pay_status": "Failed"}
 
-        if result.acknowledged:
-            return {"status": f"Product {pid} in quantity {quantity} is returned"}
-        else:
-            return {"error": f"Product {pid} in quantity {quantity} is not returned"}
+    if return_result["pay_status"] == "Successful":
+        await analytics.record_return(pid, quantity, return_summ, return_date)
+        return {"status": f"Product {pid} in quantity {quantity} is returned"}
 
-    else:
-        return {"error": "Payment is not returned."}
+    await STORAGE.cancel_return(
+        oid, pid, quantity, return_summ, return_date, order["status"]
+    )
+    return {"error": "Payment is not returned."}
 
 
 async def order_return_status_helper(order: dict) -> list | dict:
@@ -330,4 +480,4 @@ async def order_return_status_helper(order: dict) -> list | dict:
         ]
         return result
     else:
-        return {"error": f'No returned products in order {str(order["_id"])}'}
+        return {"error": f"No returned products in order {str(order['_id'])}"}
@@ -0,0 +1,140 @@
+import asyncio
+import hashlib
+import json
+import logging
+import uuid
+from datetime import timedelta
+from typing import Annotated
+from fastapi import Header
+from cache import LRUCache
+from scheduler import utcnow
+from settings import settings
+from storage import STORAGE
+
+IdempotencyKey = Annotated[
+    str | None, Header(alias="Idempotency-Key", min_length=1, max_length=255)
+]
+
+logger = logging.getLogger(__name__)
+
+RESULTS = LRUCache(settings.IDEMPOTENCY_CACHE_SIZE, settings.IDEMPOTENCY_TTL)
+IN_FLIGHT = {}
+
+
+def fingerprint(payload: dict) -> str:
+    """
+    Return hash of request payload.
+    """
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+async def run(key: str | None, scope: str, payload: dict, handler, *args) -> dict:
+    """
+    Return await handler(*args), or stored result of previous request with that Idempotency-Key.
+
+    Concurrent requests with the same key wait for the first one. Only successful results are stored,
+    so requests which returned error can be repeated.
+    """
+    if not key:
+        return await handler(*args)
+
+    key = f"{scope}:{key}"
+    entry = RESULTS.get(key)
+
+    if entry is None:
+        task = IN_FLIGHT.get(key)
+
+        if task is None:
+            task = asyncio.create_task(
+                execute(key, fingerprint(payload), handler, *args)
+            )
+            IN_FLIGHT[key] = task
+            task.add_done_callback(lambda _: IN_FLIGHT.pop(key, None))
+
+        entry = await asyncio.shield(task)
+
+    if entry["fingerprint"] != fingerprint(payload):
+        return {"error": f"Idempotency-Key {key} is used for other request."}
+
+    return entry["response"]
+
+
+async def execute(key: str, request_fingerprint: str, handler, *args) -> dict:
+    """
+    Run handler once for all workers and store its result.
+
+    Key is claimed for IDEMPOTENCY_LEASE seconds and the lease is renewed while handler runs,
+    so only if worker stops before result is stored, the next request with that key runs handler
+    again after lease.
+    """
+    deadline = asyncio.get_running_loop().time() + settings.IDEMPOTENCY_WAIT
+    owner = uuid.uuid4().hex
+
+    while True:
+        now = utcnow()
+        stored = await STORAGE.claim_key(
+            key,
+            {
+                "fingerprint": request_fingerprint,
+                "owner": owner,
+                "response": None,
+                "created_at": now,
+                "locked_until": now + timedelta(seconds=settings.IDEMPOTENCY_LEASE),
+            },
+        )
+
+        if stored is None:
+            break
+        elif stored["response"] is not None:
+            entry = {
+                "fingerprint": stored["fingerprint"],
+                "response": stored["response"],
+            }
+            RESULTS.set(key, entry)
+            return entry
+        elif asyncio.get_running_loop().time() > deadline:
+            return {
+                "fingerprint": request_fingerprint,
+                "response": {
+                    "error": f"Request with Idempotency-Key {key} is in progress."
+                },
+            }
+
+        await asyncio.sleep(0.05)
+
+    renewal = asyncio.create_task(renew_lease(key, owner))
+
+    try:
+        response = await handler(*args)
+    except BaseException:
+        await STORAGE.release_key(key, owner)
+        raise
+    finally:
+        renewal.cancel()
+
+    if "error" in response:
+        await STORAGE.release_key(key, owner)
+        return {"fingerprint": request_fingerprint, "response": response}
+
+    if not await STORAGE.save_key(key, owner, response):
+        logger.error("Result of request with Idempotency-Key %s is not saved", key)
+
+    entry = {"fingerprint": request_fingerprint, "response": response}
+    RESULTS.set(key, entry)
+    return entry
+
+
+async def renew_lease(key: str, owner: str) -> None:
+    """
+    Extend lease of claimed key every third of IDEMPOTENCY_LEASE until cancelled.
+    """
+    while True:
+        await asyncio.sleep(settings.IDEMPOTENCY_LEASE / 3)
+        locked_until = utcnow() + timedelta(seconds=settings.IDEMPOTENCY_LEASE)
+
+        try:
+            if not await STORAGE.renew_key(key, owner, locked_until):
+                logger.error("Lease of Idempotency-Key %s is lost", key)
+                return
+        except Exception:
+            logger.exception("Lease of Idempotency-Key %s is not renewed", key)
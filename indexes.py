@@ -0,0 +1,295 @@
+import argparse
+import asyncio
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+from database import MONGO
+from scheduler import utcnow
+from settings import settings
+from storage import archive_query, order_history_query
+
+# Code of error of index with the same name and other options.
+INDEX_OPTIONS_CONFLICT = 85
+
+INDEXES = {
+    "orders": [
+        IndexModel(
+            [("uid", ASCENDING), ("date", DESCENDING), ("_id", DESCENDING)],
+            name="orders_history",
+        ),
+        IndexModel(
+            [
+                ("uid", ASCENDING),
+                ("status", ASCENDING),
+                ("date", DESCENDING),
+                ("_id", DESCENDING),
+            ],
+            name="orders_history_status",
+        ),
+        IndexModel(
+            "expires_at",
+            name="orders_expiry",
+            partialFilterExpression={"status": "Created"},
+        ),
+        IndexModel(
+            "paying_until",
+            name="orders_payment",
+            partialFilterExpression={"status": "Paying"},
+        ),
+        IndexModel(
+            [("status", ASCENDING), ("date", ASCENDING)], name="orders_archival"
+        ),
+    ],
+    "orders_archive": [
+        IndexModel(
+            [("uid", ASCENDING), ("date", DESCENDING), ("_id", DESCENDING)],
+            name="orders_archive_history",
+        ),
+        IndexModel(
+            [
+                ("uid", ASCENDING),
+                ("status", ASCENDING),
+                ("date", DESCENDING),
+                ("_id", DESCENDING),
+            ],
+            name="orders_archive_history_status",
+        ),
+    ],
+    "carts": [IndexModel("products.pid", name="carts_products_pid")],
+    "sales_daily": [
+        IndexModel(
+            [("day", ASCENDING), ("pid", ASCENDING)],
+            name="sales_daily_day_pid",
+            unique=True,
+        )
+    ],
+    "promocodes": [IndexModel("code", name="promocodes_code", unique=True)],
+    "idempotency_keys": [
+        IndexModel(
+            "created_at",
+            name="idempotency_keys_ttl",
+            expireAfterSeconds=settings.IDEMPOTENCY_TTL,
+        )
+    ],
+}
+
+HISTORY_SORT = {"date": DESCENDING, "_id": DESCENDING}
+
+# Collection, place of usage, filter, sort and whether full scan is expected.
+QUERY_SHAPES = [
+    ("users", "storage.MotorStorage.user_cid", {"_id": ObjectId()}, None, False),
+    (
+        "products",
+        "storage.MotorStorage.find_products",
+        {"_id": ObjectId()},
+        None,
+        False,
+    ),
+    (
+        "products",
+        "storage.MotorStorage.find_products(pids)",
+        {"_id": {"$in": [ObjectId(), ObjectId()]}},
+        None,
+        False,
+    ),
+    ("products", "storage.MotorStorage.find_products()", {}, None, True),
+    ("carts", "storage.MotorStorage.get_cart", {"_id": ObjectId()}, None, False),
+    (
+        "carts",
+        "storage.MotorStorage.cart_add",
+        {"_id": ObjectId(), "products.pid": str(ObjectId())},
+        None,
+        False,
+    ),
+    (
+        "carts",
+        "storage.MotorStorage.cart_remove",
+        {
+            "_id": ObjectId(),
+            "products": {"$elemMatch": {"pid": str(ObjectId()), "quantity": 1}},
+        },
+        None,
+        False,
+    ),
+    (
+        "carts",
+        "storage.MotorStorage.refresh_cart_snapshots",
+        {
+            "products": {
+                "$elemMatch": {
+                    "pid": str(ObjectId()),
+                    "product.version": {"$ne": 1},
+                }
+            }
+        },
+        None,
+        False,
+    ),
+    (
+        "orders",
+        "storage.MotorStorage.order_page",
+        order_history_query(str(ObjectId())),
+        HISTORY_SORT,
+        False,
+    ),
+    (
+        "orders",
+        "storage.MotorStorage.order_page(after, status)",
+        order_history_query(
+            str(ObjectId()), "Paid", (utcnow().isoformat(), str(ObjectId()))
+        ),
+        HISTORY_SORT,
+        False,
+    ),
+    (
+        "orders_archive",
+        "storage.MotorStorage.order_page",
+        order_history_query(str(ObjectId())),
+        HISTORY_SORT,
+        False,
+    ),
+    ("orders", "storage.MotorStorage.get_order", {"_id": ObjectId()}, None, False),
+    (
+        "orders",
+        "storage.MotorStorage.archive_orders",
+        archive_query(utcnow().isoformat()),
+        None,
+        False,
+    ),
+    (
+        "orders",
+        "storage.MotorStorage.expire_orders",
+        {"status": "Created", "expires_at": {"$lte": utcnow()}},
+        None,
+        False,
+    ),
+    (
+        "orders",
+        "storage.MotorStorage.release_payments",
+        {"status": "Paying", "paying_until": {"$lte": utcnow()}},
+        None,
+        False,
+    ),
+    (
+        "sales_daily",
+        "storage.MotorStorage.find_rollups",
+        {"day": {"$gte": "2024-11-01", "$lte": "2024-11-30"}},
+        {"day": ASCENDING, "pid": ASCENDING},
+        False,
+    ),
+    ("promocodes", "storage.MotorStorage.find_promocodes()", {}, None, True),
+    (
+        "promocodes",
+        "storage.MotorStorage.find_promocodes(codes)",
+        {"code": {"$in": ["MINISHOP10", "MINISHOP20"]}},
+        None,
+        False,
+    ),
+]
+
+
+async def ensure_indexes() -> None:
+    """
+    Create all declared indexes, existing indexes are left as is except expireAfterSeconds
+    of TTL indexes, which is changed to the declared one, e.g. after change of IDEMPOTENCY_TTL.
+    """
+    for collection, indexes in INDEXES.items():
+        try:
+            await MONGO.db[collection].create_indexes(indexes)
+        except OperationFailure as e:
+            if e.code != INDEX_OPTIONS_CONFLICT:
+                raise
+
+            await update_ttl(collection, indexes)
+            await MONGO.db[collection].create_indexes(indexes)
+
+
+async def update_ttl(collection: str, indexes: list[IndexModel]) -> None:
+    """
+    Set expireAfterSeconds of existing TTL indexes of collection to declared values.
+    """
+    for index in indexes:
+        document = index.document
+
+        if "expireAfterSeconds" in document:
+            await MONGO.db.command(
+                "collMod",
+                collection,
+                index={
+                    "name": document["name"],
+                    "expireAfterSeconds": document["expireAfterSeconds"],
+                },
+            )
+
+
+def plan_stages(plan: dict) -> list[str]:
+    """
+    Return names of all stages of query plan.
+    """
+    stages = [plan["stage"]] if "stage" in plan else []
+
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages += plan_stages(plan[key])
+
+    for child in plan.get("inputStages", []):
+        stages += plan_stages(child)
+
+    return stages
+
+
+async def explain_queries() -> list[dict]:
+    """
+    Return winning plan stages of all query shapes and flag unexpected collection scans.
+    """
+    report = []
+
+    for collection, usage, query, sort, scan_expected in QUERY_SHAPES:
+        command = {"find": collection, "filter": query}
+
+        if sort:
+            command["sort"] = sort
+
+        result = await MONGO.db.command(
+            {"explain": command, "verbosity": "queryPlanner"}
+        )
+        stages = plan_stages(result["queryPlanner"]["winningPlan"])
+        report += [
+            {
+                "collection": collection,
+                "usage": usage,
+                "stages": stages,
+                "collscan": "COLLSCAN" in stages and not scan_expected,
+            }
+        ]
+
+    return report
+
+
+async def main(explain: bool) -> int:
+    await ensure_indexes()
+
+    if not explain:
+        return 0
+
+    report = await explain_queries()
+
+    for line in report:
+        flag = "COLLSCAN!" if line["collscan"] else "ok"
+        stages = " <- ".join(line["stages"])
+        print(f"{flag:9} {line['collection']:11} {line['usage']:40} {stages}")
+
+    return 1 if any(line["collscan"] for line in report) else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Create indexes of minishop database and check plans of its queries."
+    )
+    parser.add_argument(
+        "--explain",
+        action="store_true",
+        help="explain all queries of application and fail on collection scans",
+    )
+    args = parser.parse_args()
+    raise SystemExit(asyncio.run(main(args.explain)))
@@ -0,0 +1,381 @@
+"""
+Load fixtures and synthetic data into minishop database.
+
+Documents are generated lazily and written by unordered insert_many batches, several batches
+at a time, so memory is bounded by batch size and concurrency:
+python loader.py --fixtures json --users 1000000 --products 10000 --orders 10000000
+"""
+
+import argparse
+import asyncio
+import copy
+import itertools
+import os
+import random
+import time
+from datetime import datetime as dt, timedelta
+from bson import json_util
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
+from cache import product_snapshot
+from database import MONGO
+from promocodes import GLOBAL_PID, apply_discounts
+from storage import ORDER_LINE_DEFAULTS
+import indexes
+
+FIXTURE_COLLECTIONS = ["users", "products", "carts", "orders", "promocodes"]
+# Archive and rollups of dropped orders are dropped too, rollups are rebuilt by analytics.py.
+DROPPED_COLLECTIONS = FIXTURE_COLLECTIONS + ["orders_archive", "sales_daily"]
+# First 8 hex digits of synthetic ids by collection, the rest is the number of document,
+# so ids of other collections are known without keeping them in memory.
+ID_PREFIXES = {
+    "users": "5a000001",
+    "carts": "5a000002",
+    "products": "5a000003",
+    "promocodes": "5a000004",
+}
+COLORS = ["Black", "White", "Grey", "Red", "Green", "Blue", "Gold", "Silver"]
+DISCOUNTS = [0.05, 0.1, 0.15, 0.2, 0.3, 0.5]
+DISCOUNT_WEIGHTS = [30, 30, 15, 12, 8, 5]
+GLOBAL_PROMOCODES_PART = 0.05
+PROMOCODE_RATE = 0.3
+CART_FILL_RATE = 0.3
+STATUSES = ["Paid", "Returned", "Created", "Expired"]
+STATUS_WEIGHTS = [60, 5, 15, 20]
+
+
+def synthetic_id(collection: str, number: int) -> ObjectId:
+    return ObjectId(f"{ID_PREFIXES[collection]}{number:016x}")
+
+
+def batched(documents, size: int):
+    """
+    Yield lists of size documents from iterable.
+    """
+    iterator = iter(documents)
+
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+async def insert_batch(collection, batch: list[dict]) -> int:
+    """
+    Insert batch ignoring duplicates, return number of inserted documents.
+    """
+    try:
+        result = await collection.insert_many(batch, ordered=False)
+        return len(result.inserted_ids)
+    except BulkWriteError as e:
+        return e.details["nInserted"]
+
+
+async def insert_stream(
+    collection, documents, batch_size: int, concurrency: int
+) -> int:
+    """
+    Insert documents by batches with at most concurrency batches at a time, return number of inserted documents.
+    """
+    pending = set()
+    inserted = 0
+
+    for batch in batched(documents, batch_size):
+        if len(pending) >= concurrency:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            inserted += sum(task.result() for task in done)
+
+        pending.add(asyncio.create_task(insert_batch(collection, batch)))
+
+    if pending:
+        done, _ = await asyncio.wait(pending)
+        inserted += sum(task.result() for task in done)
+
+    return inserted
+
+
+def read_fixture(fixtures: str, name: str) -> list[dict]:
+    path = os.path.join(fixtures, f"minishop.{name}.json")
+
+    if not os.path.exists(path):
+        return []
+
+    with open(path) as f:
+        return json_util.loads(f.read())
+
+
+class Generator:
+    """
+    Generator of synthetic documents.
+
+    Popularity of products follows Zipf distribution with exponent zipf, so a few products
+    are in most carts and orders. Promocodes are mostly discounts of products, some are Global.
+    """
+
+    def __init__(
+        self,
+        users: int,
+        products: int,
+        promocodes: int,
+        days: int,
+        zipf: float,
+        carts_by_uid: bool,
+        seed: int = None,
+    ) -> None:
+        self.users = users
+        self.products = products
+        self.promocodes = promocodes
+        self.days = days
+        self.carts_by_uid = carts_by_uid
+        self.random = random.Random(seed)
+        self.now = dt.now()
+        self.cum_weights = list(
+            itertools.accumulate(1 / rank**zipf for rank in range(1, products + 1))
+        )
+        self.catalog = list(self.product_documents())
+        self.rules = list(self.promocode_documents())
+        self.rules_by_pid = {}
+
+        for rule in self.rules:
+            self.rules_by_pid.setdefault(rule["pid"], []).append(rule)
+
+    def cid(self, number: int) -> ObjectId:
+        return synthetic_id("users" if self.carts_by_uid else "carts", number)
+
+    def product_documents(self):
+        for number in range(self.products):
+            yield {
+                "_id": synthetic_id("products", number),
+                "name": f"Product {number}",
+                "color": self.random.choice(COLORS),
+                "price": round(self.random.lognormvariate(8, 1.5)) + 1,
+            }
+
+    def promocode_documents(self):
+        for number in range(self.promocodes):
+            if self.random.random() < GLOBAL_PROMOCODES_PART:
+                pid = GLOBAL_PID
+            else:
+                pid = str(self.popular_product()["_id"])
+
+            yield {
+                "_id": synthetic_id("promocodes", number),
+                "pid": pid,
+                "code": f"PROMO{number}",
+                "discount": self.random.choices(DISCOUNTS, DISCOUNT_WEIGHTS)[0],
+            }
+
+    def popular_product(self) -> dict:
+        return self.random.choices(self.catalog, cum_weights=self.cum_weights)[0]
+
+    def lines(self, count: int, snapshots: bool = True) -> list[dict]:
+        """
+        Return cart lines of count popular products, with snapshots of products if snapshots is true.
+        """
+        lines = {}
+
+        for _ in range(count):
+            product = self.popular_product()
+            pid = str(product["_id"])
+            quantity = self.random.randint(1, 3)
+            line = lines.get(pid)
+
+            if line is None:
+                line = lines[pid] = {
+                    "pid": pid,
+                    "price": product["price"],
+                    "quantity": 0,
+                    "summ": 0,
+                }
+
+                if snapshots:
+                    line["product"] = product_snapshot(product)
+
+            line["quantity"] += quantity
+            line["summ"] += product["price"] * quantity
+
+        return list(lines.values())
+
+    def user_documents(self):
+        for number in range(self.users):
+            uid = synthetic_id("users", number)
+            yield {"_id": uid, "name": f"user{number}", "cid": str(self.cid(number))}
+
+    def cart_documents(self):
+        for number in range(self.users):
+            count = self.random.randint(1, 3)
+            # Without products carts are empty.
+            filled = self.catalog and self.random.random() < CART_FILL_RATE
+            lines = self.lines(count) if filled else []
+            yield {
+                "_id": self.cid(number),
+                "products": lines,
+                "total": sum(line["summ"] for line in lines),
+            }
+
+    def order_documents(self, count: int):
+        for _ in range(count):
+            yield self.order()
+
+    def order(self) -> dict:
+        """
+        Return order in the same form as created and paid by application.
+        """
+        lines = self.lines(self.random.randint(1, 4), snapshots=False)
+        date = self.now - timedelta(seconds=self.random.uniform(0, self.days * 86400))
+        status = self.random.choices(STATUSES, STATUS_WEIGHTS)[0]
+        rules = []
+
+        if self.rules and self.random.random() < PROMOCODE_RATE:
+            pid = self.random.choice(lines)["pid"]
+            rules = self.rules_by_pid.get(pid) or [self.random.choice(self.rules)]
+
+        for line in lines:
+            line.update(copy.deepcopy(ORDER_LINE_DEFAULTS))
+
+        total = sum(line["summ"] for line in lines)
+        order = {
+            "uid": str(synthetic_id("users", self.random.randrange(self.users))),
+            "date": date.isoformat(),
+            "products": lines,
+            "promocodes": [rule["code"] for rule in rules[:1]],
+            "global_discount": 0,
+            "global_discount_summ": 0,
+            "total": total,
+            "total_with_discount": total,
+            "status": status,
+            "expires_at": None,
+            "pay_date": None,
+            "pay_id": None,
+            "pay_status": None,
+            "pay_system": None,
+        }
+        apply_discounts(order, rules[:1])
+
+        if status in ("Paid", "Returned"):
+            pay_date = date + timedelta(seconds=self.random.uniform(1, 600))
+            order.update(
+                {
+                    "pay_date": pay_date.isoformat(),
+                    "pay_id": f"{self.random.getrandbits(128):032x}",
+                    "pay_status": "Successful",
+                    "pay_system": self.random.choice(["VISA", "MasterCard", "MIR"]),
+                }
+            )
+
+        if status == "Returned":
+            line = self.random.choice(lines)
+            return_date = pay_date + timedelta(days=self.random.uniform(0, 14))
+            line.update(
+                {
+                    "return_quantity": 1,
+                    "return_summ": line["price"]
+                    * (1 - line["discount"])
+                    * (1 - order["global_discount"]),
+                    "return_status": "Returned",
+                    "return_dates": [return_date.isoformat()],
+                }
+            )
+        elif status == "Expired":
+            order["expires_at"] = date + timedelta(minutes=15)
+
+        return order
+
+
+async def load(collection: str, documents, args) -> None:
+    start = time.perf_counter()
+    inserted = await insert_stream(
+        MONGO.db[collection], documents, args.batch_size, args.concurrency
+    )
+    elapsed = time.perf_counter() - start
+    print(f"{collection:11} {inserted:>10} documents in {elapsed:.1f}s")
+
+
+async def main(args) -> int:
+    if args.orders and not (args.users and args.products):
+        print("Orders need --users and --products")
+        return 1
+    elif args.promocodes and not args.products:
+        print("Promocodes need --products")
+        return 1
+
+    if args.drop:
+        for collection in DROPPED_COLLECTIONS:
+            await MONGO.db.drop_collection(collection)
+
+    if args.fixtures:
+        for collection in FIXTURE_COLLECTIONS:
+            await load(collection, read_fixture(args.fixtures, collection), args)
+
+    if args.users or args.products:
+        generator = Generator(
+            args.users,
+            args.products,
+            args.promocodes,
+            args.days,
+            args.zipf,
+            args.carts_by_uid,
+            args.seed,
+        )
+        await load("products", generator.catalog, args)
+        await load("promocodes", generator.rules, args)
+        await load("users", generator.user_documents(), args)
+        await load("carts", generator.cart_documents(), args)
+        await load("orders", generator.order_documents(args.orders), args)
+
+        if args.uids_file:
+            with open(args.uids_file, "w") as f:
+                for number in range(min(args.users, args.uids_count)):
+                    f.write(f"{synthetic_id('users', number)}\n")
+
+    # Indexes are built once after loading, it is faster than updating them by every batch.
+    await indexes.ensure_indexes()
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load fixtures and synthetic users, carts, products, promocodes and orders."
+    )
+    parser.add_argument("--fixtures", help="directory of minishop.<collection>.json")
+    parser.add_argument("--users", type=int, default=0, help="number of users")
+    parser.add_argument("--products", type=int, default=0, help="number of products")
+    parser.add_argument(
+        "--promocodes", type=int, default=0, help="number of promocodes"
+    )
+    parser.add_argument("--orders", type=int, default=0, help="number of orders")
+    parser.add_argument(
+        "--days", type=int, default=365, help="orders are created in last days"
+    )
+    parser.add_argument(
+        "--zipf",
+        type=float,
+        default=1.1,
+        help="exponent of Zipf distribution of popularity of products",
+    )
+    parser.add_argument(
+        "--carts-by-uid",
+        action="store_true",
+        help="_id of cart is the same as _id of its user, as with CARTS_BY_UID",
+    )
+    parser.add_argument("--seed", type=int, help="seed of random generator")
+    parser.add_argument(
+        "--batch-size", type=int, default=5000, help="documents in one insert_many"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="batches inserted at a time"
+    )
+    parser.add_argument(
+        "--drop", action="store_true", help="drop collections before loading"
+    )
+    parser.add_argument(
+        "--uids-file", help="write uids of synthetic users for MINISHOP_UIDS of locust"
+    )
+    parser.add_argument(
+        "--uids-count",
+        type=int,
+        default=10000,
+        help="number of uids written to uids file",
+    )
+    args = parser.parse_args()
+    raise SystemExit(asyncio.run(main(args)))
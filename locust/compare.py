@@ -0,0 +1,107 @@
+"""
+Compare locust stats of a run with baseline, exit with code 1 on regressions.
+
+Works with *_stats.csv of locust (--csv option) and with results of microbench.py:
+python locust/compare.py baseline_stats.csv new_stats.csv --threshold 0.1
+Baseline of load test is recorded with the same scenarios on the reference commit.
+"""
+
+import argparse
+import csv
+
+# Metric and True if higher value is worse.
+METRICS = [("50%", True), ("95%", True), ("99%", True), ("Requests/s", False)]
+
+
+def read_stats(path: str) -> dict:
+    """
+    Return rows of stats by (Type, Name), without Aggregated row.
+    """
+    with open(path, newline="") as f:
+        return {
+            (row["Type"], row["Name"]): row
+            for row in csv.DictReader(f)
+            if row["Name"] != "Aggregated"
+        }
+
+
+def compare(
+    baseline: dict, current: dict, threshold: float, min_delta: float
+) -> list[dict]:
+    """
+    Return changes of metrics for every request of baseline.
+
+    Change is a regression if it is worse than baseline by more than threshold part
+    and, for latencies, by more than min_delta ms.
+    """
+    changes = []
+
+    for key, base in baseline.items():
+        row = current.get(key)
+
+        if row is None:
+            changes += [{"key": key, "metric": "missing", "regression": True}]
+            continue
+
+        for metric, higher_is_worse in METRICS:
+            before, after = float(base[metric] or 0), float(row[metric] or 0)
+            change = (after - before) / before if before else 0.0
+            worse = change if higher_is_worse else -change
+            regression = worse > threshold
+
+            if higher_is_worse:
+                regression = regression and after - before > min_delta
+
+            changes += [
+                {
+                    "key": key,
+                    "metric": metric,
+                    "before": before,
+                    "after": after,
+                    "change": change,
+                    "regression": regression,
+                }
+            ]
+
+    return changes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare p50/p95/p99 and RPS of locust stats with baseline."
+    )
+    parser.add_argument("baseline", help="stats CSV of baseline run")
+    parser.add_argument("current", help="stats CSV of compared run")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="allowed part of degradation, 0.1 by default",
+    )
+    parser.add_argument(
+        "--min-delta",
+        type=float,
+        default=1.0,
+        help="allowed increase of latency in ms regardless of threshold, 1 by default",
+    )
+    args = parser.parse_args()
+    changes = compare(
+        read_stats(args.baseline),
+        read_stats(args.current),
+        args.threshold,
+        args.min_delta,
+    )
+
+    for change in changes:
+        name = " ".join(change["key"])
+        flag = "REGRESSION" if change["regression"] else "ok"
+
+        if change["metric"] == "missing":
+            print(f"{flag:10} {name:50} missing in current run")
+        else:
+            print(
+                f"{flag:10} {name:50} {change['metric']:10} "
+                f"{change['before']:10.3f} -> {change['after']:10.3f} {change['change']:+7.1%}"
+            )
+
+    raise SystemExit(1 if any(change["regression"] for change in changes) else 0)
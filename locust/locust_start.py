@@ -1,20 +1,132 @@
-from locust import HttpUser, task
+import json
+import os
+import random
+from bson import ObjectId
+from locust import HttpUser, between, task
 
-exist_pid = "6707956239445e8693a16362"
-exist_uid = "671210a24c0b7d4a8caa715a"
-extra_uid = "671210b74c0b7d4a8caa715b"
+FIXTURES = os.path.join(os.path.dirname(__file__), "..", "json")
 
 
-class WebsiteUser(HttpUser):
-    @task(2)
+def load_uids() -> list[str]:
+    """
+    Return uids of users for load test, from file in MINISHOP_UIDS (one uid per line) or from fixtures.
+    """
+    path = os.environ.get("MINISHOP_UIDS")
+
+    if path:
+        with open(path) as f:
+            return [line.strip() for line in f if line.strip()]
+
+    with open(os.path.join(FIXTURES, "minishop.users.json")) as f:
+        return [user["_id"]["$oid"] for user in json.load(f)]
+
+
+def load_promocodes() -> list[str]:
+    with open(os.path.join(FIXTURES, "minishop.promocodes.json")) as f:
+        return [rule["code"] for rule in json.load(f)]
+
+
+UIDS = load_uids()
+PROMOCODES = load_promocodes()
+
+
+class ShopperUser(HttpUser):
+    """
+    User browsing products, changing cart, reading history and buying with returns.
+
+    Weights of tasks follow usual shop traffic: reads of catalog are the most frequent,
+    checkouts are rare.
+    """
+
+    wait_time = between(0, 0.1)
+
+    def on_start(self):
+        self.uid = random.choice(UIDS)
+        self.pids = [p["id"] for p in self.client.get("/products/").json()]
+
+    def random_pid(self) -> str:
+        return random.choice(self.pids)
+
+    @task(10)
     def get_products(self):
         self.client.get("/products/")
 
-    @task(2)
+    @task(8)
+    def get_product(self):
+        self.client.get(f"/products/{self.random_pid()}/", name="/products/[pid]/")
+
+    @task(1)
+    def get_not_exist_product(self):
+        self.client.get(f"/products/{ObjectId()}/", name="/products/[pid]/ not found")
+
+    @task(5)
     def get_cart(self):
-        self.client.get(f"/cart/{exist_uid}/")
+        self.client.get(f"/cart/{self.uid}/", name="/cart/[uid]/")
 
-    @task(2)
+    @task(4)
     def add_cart(self):
-        data = {"uid": extra_uid, "pid": exist_pid, "quantity": 1}
+        data = {"uid": self.uid, "pid": self.random_pid(), "quantity": 1}
         self.client.post("/cart/add/", json=data)
+
+    @task(2)
+    def remove_cart(self):
+        self.client.delete(
+            f"/cart/remove/{self.uid}/{self.random_pid()}/1/",
+            name="/cart/remove/[uid]/[pid]/[quantity]/",
+        )
+
+    @task(1)
+    def bulk_cart(self):
+        data = {
+            "uid": self.uid,
+            "add": [{"pid": self.random_pid(), "quantity": 1} for _ in range(3)],
+            "remove": [{"pid": self.random_pid(), "quantity": 1}],
+        }
+        self.client.post("/cart/bulk/", json=data)
+
+    @task(3)
+    def get_orders(self):
+        response = self.client.get(f"/order/{self.uid}/", name="/order/[uid]/")
+        cursor = response.json().get("next_cursor")
+
+        if cursor:
+            self.client.get(
+                f"/order/{self.uid}/",
+                params={"cursor": cursor, "summary": True},
+                name="/order/[uid]/ next page",
+            )
+
+    @task(1)
+    def checkout(self):
+        pid = self.random_pid()
+        self.client.post(
+            "/cart/add/", json={"uid": self.uid, "pid": pid, "quantity": 2}
+        )
+        promocodes = random.sample(PROMOCODES, k=random.randint(0, 1))
+        status = self.client.post(
+            "/order/create/",
+            json={"uid": self.uid, "promocodes": promocodes, "pay_timeout": 60},
+            headers={"Idempotency-Key": str(ObjectId())},
+        ).json()
+
+        if "error" in status:
+            return
+
+        oid = status["status"].split()[1]
+        paid = self.client.post(
+            "/order/pay/",
+            json={"oid": oid, "pay_system": "VISA"},
+            headers={"Idempotency-Key": str(ObjectId())},
+        ).json()
+
+        if "error" in paid or random.random() < 0.7:
+            return
+
+        self.client.post(
+            f"/order/{oid}/return/",
+            json={"pid": pid, "quantity": 1},
+            name="/order/[oid]/return/",
+        )
+        self.client.get(
+            f"/order/{oid}/return_status/", name="/order/[oid]/return_status/"
+        )
@@ -0,0 +1,263 @@
+"""
+Micro-benchmarks of helpers.py run against in-process stand-in of MongoDB (mongomock-motor).
+
+Results are written in format of locust stats, so they can be compared with baseline by compare.py:
+python locust/microbench.py --csv locust/microbench_stats.csv
+python locust/compare.py locust/microbench_baseline.csv locust/microbench_stats.csv --threshold 0.3
+Calls take less than ms, so thresholds are higher than for load tests of server.
+"""
+
+import argparse
+import asyncio
+import copy
+import csv
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+os.environ.setdefault("DB_URI", "mongodb://localhost:27017/")
+
+# Stand-in must replace client before database module is imported.
+import motor.motor_asyncio  # noqa: E402
+from mongomock_motor import AsyncMongoMockClient  # noqa: E402
+
+STAND_IN = AsyncMongoMockClient()
+motor.motor_asyncio.AsyncIOMotorClient = lambda *args, **kwargs: STAND_IN
+
+from bson import ObjectId, json_util  # noqa: E402
+import helpers  # noqa: E402
+from cache import CATALOG  # noqa: E402
+from database import MONGO, ORDER_COLLECTION  # noqa: E402
+from loader import Generator  # noqa: E402
+from models import Cart, CartBulk, CartLine, Order, ProductReturn  # noqa: E402
+
+COLLECTIONS = ["users", "products", "carts", "orders", "promocodes"]
+PERCENTILES = [
+    "50%",
+    "66%",
+    "75%",
+    "80%",
+    "90%",
+    "95%",
+    "98%",
+    "99%",
+    "99.9%",
+    "99.99%",
+    "100%",
+]
+FIELDS = [
+    "Type",
+    "Name",
+    "Request Count",
+    "Failure Count",
+    "Median Response Time",
+    "Average Response Time",
+    "Min Response Time",
+    "Max Response Time",
+    "Average Content Size",
+    "Requests/s",
+    "Failures/s",
+    *PERCENTILES,
+]
+
+UID = "671210a24c0b7d4a8caa715a"
+PID = "6707956239445e8693a16362"
+# History is read for its own user with fixed number of orders. Orders are reset before every
+# benchmark, so timings don't depend on orders created by other benchmarks, their selection
+# and number of iterations.
+HISTORY_UID = "671210a24c0b7d4a8caa7160"
+HISTORY_ORDERS = 200
+
+
+def read_fixture(name: str) -> list[dict]:
+    with open(os.path.join(ROOT, "json", f"minishop.{name}.json")) as f:
+        return json_util.loads(f.read())
+
+
+async def load_fixtures() -> None:
+    for name in COLLECTIONS:
+        await MONGO.db[name].insert_many(read_fixture(name))
+
+
+async def reset_orders(history: list[dict]) -> None:
+    """
+    Replace orders with orders of fixtures and history of HISTORY_UID.
+    """
+    await MONGO.db.drop_collection("orders")
+    await MONGO.db.orders.insert_many(read_fixture("orders") + copy.deepcopy(history))
+
+
+async def create_order(cid: str) -> str:
+    await helpers.cart_add_helper(Cart(uid=UID, pid=PID, quantity=2), cid)
+    status = await helpers.order_add_helper(
+        Order(uid=UID, promocodes=["IPHONE15"], pay_timeout=0), cid
+    )
+    return status["status"].split()[1]
+
+
+async def paid_order(cid: str) -> str:
+    oid = await create_order(cid)
+    await helpers.order_pay_helper(oid, "VISA")
+    return oid
+
+
+# Every benchmark prepares its data and returns not awaited call, only the call is timed.
+
+
+async def catalog_get_cold(cid):
+    CATALOG.invalidate()
+    return CATALOG.get(PID)
+
+
+async def cart(cid):
+    return helpers.cart_helper(cid)
+
+
+async def cart_add(cid):
+    return helpers.cart_add_helper(Cart(uid=UID, pid=PID, quantity=1), cid)
+
+
+async def cart_del(cid):
+    await helpers.cart_add_helper(Cart(uid=UID, pid=PID, quantity=1), cid)
+    return helpers.cart_del_helper(UID, cid, PID, 1)
+
+
+async def cart_bulk(cid):
+    lines = [CartLine(pid=PID, quantity=1)]
+    return helpers.cart_bulk_helper(CartBulk(uid=UID, add=lines * 3, remove=lines), cid)
+
+
+async def order_create(cid):
+    await helpers.cart_add_helper(Cart(uid=UID, pid=PID, quantity=1), cid)
+    return helpers.order_add_helper(
+        Order(uid=UID, promocodes=["IPHONE15"], pay_timeout=0), cid
+    )
+
+
+async def order_history(cid):
+    return helpers.order_history_helper(HISTORY_UID, 20, None, False, None)
+
+
+async def order_history_summary(cid):
+    return helpers.order_history_helper(HISTORY_UID, 20, None, True, None)
+
+
+async def order_pay(cid):
+    return helpers.order_pay_helper(await create_order(cid), "VISA")
+
+
+async def order_return(cid):
+    oid = await paid_order(cid)
+    return helpers.order_return_helper(oid, ProductReturn(pid=PID, quantity=1))
+
+
+async def order_return_status(cid):
+    oid = await paid_order(cid)
+    await helpers.order_return_helper(oid, ProductReturn(pid=PID, quantity=1))
+    order = await ORDER_COLLECTION.find_one({"_id": ObjectId(oid)})
+    return helpers.order_return_status_helper(order)
+
+
+BENCHMARKS = {
+    "CATALOG.get cold": catalog_get_cold,
+    "cart_helper": cart,
+    "cart_add_helper": cart_add,
+    "cart_del_helper": cart_del,
+    "cart_bulk_helper": cart_bulk,
+    "order_add_helper": order_create,
+    "order_history_helper": order_history,
+    "order_history_helper summary": order_history_summary,
+    "order_pay_helper": order_pay,
+    "order_return_helper": order_return,
+    "order_return_status_helper": order_return_status,
+}
+
+
+def percentile(times: list[float], q: float) -> float:
+    return times[min(len(times) - 1, int(len(times) * q / 100))]
+
+
+def stats_row(name: str, times: list[float], failures: int) -> dict:
+    """
+    Return row of locust stats for times of calls in ms.
+    """
+    total = sum(times) / 1000
+    times = sorted(times)
+    row = {
+        "Type": "helper",
+        "Name": name,
+        "Request Count": len(times),
+        "Failure Count": failures,
+        "Median Response Time": round(statistics.median(times), 4),
+        "Average Response Time": round(statistics.mean(times), 4),
+        "Min Response Time": round(times[0], 4),
+        "Max Response Time": round(times[-1], 4),
+        "Average Content Size": 0,
+        "Requests/s": round(len(times) / total, 2),
+        "Failures/s": round(failures / total, 2),
+    }
+
+    for column in PERCENTILES:
+        row[column] = round(percentile(times, float(column[:-1])), 4)
+
+    return row
+
+
+async def run(iterations: int, names: list[str]) -> list[dict]:
+    await load_fixtures()
+    cid = await helpers.get_user_cid(_uid=UID)
+    generator = Generator(1, 100, 0, 365, 1.1, False, seed=1)
+    history = [{**generator.order(), "uid": HISTORY_UID} for _ in range(HISTORY_ORDERS)]
+    rows = []
+
+    for name in names:
+        await reset_orders(history)
+        times = []
+        failures = 0
+
+        for _ in range(iterations):
+            call = await BENCHMARKS[name](cid)
+            start = time.perf_counter()
+
+            try:
+                result = await call
+            except Exception:
+                result = {"error": "exception"}
+
+            times += [(time.perf_counter() - start) * 1000]
+
+            if isinstance(result, dict) and "error" in result:
+                failures += 1
+
+        rows += [stats_row(name, times, failures)]
+
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run micro-benchmarks of helpers.")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--csv", help="file for results in format of locust stats")
+    parser.add_argument(
+        "names",
+        nargs="*",
+        default=list(BENCHMARKS),
+        help="benchmarks to run, all by default",
+    )
+    args = parser.parse_args()
+    rows = asyncio.run(run(args.iterations, args.names))
+
+    for row in rows:
+        print(
+            f"{row['Name']:30} p50 {row['50%']:8.3f} ms  p95 {row['95%']:8.3f} ms  "
+            f"p99 {row['99%']:8.3f} ms  {row['Requests/s']:10.1f} calls/s  failures {row['Failure Count']}"
+        )
+
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from metrics import LOOP_LAG
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class LoopWatchdog:
+    """
+    Watchdog of event loop measuring its lag and dumping stacks of callbacks blocking it.
+
+    Task of watchdog sleeps interval and observes how much later it is woken up. Thread of watchdog
+    checks that task is woken up in time, and if it is late by more than threshold, it logs stack
+    of loop thread, which is the stack of blocking coroutine. In debug mode asyncio debug mode is on
+    too, it logs slow callbacks and not awaited coroutines, and stalls are kept for tests.
+    """
+
+    def __init__(self, interval: float, threshold: float, debug: bool = False) -> None:
+        self.interval = interval
+        self.threshold = threshold
+        self.debug = debug
+        self.lag = 0.0
+        self.stalls = 0
+        self.dumps = []
+        self._heartbeat = time.monotonic()
+        self._dumped = False
+        self._task = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._loop_debug = None
+
+    def start(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        if self.debug:
+            self._loop_debug = (loop.get_debug(), loop.slow_callback_duration)
+            loop.set_debug(True)
+            loop.slow_callback_duration = self.threshold
+
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._measure())
+        self._thread = threading.Thread(
+            target=self._watch, args=(threading.get_ident(),), daemon=True
+        )
+        self._thread.start()
+
+    async def stop(self) -> None:
+        self._stop.set()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        await asyncio.to_thread(self._thread.join)
+
+        if self._loop_debug:
+            loop = asyncio.get_running_loop()
+            loop.set_debug(self._loop_debug[0])
+            loop.slow_callback_duration = self._loop_debug[1]
+
+    async def _measure(self) -> None:
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.lag = max(0.0, now - start - self.interval)
+            self._heartbeat = now
+            self._dumped = False
+            LOOP_LAG.observe(self.lag)
+
+    def _watch(self, loop_thread: int) -> None:
+        # Stall is found at most threshold / 2 after threshold, thread mostly sleeps.
+        while not self._stop.wait(self.threshold / 2):
+            held = time.monotonic() - self._heartbeat - self.interval
+
+            if held > self.threshold and not self._dumped:
+                self._dumped = True
+                self.dump(loop_thread, held)
+
+    def dump(self, loop_thread: int, held: float) -> None:
+        """
+        Log stack of loop thread held for held seconds.
+        """
+        frame = sys._current_frames().get(loop_thread)
+        stack = "".join(traceback.format_stack(frame)) if frame else ""
+        self.stalls += 1
+        logger.warning("Event loop is blocked for %.3fs at:\n%s", held, stack)
+
+        if self.debug:
+            self.dumps += [stack]
+
+
+def create_watchdog() -> LoopWatchdog | None:
+    """
+    Return watchdog of LOOP_WATCHDOG mode or None if it is off.
+    """
+    if settings.LOOP_WATCHDOG == "off":
+        return None
+
+    return LoopWatchdog(
+        settings.LOOP_LAG_INTERVAL,
+        settings.LOOP_LAG_THRESHOLD,
+        settings.LOOP_WATCHDOG == "debug",
+    )
@@ -1,60 +1,261 @@
+import asyncio
+import os
+from datetime import date
 import uvicorn
+from contextlib import asynccontextmanager
 from typing import Annotated
-from bson.objectid import ObjectId
-from fastapi import FastAPI, BackgroundTasks, Path
+from fastapi import FastAPI, HTTPException, Path, Query, Response
+from fastapi.responses import FileResponse, PlainTextResponse
 from pydantic import AfterValidator
 
+import admission
+import analytics
 import helpers
-from database import ORDER_COLLECTION, PRODUCTS_COLLECTION
-from models import Cart, Order, ProductReturn, PayData, check_common_ids
+import idempotency
+import indexes
+import loop_watchdog
+import metrics
+import payments
+import profiling
+import scheduler
+from cache import CATALOG, USER_CIDS
+from database import MONGO
+from idempotency import IdempotencyKey
+from models import (
+    Cart,
+    CartBulk,
+    CartResponse,
+    ErrorResponse,
+    Order,
+    OrdersPageResponse,
+    ProductResponse,
+    ProductReturn,
+    PayData,
+    check_common_ids,
+)
+from promocodes import PROMOCODES
+from serializers import FastJSONResponse
+from settings import settings
+from storage import STORAGE
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Connect to database, create indexes, warm up pool and caches, start sweeper of not paid orders,
+    reconciler of carts, archiver of orders and watchdog of event loop. Stop them and close clients
+    on shutdown.
 
-app = FastAPI()
+    Application is ready only after warm-up and until shutdown.
+    """
+    if settings.STORAGE == "motor":
+        MONGO.connect()
+        await indexes.ensure_indexes()
+        await MONGO.warm_up(settings.MONGO_WARM_CONNECTIONS)
+
+    await CATALOG.all_json()
+
+    if PROMOCODES.preload:
+        await PROMOCODES.refresh()
+
+    sweeper = asyncio.create_task(
+        scheduler.run_expiry_sweeper(settings.EXPIRY_SWEEP_INTERVAL)
+    )
+    reconciler = asyncio.create_task(
+        scheduler.run_cart_reconciler(settings.CART_RECONCILE_INTERVAL)
+    )
+    archiver = asyncio.create_task(scheduler.run_archiver(settings.ARCHIVE_INTERVAL))
+    watchdog = app.state.watchdog = loop_watchdog.create_watchdog()
+
+    if watchdog:
+        watchdog.start()
+
+    app.state.ready = True
+    yield
+    app.state.ready = False
+    sweeper.cancel()
+    reconciler.cancel()
+    archiver.cancel()
+
+    if watchdog:
+        await watchdog.stop()
+
+    await payments.close_clients()
+    MONGO.close()
+
+
+# Endpoints returning large responses return FastJSONResponse themselves,
+# their response models are used only for documentation.
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+app.state.ready = False
+app.state.watchdog = None
+# Admission control is the innermost middleware, so rejected requests are still recorded in metrics.
+app.add_middleware(admission.AdmissionMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(profiling.ProfilingMiddleware)
+metrics.register_gauge(
+    "minishop_cache_entries",
+    "Number of entries in caches.",
+    lambda: [
+        ({"cache": name}, cache.stats()["size"])
+        for name, cache in (("catalog", CATALOG), ("user_cids", USER_CIDS))
+    ],
+)
+metrics.register_gauge(
+    "minishop_cache_hit_ratio",
+    "Part of cache lookups answered from memory.",
+    lambda: [
+        ({"cache": name}, cache.stats()["hit_ratio"])
+        for name, cache in (("catalog", CATALOG), ("user_cids", USER_CIDS))
+    ],
+)
+metrics.register_gauge(
+    "minishop_payment_breaker_open",
+    "1 if circuit breaker of payment gateway is not closed.",
+    lambda: [
+        ({"gateway": name}, int(client.breaker.state != "closed"))
+        for name, client in payments.CLIENTS.items()
+    ],
+)
+
+metrics.register_gauge(
+    "minishop_mongo_pool_connections",
+    "Number of connections to MongoDB by state, waiting are checkouts waiting for connection.",
+    lambda: [
+        ({"state": state}, MONGO.pool.stats()[state])
+        for state in ("open", "checked_out", "waiting")
+    ],
+)
+metrics.register_gauge(
+    "minishop_mongo_pool_saturation",
+    "Part of maximum pool size of MongoDB checked out.",
+    lambda: [({}, MONGO.pool.stats()["saturation"])],
+)
+metrics.register_gauge(
+    "minishop_admission_in_flight",
+    "Number of requests handled at the same time under admission control.",
+    lambda: [({}, admission.ADMISSION.in_flight)],
+)
+metrics.register_gauge(
+    "minishop_admission_queued",
+    "Number of requests waiting in queue of admission control.",
+    lambda: [({}, len(admission.ADMISSION.waiters))],
+)
+metrics.register_gauge(
+    "minishop_admission_rejected_total",
+    "Number of requests rejected by admission control by reason and priority.",
+    lambda: [
+        ({"reason": reason, "priority": priority}, count)
+        for (reason, priority), count in admission.ADMISSION.rejected.items()
+    ],
+    "counter",
+)
+metrics.register_gauge(
+    "minishop_event_loop_lag_last_seconds",
+    "Delay of the last wake-up of event loop watchdog.",
+    lambda: [({}, app.state.watchdog.lag)] if app.state.watchdog else [],
+)
+metrics.register_gauge(
+    "minishop_event_loop_stalls_total",
+    "Number of times event loop was blocked longer than LOOP_LAG_THRESHOLD.",
+    lambda: [({}, app.state.watchdog.stalls)] if app.state.watchdog else [],
+    "counter",
+)
+
+
+@app.get("/healthz", include_in_schema=False)
+async def get_health() -> dict:
+    """
+    Return status of process and usage of connection pool.
+    """
+    return {"status": "ok", "pool": MONGO.pool.stats()}
 
 
-@app.get("/products/")
-async def get_all_products() -> list | dict:
+@app.get("/readyz", include_in_schema=False)
+async def get_readiness() -> FastJSONResponse:
     """
-    Return all products.
+    Return status 200 if application is warmed up and connection pool is not saturated, 503 otherwise.
     """
-    result = []
-    all_products = PRODUCTS_COLLECTION.find()
+    pool = MONGO.pool.stats()
 
-    if all_products:
-        for product in await all_products.to_list():
-            result += [helpers.product_helper(product)]
-        return result
-    else:
-        return {"error": "No products found!"}
+    if not app.state.ready:
+        return FastJSONResponse({"status": "not ready", "pool": pool}, 503)
+    elif pool["saturation"] >= settings.READY_MAX_SATURATION:
+        return FastJSONResponse({"status": "saturated", "pool": pool}, 503)
+
+    return FastJSONResponse({"status": "ready", "pool": pool})
 
 
-@app.get("/products/{pid}/")
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def get_metrics() -> str:
+    """
+    Return metrics of application in Prometheus text format.
+    """
+    return metrics.render()
+
+
+@app.get("/admin/profiles/", include_in_schema=False)
+async def get_profiles(token: profiling.ProfileToken = None) -> list:
+    """
+    Return saved profiles of requests from newest to oldest.
+    """
+    if not profiling.check_token(token):
+        raise HTTPException(status_code=403)
+
+    return profiling.list_profiles()
+
+
+@app.get("/admin/profiles/{file}", include_in_schema=False)
+async def get_profile(file: str, token: profiling.ProfileToken = None) -> FileResponse:
+    """
+    Return collapsed stacks or speedscope file of saved profile.
+    """
+    if not profiling.check_token(token):
+        raise HTTPException(status_code=403)
+
+    for profile in profiling.list_profiles():
+        if file in (profile["collapsed"], profile["speedscope"]):
+            return FileResponse(os.path.join(settings.PROFILE_DIR, file))
+
+    raise HTTPException(status_code=404)
+
+
+@app.get("/products/", response_model=list[ProductResponse])
+async def get_all_products() -> Response:
+    """
+    Return all products.
+    """
+    return Response(content=await CATALOG.all_json(), media_type="application/json")
+
+
+@app.get("/products/{pid}/", response_model=ProductResponse | ErrorResponse)
 async def get_product(
     pid: str = Path(annotation=Annotated[str, AfterValidator(check_common_ids)]),
-) -> dict:
+) -> FastJSONResponse:
     """
     Return product with that pid.
     """
-    product = await PRODUCTS_COLLECTION.find_one({"_id": ObjectId(pid)})
+    product = await CATALOG.get(pid)
 
     if product:
-        return helpers.product_helper(product)
+        return FastJSONResponse(product)
     else:
-        return {"error": f"Product {pid} not found!"}
+        return FastJSONResponse({"error": f"Product {pid} not found!"})
 
 
-@app.get("/cart/{uid}/")
+@app.get("/cart/{uid}/", response_model=CartResponse | ErrorResponse)
 async def get_cart(
     uid: str = Path(annotation=Annotated[str, AfterValidator(check_common_ids)]),
-) -> dict:
+) -> FastJSONResponse:
     """
     Return cart for that uid.
     """
     cid = await helpers.get_user_cid(_uid=uid)
 
     if cid:
-        return await helpers.cart_helper(cid)
+        return FastJSONResponse(await helpers.cart_helper(cid))
     else:
-        return {"error": f"User {uid} not found"}
+        return FastJSONResponse({"error": f"User {uid} not found"})
 
 
 @app.post("/cart/add/")
@@ -70,6 +271,21 @@ async def add_to_cart(data: Cart) -> dict:
         return {"error": f"User {data.uid} not found"}
 
 
+@app.post("/cart/bulk/")
+async def bulk_cart(data: CartBulk) -> dict:
+    """
+    Add and remove many products in cart of user with uid.
+
+    Results of operations are returned in the same order as operations.
+    """
+    cid = await helpers.get_user_cid(data)
+
+    if cid:
+        return await helpers.cart_bulk_helper(data, cid)
+    else:
+        return {"error": f"User {data.uid} not found"}
+
+
 @app.delete("/cart/remove/{uid}/{pid}/{quantity}/")
 async def del_from_cart(
     quantity: Annotated[int, Path(ge=1)],
@@ -87,46 +303,58 @@ async def del_from_cart(
         return {"error": f"User {uid} not found"}
 
 
-@app.get("/order/{uid}/")
+@app.get("/order/{uid}/", response_model=OrdersPageResponse | ErrorResponse)
 async def get_user_orders(
     uid: str = Path(annotation=Annotated[str, AfterValidator(check_common_ids)]),
-) -> list | dict:
-    """
-    Return orders for that uid.
+    limit: int = Query(
+        settings.ORDERS_PAGE_SIZE, ge=1, le=settings.ORDERS_MAX_PAGE_SIZE
+    ),
+    cursor: str | None = None,
+    summary: bool = False,
+    status: str | None = None,
+) -> FastJSONResponse:
     """
-    result = []
-    orders = ORDER_COLLECTION.find({"uid": uid})
+    Return page of orders for that uid, from newest to oldest.
 
-    for order in await orders.to_list():
-        order["id"] = str(order.pop("_id"))
-        result += [order]
-
-    if result:
-        return result
-    else:
-        return {"error": f"No orders found for user {uid}"}
+    Next page is returned for next_cursor of previous page, summary orders are returned without products.
+    """
+    return FastJSONResponse(
+        await helpers.order_history_helper(uid, limit, cursor, summary, status)
+    )
 
 
 @app.post("/order/create/")
-async def create_order(data: Order, background_task: BackgroundTasks) -> dict:
+async def create_order(data: Order, idempotency_key: IdempotencyKey = None) -> dict:
     """
     Create order from cart for user with that uid.
-    """
-    cid = await helpers.get_user_cid(data)
 
-    if cid:
-        return await helpers.order_add_helper(data, cid, background_task)
-    else:
-        return {"error": f"User {data.uid} not found"}
+    Repeated request with the same Idempotency-Key header returns result of the first one.
+    """
+    return await idempotency.run(
+        idempotency_key,
+        "order_create",
+        data.model_dump(),
+        helpers.order_create_helper,
+        data,
+    )
 
 
 @app.post("/order/pay/")
-async def pay_order(data: PayData) -> dict:
+async def pay_order(data: PayData, idempotency_key: IdempotencyKey = None) -> dict:
     """
     Pay order with that data.
+
+    Repeated request with the same Idempotency-Key header returns result of the first one.
     """
     oid, pay_system = data.model_dump().values()
-    return await helpers.order_pay_helper(oid, pay_system)
+    return await idempotency.run(
+        idempotency_key,
+        "order_pay",
+        data.model_dump(),
+        helpers.order_pay_helper,
+        oid,
+        pay_system,
+    )
 
 
 @app.post("/order/{oid}/return/")
@@ -137,12 +365,7 @@ async def return_order(
     """
     Return products from order with that oid.
     """
-    order = await ORDER_COLLECTION.find_one({"_id": ObjectId(oid)})
-
-    if order:
-        return await helpers.order_return_helper(oid, data)
-    else:
-        return {"error": f"Order {oid} not found."}
+    return await helpers.order_return_helper(oid, data)
 
 
 @app.get("/order/{oid}/return_status/")
@@ -152,7 +375,7 @@ async def status_return_order(
     """
     Return status of returned products for that oid.
     """
-    order = await ORDER_COLLECTION.find_one({"_id": ObjectId(oid)})
+    order = await STORAGE.get_order(oid)
 
     if order:
         return await helpers.order_return_status_helper(order)
@@ -160,5 +383,29 @@ async def status_return_order(
         return {"error": f"Order {oid} not found."}
 
 
+@app.get("/analytics/sales/")
+async def get_sales(
+    start: date | None = None,
+    end: date | None = None,
+    pid: Annotated[str, AfterValidator(check_common_ids)] | None = None,
+) -> list | dict:
+    """
+    Return sales and returns of products by day from start to end, today by default.
+    """
+    end = end or date.today()
+    return await analytics.sales_report(start or end, end, pid)
+
+
+@app.get("/analytics/products/")
+async def get_products_sales(
+    start: date | None = None, end: date | None = None
+) -> list | dict:
+    """
+    Return totals of sales and returns with return rate of products from start to end, today by default.
+    """
+    end = end or date.today()
+    return await analytics.products_report(start or end, end)
+
+
 if __name__ == "__main__":
     uvicorn.run("main:app", reload=True)
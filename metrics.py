@@ -0,0 +1,312 @@
+import time
+from contextvars import ContextVar
+from settings import settings
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+ASYNC_OPERATIONS = {
+    "bulk_write",
+    "count_documents",
+    "create_indexes",
+    "delete_many",
+    "delete_one",
+    "find_one",
+    "find_one_and_update",
+    "index_information",
+    "insert_many",
+    "insert_one",
+    "update_many",
+    "update_one",
+}
+CURSOR_OPERATIONS = {"aggregate", "aggregate_raw_batches", "find"}
+
+
+class Histogram:
+    """
+    Histogram of observed values by values of labels, rendered in Prometheus text format.
+    """
+
+    def __init__(
+        self, name: str, description: str, labels: list[str], buckets=BUCKETS
+    ) -> None:
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, value: float, *labels) -> None:
+        series = self.series.get(labels)
+
+        if series is None:
+            # Counts of buckets, sum and count of values.
+            series = self.series[labels] = [0] * (len(self.buckets) + 2)
+
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                series[i] += 1
+
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+
+        for labels, series in self.series.items():
+            pairs = [f'{name}="{value}"' for name, value in zip(self.labels, labels)]
+
+            for bucket, count in zip(self.buckets, series):
+                le = ",".join(pairs + [f'le="{bucket}"'])
+                lines += [f"{self.name}_bucket{{{le}}} {count}"]
+
+            le = ",".join(pairs + ['le="+Inf"'])
+            lines += [f"{self.name}_bucket{{{le}}} {series[-1]}"]
+            lines += [f"{self.name}_sum{{{','.join(pairs)}}} {series[-2]}"]
+            lines += [f"{self.name}_count{{{','.join(pairs)}}} {series[-1]}"]
+
+        return lines
+
+
+class Timings:
+    """
+    Time spent by one request in database, payment system and serialization.
+    """
+
+    __slots__ = ("db_count", "db_time", "pay_time", "serialize_time")
+
+    def __init__(self) -> None:
+        self.db_count = 0
+        self.db_time = 0.0
+        self.pay_time = 0.0
+        self.serialize_time = 0.0
+
+
+REQUEST_TIMINGS = ContextVar("request_timings", default=None)
+
+HTTP_REQUESTS = Histogram(
+    "minishop_http_request_seconds",
+    "Time of handling of HTTP requests.",
+    ["method", "route", "status"],
+)
+DB_OPERATIONS = Histogram(
+    "minishop_db_operation_seconds",
+    "Time of database operations.",
+    ["collection", "operation"],
+)
+DB_OPERATIONS_PER_REQUEST = Histogram(
+    "minishop_db_operations_per_request",
+    "Number of database operations made by one HTTP request.",
+    ["route"],
+    COUNT_BUCKETS,
+)
+PAYMENT_CALLS = Histogram(
+    "minishop_payment_call_seconds",
+    "Time of calls of payment system including retries.",
+    ["operation", "outcome"],
+)
+ADMISSION_WAIT = Histogram(
+    "minishop_admission_wait_seconds",
+    "Time of waiting of admitted requests in queue of admission control.",
+    ["priority"],
+)
+LOOP_LAG = Histogram(
+    "minishop_event_loop_lag_seconds",
+    "Delay of wake-ups of event loop watchdog.",
+    [],
+)
+HISTOGRAMS = [
+    HTTP_REQUESTS,
+    DB_OPERATIONS,
+    DB_OPERATIONS_PER_REQUEST,
+    PAYMENT_CALLS,
+    ADMISSION_WAIT,
+    LOOP_LAG,
+]
+GAUGES = {}
+
+
+def register_gauge(
+    name: str, description: str, collect, metric_type: str = "gauge"
+) -> None:
+    """
+    Register gauge, or counter if metric_type is "counter", with values returned by collect() as list of (labels dict, value).
+    """
+    GAUGES[name] = (description, collect, metric_type)
+
+
+def observe_db(collection: str, operation: str, elapsed: float) -> None:
+    DB_OPERATIONS.observe(elapsed, collection, operation)
+    timings = REQUEST_TIMINGS.get()
+
+    if timings:
+        timings.db_count += 1
+        timings.db_time += elapsed
+
+
+def observe_payment(operation: str, outcome: str, elapsed: float) -> None:
+    PAYMENT_CALLS.observe(elapsed, operation, outcome)
+    timings = REQUEST_TIMINGS.get()
+
+    if timings:
+        timings.pay_time += elapsed
+
+
+def observe_serialization(elapsed: float) -> None:
+    timings = REQUEST_TIMINGS.get()
+
+    if timings:
+        timings.serialize_time += elapsed
+
+
+def render() -> str:
+    """
+    Return all metrics in Prometheus text format.
+    """
+    lines = []
+
+    for histogram in HISTOGRAMS:
+        lines += histogram.render()
+
+    for name, (description, collect, metric_type) in GAUGES.items():
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} {metric_type}"]
+
+        for labels, value in collect():
+            pairs = ",".join(f'{label}="{v}"' for label, v in labels.items())
+            lines += [f"{name}{{{pairs}}} {value}"]
+
+    return "\n".join(lines) + "\n"
+
+
+class InstrumentedCursor:
+    """
+    Cursor of collection which records time of its reading as one database operation.
+    """
+
+    def __init__(self, cursor, collection: str, operation: str) -> None:
+        self.cursor = cursor
+        self.collection = collection
+        self.operation = operation
+        self.elapsed = 0.0
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.cursor, name)
+
+        if not callable(attr):
+            return attr
+
+        def chained(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            return self if result is self.cursor else result
+
+        return chained
+
+    async def to_list(self, *args, **kwargs) -> list:
+        start = time.perf_counter()
+
+        try:
+            return await self.cursor.to_list(*args, **kwargs)
+        finally:
+            observe_db(self.collection, self.operation, time.perf_counter() - start)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        start = time.perf_counter()
+
+        try:
+            return await self.cursor.__anext__()
+        except StopAsyncIteration:
+            elapsed = self.elapsed + time.perf_counter() - start
+            observe_db(self.collection, self.operation, elapsed)
+            raise
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+
+class InstrumentedCollection:
+    """
+    Collection which records count and time of its operations.
+
+    Collection is returned by get_collection() on every access, so it follows reconnects of client.
+    """
+
+    def __init__(self, name: str, get_collection) -> None:
+        self.collection_name = name
+        self.get_collection = get_collection
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.get_collection(), name)
+
+        if name in ASYNC_OPERATIONS:
+
+            async def operation(*args, **kwargs):
+                start = time.perf_counter()
+
+                try:
+                    return await attr(*args, **kwargs)
+                finally:
+                    observe_db(self.collection_name, name, time.perf_counter() - start)
+
+            return operation
+        elif name in CURSOR_OPERATIONS:
+            return lambda *args, **kwargs: InstrumentedCursor(
+                attr(*args, **kwargs), self.collection_name, name
+            )
+
+        return attr
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording latency of routes and database operations of every request.
+
+    If SERVER_TIMING is on, Server-Timing header shows time spent in database, payment system and serialization.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        timings = Timings()
+        token = REQUEST_TIMINGS.set(timings)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message) -> None:
+            nonlocal status
+
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+                if settings.SERVER_TIMING:
+                    total = (time.perf_counter() - start) * 1000
+                    value = (
+                        f'db;dur={timings.db_time * 1000:.3f};desc="{timings.db_count} ops", '
+                        f"pay;dur={timings.pay_time * 1000:.3f}, "
+                        f"serialize;dur={timings.serialize_time * 1000:.3f}, "
+                        f"total;dur={total:.3f}"
+                    )
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"server-timing", value.encode())
+                    ]
+
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            REQUEST_TIMINGS.reset(token)
+            route = scope.get("route")
+            route = route.path if route else "unmatched"
+            HTTP_REQUESTS.observe(
+                time.perf_counter() - start, scope["method"], route, str(status)
+            )
+            DB_OPERATIONS_PER_REQUEST.observe(timings.db_count, route)
@@ -16,6 +16,21 @@ class Cart(BaseModel):
     validate_fields = field_validator("uid", "pid")(check_common_ids)
 
 
+class CartLine(BaseModel):
+    pid: str
+    quantity: PositiveInt
+
+    validate_fields = field_validator("pid")(check_common_ids)
+
+
+class CartBulk(BaseModel):
+    uid: str
+    add: list[CartLine] = []
+    remove: list[CartLine] = []
+
+    validate_fields = field_validator("uid")(check_common_ids)
+
+
 class Order(BaseModel):
     uid: str
     promocodes: list[str]
@@ -36,3 +51,64 @@ class ProductReturn(BaseModel):
     quantity: PositiveInt
 
     validate_fields = field_validator("pid")(check_common_ids)
+
+
+class ErrorResponse(BaseModel):
+    error: str
+
+
+class ProductResponse(BaseModel):
+    name: str
+    color: str
+    price: float
+    id: str
+
+
+class CartProductResponse(ProductResponse):
+    quantity: int
+    summ: float
+
+
+class CartResponse(BaseModel):
+    id: str
+    products: list[CartProductResponse]
+    total: float
+
+
+class OrderProductResponse(BaseModel):
+    pid: str
+    price: float
+    quantity: int
+    summ: float
+    discount: float = 0
+    discount_summ: float = 0
+    summ_with_discount: float = 0
+    return_quantity: int = 0
+    return_summ: float = 0
+    return_status: str | None = None
+    return_dates: list[str] = []
+
+
+class OrderResponse(BaseModel):
+    uid: str
+    date: str
+    products: list[OrderProductResponse] = Field(
+        None, description="Not returned in summary mode"
+    )
+    promocodes: list[str]
+    global_discount: float
+    global_discount_summ: float
+    total: float
+    total_with_discount: float
+    status: str
+    expires_at: str | None = None
+    pay_date: str | None
+    pay_id: str | None
+    pay_status: str | None
+    pay_system: str | None
+    id: str
+
+
+class OrdersPageResponse(BaseModel):
+    orders: list[OrderResponse]
+    next_cursor: str | None
@@ -0,0 +1,226 @@
+import asyncio
+import random
+import time
+import httpx
+import paysystem_mock
+from metrics import observe_payment
+from settings import settings
+
+RETRY_ERRORS = (ConnectionError, TimeoutError, httpx.TransportError)
+
+
+class PaymentError(Exception):
+    """
+    Payment system is not available.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stop calls of payment system after failure_threshold failures in a row for reset_timeout seconds.
+
+    After reset_timeout one trial call is allowed, the breaker is closed again if it succeeds.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        elif time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        """
+        Return True if call of payment system is allowed.
+        """
+        state = self.state
+
+        if state == "half-open" and not self.trial:
+            self.trial = True
+            return True
+
+        return state == "closed"
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def release(self) -> None:
+        """
+        End trial call without result, e.g. cancelled, so the next call can be a trial.
+        """
+        self.trial = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        self.trial = False
+
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+class HttpGateway:
+    """
+    Payment system with HTTP API, connections are pooled in one client.
+    """
+
+    def __init__(self, base_url: str, max_connections: int, timeout: float) -> None:
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            timeout=timeout,
+        )
+
+    async def _post(self, url: str, key: str, data: dict) -> dict:
+        response = await self.client.post(
+            url, json=data, headers={"Idempotency-Key": key}
+        )
+        response.raise_for_status()
+        return response.json()
+
+    async def send_payment(self, oid: str, pay_summ: float, pay_system: str) -> dict:
+        return await self._post(
+            "/payments/",
+            f"pay-{oid}",
+            {"order_id": oid, "pay_sum": pay_summ, "pay_system": pay_system},
+        )
+
+    async def return_payment(
+        self, pay_id: str, pay_summ: float, pay_system: str, return_id: str
+    ) -> dict:
+        return await self._post(
+            "/returns/",
+            f"return-{return_id}",
+            {"pay_id": pay_id, "pay_sum": pay_summ, "pay_system": pay_system},
+        )
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+class PaymentClient:
+    """
+    Client of payment system with limit of concurrent calls, timeout, retries and circuit breaker.
+    """
+
+    def __init__(
+        self,
+        gateway,
+        concurrency: int,
+        timeout: float,
+        retries: int,
+        backoff: float,
+        breaker: CircuitBreaker,
+    ) -> None:
+        self.gateway = gateway
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker
+
+    async def send_payment(self, oid: str, pay_summ: float, pay_system: str) -> dict:
+        return await self._call(self.gateway.send_payment, oid, pay_summ, pay_system)
+
+    async def return_payment(
+        self, pay_id: str, pay_summ: float, pay_system: str, return_id: str
+    ) -> dict:
+        """
+        Return payment, return_id is unique for every return and is idempotency key of gateway.
+        """
+        return await self._call(
+            self.gateway.return_payment, pay_id, pay_summ, pay_system, return_id
+        )
+
+    async def _call(self, method, *args) -> dict:
+        start = time.perf_counter()
+        outcome = "error"
+
+        try:
+            result = await self._retry(method, *args)
+            outcome = "ok"
+            return result
+        finally:
+            observe_payment(method.__name__, outcome, time.perf_counter() - start)
+
+    async def _retry(self, method, *args) -> dict:
+        for attempt in range(self.retries + 1):
+            if not self.breaker.allow():
+                raise PaymentError("Circuit breaker is open")
+
+            try:
+                async with self.semaphore:
+                    result = await asyncio.wait_for(method(*args), self.timeout)
+            except (*RETRY_ERRORS, httpx.HTTPStatusError) as e:
+                self.breaker.failure()
+                # Rejected requests are not retried, only errors of server.
+                retry = not isinstance(e, httpx.HTTPStatusError) or (
+                    e.response.is_server_error
+                )
+
+                if attempt == self.retries or not retry:
+                    raise PaymentError(str(e)) from e
+
+                await asyncio.sleep(self.backoff * 2**attempt * random.uniform(1, 2))
+            except BaseException:
+                # Cancelled call or error of client is not failure of payment system,
+                # but it must not leave trial of breaker in progress forever.
+                self.breaker.release()
+                raise
+            else:
+                self.breaker.success()
+                return result
+
+
+CLIENTS = {}
+
+
+def get_client() -> PaymentClient:
+    """
+    Return client of configured gateway, it is created on first use and shared by all payment systems.
+    """
+    name = "http" if settings.PAY_GATEWAY_URL else "mock"
+    client = CLIENTS.get(name)
+
+    if client is None:
+        if settings.PAY_GATEWAY_URL:
+            gateway = HttpGateway(
+                settings.PAY_GATEWAY_URL, settings.PAY_CONCURRENCY, settings.PAY_TIMEOUT
+            )
+        else:
+            gateway = paysystem_mock
+
+        client = PaymentClient(
+            gateway,
+            settings.PAY_CONCURRENCY,
+            settings.PAY_TIMEOUT,
+            settings.PAY_RETRIES,
+            settings.PAY_BACKOFF,
+            CircuitBreaker(settings.PAY_BREAKER_FAILURES, settings.PAY_BREAKER_RESET),
+        )
+        CLIENTS[name] = client
+
+    return client
+
+
+async def close_clients() -> None:
+    """
+    Close connections of all payment clients.
+    """
+    for client in CLIENTS.values():
+        if hasattr(client.gateway, "close"):
+            await client.gateway.close()
+
+    CLIENTS.clear()
@@ -1,8 +1,23 @@
+import asyncio
+import random
 import uuid
 from datetime import datetime as dt
+from settings import settings
 
 
-def send_payment(oid: str, pay_summ: float, pay_system: str) -> dict:
+async def gateway_delay() -> None:
+    """
+    Wait like real payment system and fail with configured rate.
+    """
+    if settings.PAY_MOCK_LATENCY:
+        await asyncio.sleep(random.expovariate(1 / settings.PAY_MOCK_LATENCY))
+
+    if random.random() < settings.PAY_MOCK_FAILURE_RATE:
+        raise ConnectionError("Payment system is not available")
+
+
+async def send_payment(oid: str, pay_summ: float, pay_system: str) -> dict:
+    await gateway_delay()
     pay_id = uuid.uuid4().hex
     result = {
         "pay_id": pay_id,
@@ -16,7 +31,10 @@ def send_payment(oid: str, pay_summ: float, pay_system: str) -> dict:
     return result
 
 
-def return_payment(pay_id: str, pay_summ: float, pay_system: str) -> dict:
+async def return_payment(
+    pay_id: str, pay_summ: float, pay_system: str, return_id: str
+) -> dict:
+    await gateway_delay()
     pay_return_date = str(dt.now().isoformat())
     return {
         "pay_id": pay_id,
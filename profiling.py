@@ -0,0 +1,146 @@
+import asyncio
+import hmac
+import logging
+import os
+import random
+import re
+import time
+from datetime import datetime as dt
+from typing import Annotated
+from fastapi import Header
+from settings import settings
+
+try:
+    from pyinstrument import Profiler
+    from pyinstrument.renderers import SpeedscopeRenderer
+except ImportError:
+    Profiler = None
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = b"x-profile-token"
+ProfileToken = Annotated[str | None, Header(alias="X-Profile-Token")]
+COLLAPSED_SUFFIX = ".collapsed"
+SPEEDSCOPE_SUFFIX = ".speedscope.json"
+
+
+def check_token(token: str | None) -> bool:
+    """
+    Return True if token is equal to PROFILE_TOKEN.
+    """
+    return bool(
+        settings.PROFILE_TOKEN
+        and token
+        and hmac.compare_digest(token.encode(), settings.PROFILE_TOKEN.encode())
+    )
+
+
+def collapsed_stacks(frame, prefix: str = "") -> list[str]:
+    """
+    Return stacks of profile in collapsed format: frames separated by ";" and self time in microseconds.
+    """
+    name = f"{frame.function} ({frame.file_path_short}:{frame.line_no})"
+    stack = f"{prefix};{name}" if prefix else name
+    self_time = frame.time - sum(child.time for child in frame.children)
+    lines = [f"{stack} {round(self_time * 1e6)}"] if self_time > 0 else []
+
+    for child in frame.children:
+        lines += collapsed_stacks(child, stack)
+
+    return lines
+
+
+def write_profile(session, name: str) -> None:
+    """
+    Write profile as collapsed stacks and speedscope files, remove the oldest profiles over PROFILE_KEEP.
+    """
+    os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+    path = os.path.join(settings.PROFILE_DIR, name)
+    root = session.root_frame()
+
+    with open(path + COLLAPSED_SUFFIX, "w") as f:
+        f.write("\n".join(collapsed_stacks(root) if root else []) + "\n")
+
+    with open(path + SPEEDSCOPE_SUFFIX, "w") as f:
+        f.write(SpeedscopeRenderer().render(session))
+
+    for old in list_profiles()[settings.PROFILE_KEEP :]:
+        for suffix in (COLLAPSED_SUFFIX, SPEEDSCOPE_SUFFIX):
+            try:
+                os.remove(os.path.join(settings.PROFILE_DIR, old["name"] + suffix))
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles() -> list[dict]:
+    """
+    Return saved profiles from newest to oldest.
+    """
+    if not os.path.isdir(settings.PROFILE_DIR):
+        return []
+
+    names = sorted(
+        (
+            file[: -len(COLLAPSED_SUFFIX)]
+            for file in os.listdir(settings.PROFILE_DIR)
+            if file.endswith(COLLAPSED_SUFFIX)
+        ),
+        reverse=True,
+    )
+    return [
+        {
+            "name": name,
+            "collapsed": name + COLLAPSED_SUFFIX,
+            "speedscope": name + SPEEDSCOPE_SUFFIX,
+        }
+        for name in names
+    ]
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware profiling requests with pyinstrument in async mode.
+
+    Request is profiled if it has X-Profile-Token header equal to PROFILE_TOKEN or is sampled
+    with PROFILE_SAMPLE_RATE. Only one request is profiled at a time. Without pyinstrument
+    middleware does nothing.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+        self.active = False
+
+    def wanted(self, scope) -> bool:
+        if Profiler is None or self.active or scope["path"].startswith("/admin/"):
+            return False
+
+        if settings.PROFILE_TOKEN:
+            for key, value in scope["headers"]:
+                if key == PROFILE_HEADER:
+                    return check_token(value.decode("latin-1"))
+
+        return random.random() < settings.PROFILE_SAMPLE_RATE
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http" or not self.wanted(scope):
+            return await self.app(scope, receive, send)
+
+        self.active = True
+        profiler = Profiler(interval=settings.PROFILE_INTERVAL, async_mode="enabled")
+        start = time.perf_counter()
+        profiler.start()
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            session = profiler.stop()
+            self.active = False
+            elapsed = round((time.perf_counter() - start) * 1000)
+            route = scope.get("route")
+            route = re.sub(r"\W+", "_", route.path if route else "unmatched").strip("_")
+            name = f"{dt.now():%Y%m%dT%H%M%S.%f}-{scope['method']}-{route}-{elapsed}ms"
+
+            try:
+                await asyncio.to_thread(write_profile, session, name)
+            except OSError:
+                logger.exception("Profile %s is not saved", name)
@@ -0,0 +1,127 @@
+import asyncio
+import time
+from settings import settings
+from snapshot import SNAPSHOT, Snapshot
+from storage import STORAGE
+
+GLOBAL_PID = "Global"
+
+
+def apply_discounts(order: dict, rules: list[dict]) -> None:
+    """
+    Apply product and Global discounts of promocodes to order in one pass over its products.
+
+    If several promocodes are given for one product or Global, the last one is applied.
+    """
+    global_discount = 0
+    discounts = {}
+
+    for rule in rules:
+        if rule["pid"] == GLOBAL_PID:
+            global_discount = rule["discount"]
+        else:
+            discounts[rule["pid"]] = rule["discount"]
+
+    total = order["total"]
+
+    for product in order["products"]:
+        discount = discounts.get(product["pid"])
+
+        if discount is not None:
+            product["discount"] = discount
+            product["discount_summ"] = product["summ"] * discount
+            product["summ_with_discount"] = product["summ"] - product["discount_summ"]
+            total -= product["discount_summ"]
+
+    order["total"] = total
+    order["global_discount"] = global_discount
+    order["global_discount_summ"] = total * global_discount
+    order["total_with_discount"] = total - order["global_discount_summ"]
+
+
+class PromocodeEngine:
+    """
+    In-memory index of promocodes by code and by pid.
+
+    Index is reloaded from database, or from snapshot if it is given, after ttl seconds or invalidation.
+    If preload is off, promocodes are searched with one query per order.
+    """
+
+    def __init__(
+        self, ttl: float, preload: bool = True, snapshot: Snapshot = None
+    ) -> None:
+        self.ttl = ttl
+        self.preload = preload
+        self.snapshot = snapshot
+        self.codes = {}
+        self.pids = {}
+        self._expires = 0.0
+        self._lock = asyncio.Lock()
+
+    def load(self, rules: list[dict]) -> None:
+        """
+        Replace index with that promocodes.
+        """
+        codes = {}
+        pids = {}
+
+        for rule in rules:
+            rule = {
+                "code": rule["code"],
+                "pid": rule["pid"],
+                "discount": rule["discount"],
+            }
+            codes[rule["code"]] = rule
+            pids.setdefault(rule["pid"], []).append(rule)
+
+        self.codes = codes
+        self.pids = pids
+        self._expires = time.monotonic() + self.ttl
+
+    async def refresh(self) -> None:
+        """
+        Reload index from database.
+        """
+        if self.snapshot and self.snapshot.refresh():
+            self.load(self.snapshot.promocodes)
+            return
+
+        async with self._lock:
+            if self._expires <= time.monotonic():
+                self.load(await STORAGE.find_promocodes())
+
+    def invalidate(self) -> None:
+        """
+        Reload index from database on next use.
+        """
+        self._expires = 0.0
+
+    def rules_for(self, pid: str) -> list[dict]:
+        """
+        Return promocodes for product with that pid, including Global promocodes.
+        """
+        return self.pids.get(pid, []) + self.pids.get(GLOBAL_PID, [])
+
+    async def resolve(self, codes: list[str]) -> tuple[list[dict], list[str]]:
+        """
+        Return promocodes for that codes in the same order and list of not found codes.
+
+        Codes not found in index are searched in database with one query, as they can be added after loading of index.
+        """
+        if self.preload and self._expires <= time.monotonic():
+            await self.refresh()
+
+        found = {code: self.codes[code] for code in codes if code in self.codes}
+        missed = [code for code in dict.fromkeys(codes) if code not in found]
+
+        if missed:
+            for rule in await STORAGE.find_promocodes(missed):
+                found[rule["code"]] = rule
+
+        rules = [found[code] for code in codes if code in found]
+        return rules, [code for code in codes if code not in found]
+
+
+PROMOCODES = PromocodeEngine(
+    settings.PROMOCODES_TTL, settings.PROMOCODES_PRELOAD, SNAPSHOT
+)
@@ -0,0 +1,142 @@
+import asyncio
+import itertools
+import logging
+from datetime import datetime as dt, timedelta, timezone
+from cache import product_snapshot
+from settings import settings
+from storage import STORAGE
+
+logger = logging.getLogger(__name__)
+
+
+def utcnow() -> dt:
+    """
+    Return current UTC time without tzinfo, as it is returned from database.
+    """
+    return dt.now(timezone.utc).replace(tzinfo=None)
+
+
+def expires_at(pay_timeout: int) -> dt | None:
+    """
+    Return time when order with that pay timeout in seconds expires, None if timeout is 0.
+    """
+    if pay_timeout:
+        return utcnow() + timedelta(seconds=pay_timeout)
+
+
+async def expire_orders(now: dt = None) -> int:
+    """
+    Set status "Expired" for all not paid orders with passed expires_at, return number of expired orders.
+
+    Orders left reserved for payment by stopped workers are released first, so they can expire too.
+    """
+    now = now or utcnow()
+    released = await STORAGE.release_payments(now)
+
+    if released:
+        logger.warning("Released %s orders reserved for payment", released)
+
+    return await STORAGE.expire_orders(now)
+
+
+async def run_expiry_sweeper(interval: float) -> None:
+    """
+    Expire overdue orders every interval seconds until cancelled.
+
+    Update is conditional, so sweepers of several workers can run at the same time.
+    """
+    while True:
+        try:
+            expired = await expire_orders()
+
+            if expired:
+                logger.info("Expired %s orders", expired)
+        except Exception:
+            logger.exception("Orders expiration failed")
+
+        await asyncio.sleep(interval)
+
+
+async def reconcile_carts(versions: dict, full: bool = False) -> int:
+    """
+    Refresh snapshots of products changed since versions by pid, or of all products if full,
+    in lines of carts, return number of changed lines.
+
+    Versions are updated with versions of refreshed products. Full run repairs lines added
+    with stale snapshots from cache of catalog after their products were refreshed, database
+    updates only lines with other version, so it is cheap.
+    """
+    snapshots = {}
+
+    for product in await STORAGE.find_products():
+        snapshot = product_snapshot(product)
+
+        if full or versions.get(product["id"]) != snapshot["version"]:
+            snapshots[product["id"]] = snapshot
+
+    if not snapshots:
+        return 0
+
+    changed = await STORAGE.refresh_cart_snapshots(snapshots)
+    versions.update((pid, snapshot["version"]) for pid, snapshot in snapshots.items())
+    return changed
+
+
+async def run_cart_reconciler(interval: float) -> None:
+    """
+    Refresh snapshots of changed products in carts every interval seconds until cancelled.
+
+    Every run reads all products. The first run and every CART_RECONCILE_FULL_RUNS run
+    refresh all products, so lines without snapshots or with stale snapshots get current ones.
+    """
+    versions = {}
+
+    for run in itertools.count():
+        try:
+            full = run % settings.CART_RECONCILE_FULL_RUNS == 0
+            changed = await reconcile_carts(versions, full)
+
+            if changed:
+                logger.info("Refreshed %s cart lines", changed)
+        except Exception:
+            logger.exception("Carts reconciliation failed")
+
+        await asyncio.sleep(interval)
+
+
+async def archive_orders(now: dt = None) -> int:
+    """
+    Move expired orders and paid or returned orders older than ARCHIVE_AFTER_DAYS to archive by batches,
+    return number of moved orders.
+    """
+    # Dates of orders are local, as they are written by order_add_helper.
+    now = now or dt.now()
+    before = (now - timedelta(days=settings.ARCHIVE_AFTER_DAYS)).isoformat()
+    archived = 0
+
+    while True:
+        moved = await STORAGE.archive_orders(
+            before, settings.ARCHIVE_BATCH_SIZE, settings.ARCHIVE_COMPACT
+        )
+        archived += moved
+
+        if moved < settings.ARCHIVE_BATCH_SIZE:
+            return archived
+
+
+async def run_archiver(interval: float) -> None:
+    """
+    Archive orders every interval seconds until cancelled.
+
+    Order is removed from live collection only if it is not changed, so archivers of several workers can run at the same time.
+    """
+    while True:
+        try:
+            archived = await archive_orders()
+
+            if archived:
+                logger.info("Archived %s orders", archived)
+        except Exception:
+            logger.exception("Orders archiving failed")
+
+        await asyncio.sleep(interval)
@@ -0,0 +1,70 @@
+import struct
+import time
+import orjson
+from bson import ObjectId
+from fastapi.responses import JSONResponse
+from metrics import observe_serialization
+
+try:
+    import bsonjs
+except ImportError:
+    bsonjs = None
+
+# Stages converting _id of documents to str id on database side.
+ID_STAGES = [{"$set": {"id": {"$toString": "$_id"}}}, {"$project": {"_id": 0}}]
+
+
+def default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError
+
+
+def dumps(content) -> bytes:
+    """
+    Return content serialized to JSON, ObjectId are converted to str and datetime to ISO format.
+    """
+    return orjson.dumps(content, default=default)
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON response serialized with orjson.
+
+    Content is not processed by jsonable_encoder when response is returned from endpoint,
+    so it can contain pre-serialized JSON as orjson.Fragment.
+    """
+
+    def render(self, content) -> bytes:
+        start = time.perf_counter()
+        body = dumps(content)
+        observe_serialization(time.perf_counter() - start)
+        return body
+
+
+def raw_documents(batches: list[bytes]) -> list[bytes]:
+    """
+    Return BSON documents of raw batches without decoding them.
+    """
+    documents = []
+
+    for batch in batches:
+        offset = 0
+
+        while offset < len(batch):
+            (size,) = struct.unpack_from("<i", batch, offset)
+            documents += [batch[offset : offset + size]]
+            offset += size
+
+    return documents
+
+
+def raw_json_array(documents: list[bytes]) -> orjson.Fragment:
+    """
+    Return JSON array of BSON documents converted by bsonjs, documents must contain only JSON types.
+    """
+    return orjson.Fragment(
+        b"["
+        + b",".join(bsonjs.dumps(document).encode() for document in documents)
+        + b"]"
+    )
@@ -0,0 +1,53 @@
+import argparse
+import os
+import tempfile
+import uvicorn
+import snapshot
+from settings import settings
+
+
+def main(host: str, port: int, workers: int, path: str, graceful_timeout: int) -> None:
+    """
+    Publish snapshot of catalog and run workers of application under uvicorn supervisor.
+
+    Supervisor restarts died workers, SIGHUP restarts all workers one by one and
+    SIGTERM stops them after in-flight requests are finished.
+    """
+    snapshot.start_publisher(path, settings.CATALOG_SNAPSHOT_INTERVAL)
+    # Settings of workers are read from environment.
+    os.environ["CATALOG_SNAPSHOT"] = path
+    uvicorn.run(
+        "main:app",
+        host=host,
+        port=port,
+        workers=workers,
+        timeout_graceful_shutdown=graceful_timeout,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run minishop with several worker processes."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=settings.WORKERS or os.cpu_count(),
+        help="number of worker processes, number of cores by default",
+    )
+    parser.add_argument(
+        "--snapshot",
+        default=settings.CATALOG_SNAPSHOT
+        or os.path.join(tempfile.gettempdir(), "minishop.snapshot"),
+        help="file of catalog snapshot shared by workers",
+    )
+    parser.add_argument(
+        "--graceful-timeout",
+        type=int,
+        default=30,
+        help="time in seconds to finish requests of stopped workers",
+    )
+    args = parser.parse_args()
+    main(args.host, args.port, args.workers, args.snapshot, args.graceful_timeout)
@@ -3,7 +3,72 @@ from pydantic_settings import BaseSettings, SettingsConfigDict
 
 class Settings(BaseSettings):
     DB_URI: str
-    model_config = SettingsConfigDict(env_file='.env')
+    MONGO_MAX_POOL_SIZE: int = 100
+    MONGO_MIN_POOL_SIZE: int = 0
+    MONGO_MAX_CONNECTING: int = 2
+    MONGO_SERVER_SELECTION_TIMEOUT: float = 30
+    MONGO_CONNECT_TIMEOUT: float = 20
+    MONGO_SOCKET_TIMEOUT: float | None = None
+    MONGO_TIMEOUT: float | None = None
+    MONGO_COMPRESSORS: str | None = None
+    MONGO_WRITE_CONCERN: str | None = None
+    MONGO_JOURNAL: bool | None = None
+    MONGO_WARM_CONNECTIONS: int = 10
+    READY_MAX_SATURATION: float = 0.9
+    STORAGE: str = "motor"
+    STORAGE_FIXTURES: str | None = None
+    CATALOG_MAX_SIZE: int = 10000
+    CATALOG_TTL: float = 60
+    CATALOG_SNAPSHOT: str | None = None
+    CATALOG_SNAPSHOT_INTERVAL: float = 10
+    WORKERS: int | None = None
+    SERVER_TIMING: bool = False
+    ADMISSION_MAX_IN_FLIGHT: int = 256
+    ADMISSION_QUEUE_SIZE: int = 512
+    ADMISSION_QUEUE_TIMEOUT: float = 1
+    ADMISSION_RETRY_AFTER: float = 1
+    ADMISSION_USER_RATE: float = 0
+    ADMISSION_USER_BURST: int = 20
+    ADMISSION_USER_BUCKETS: int = 100000
+    LOOP_WATCHDOG: str = "production"
+    LOOP_LAG_INTERVAL: float = 0.5
+    LOOP_LAG_THRESHOLD: float = 0.1
+    PROFILE_TOKEN: str | None = None
+    PROFILE_SAMPLE_RATE: float = 0
+    PROFILE_INTERVAL: float = 0.001
+    PROFILE_DIR: str = "profiles"
+    PROFILE_KEEP: int = 50
+    USER_CID_CACHE_SIZE: int = 100000
+    USER_CID_TTL: float = 3600
+    CARTS_BY_UID: bool = False
+    EXPIRY_SWEEP_INTERVAL: float = 5
+    CART_RECONCILE_INTERVAL: float = 30
+    CART_RECONCILE_FULL_RUNS: int = 10
+    ARCHIVE_INTERVAL: float = 3600
+    ARCHIVE_AFTER_DAYS: float = 90
+    ARCHIVE_BATCH_SIZE: int = 1000
+    ARCHIVE_COMPACT: bool = False
+    PROMOCODES_TTL: float = 60
+    PROMOCODES_PRELOAD: bool = True
+    ORDERS_PAGE_SIZE: int = 20
+    ORDERS_MAX_PAGE_SIZE: int = 100
+    ORDERS_RAW_JSON: bool = False
+    ANALYTICS_MAX_DAYS: int = 366
+    PAY_GATEWAY_URL: str | None = None
+    PAY_CONCURRENCY: int = 100
+    PAY_TIMEOUT: float = 10
+    PAY_RETRIES: int = 2
+    PAY_BACKOFF: float = 0.1
+    PAY_BREAKER_FAILURES: int = 5
+    PAY_BREAKER_RESET: float = 30
+    PAY_RESERVATION: float = 300
+    PAY_MOCK_LATENCY: float = 0
+    PAY_MOCK_FAILURE_RATE: float = 0
+    IDEMPOTENCY_CACHE_SIZE: int = 10000
+    IDEMPOTENCY_TTL: int = 86400
+    IDEMPOTENCY_WAIT: float = 30
+    IDEMPOTENCY_LEASE: float = 60
+    model_config = SettingsConfigDict(env_file=".env")
 
 
 settings = Settings()
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import orjson
+from serializers import dumps
+from settings import settings
+from storage import STORAGE
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"MSHOPSN1"
+# Magic, version and sizes of index, products and promocodes sections.
+HEADER = struct.Struct("<8sQQQQ")
+
+
+def write_snapshot(path: str, version: int, products: list, promocodes: list) -> None:
+    """
+    Write snapshot of products and promocodes to file at that path.
+
+    Products section is JSON array of all products, index maps pid to offset and size of product in it.
+    File is replaced atomically, so readers see either old or new snapshot.
+    """
+    encoded = [dumps(product) for product in products]
+    index = {}
+    offset = 1
+
+    for product, data in zip(products, encoded):
+        index[product["id"]] = [offset, len(data)]
+        offset += len(data) + 1
+
+    sections = [dumps(index), b"[" + b",".join(encoded) + b"]", dumps(promocodes)]
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, version, *map(len, sections)))
+        f.writelines(sections)
+
+    os.replace(tmp_path, path)
+
+
+class Snapshot:
+    """
+    Read-only snapshot of products and promocodes mapped to memory of worker.
+
+    Pages of file are shared by all workers, only index of products is parsed by every worker.
+    File is checked for new version at most every check_interval seconds.
+    """
+
+    def __init__(self, path: str, check_interval: float = 1.0) -> None:
+        self.path = path
+        self.check_interval = check_interval
+        self.version = None
+        self.promocodes = []
+        self._file_id = None
+        self._checked = float("-inf")
+        self._index = {}
+        self._products = None
+
+    def refresh(self) -> bool:
+        """
+        Map new version of snapshot if file was replaced, return True if snapshot is loaded.
+        """
+        now = time.monotonic()
+
+        if now - self._checked >= self.check_interval:
+            self._checked = now
+
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return self._products is not None
+
+            if (stat.st_ino, stat.st_mtime_ns) != self._file_id:
+                self._load()
+                self._file_id = (stat.st_ino, stat.st_mtime_ns)
+
+        return self._products is not None
+
+    def _load(self) -> None:
+        with open(self.path, "rb") as f:
+            # Old map stays open while responses still use its memory.
+            view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+        magic, version, *sizes = HEADER.unpack_from(view)
+
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not a snapshot")
+
+        start = HEADER.size
+        sections = []
+
+        for size in sizes:
+            sections += [view[start : start + size]]
+            start += size
+
+        index, self._products, promocodes = sections
+        self._index = orjson.loads(index)
+        self.promocodes = orjson.loads(promocodes)
+        self.version = version
+
+    def products_json(self) -> memoryview:
+        """
+        Return JSON array of all products.
+        """
+        return self._products
+
+    def product(self, pid: str) -> dict | None:
+        """
+        Return product with that pid, None if it is not in snapshot.
+        """
+        entry = self._index.get(pid)
+
+        if entry:
+            offset, size = entry
+            return orjson.loads(self._products[offset : offset + size])
+
+
+async def publish(path: str) -> int:
+    """
+    Write snapshot of products and promocodes from database, return its version.
+    """
+    products = await STORAGE.find_products()
+    promocodes = await STORAGE.find_promocodes()
+    version = time.time_ns()
+    write_snapshot(path, version, products, promocodes)
+    return version
+
+
+async def run_publisher(path: str, interval: float, ready: threading.Event) -> None:
+    """
+    Publish snapshot every interval seconds, ready is set after the first attempt.
+    """
+    while True:
+        try:
+            version = await publish(path)
+            logger.debug("Published snapshot %s", version)
+        except Exception:
+            logger.exception("Publishing of snapshot failed")
+
+        ready.set()
+        await asyncio.sleep(interval)
+
+
+def start_publisher(path: str, interval: float) -> threading.Thread:
+    """
+    Start publisher of snapshot in thread of supervisor process, return after the first snapshot is written.
+    """
+    ready = threading.Event()
+    thread = threading.Thread(
+        target=asyncio.run,
+        args=(run_publisher(path, interval, ready),),
+        name="snapshot-publisher",
+        daemon=True,
+    )
+    thread.start()
+    ready.wait()
+    return thread
+
+
+SNAPSHOT = Snapshot(settings.CATALOG_SNAPSHOT) if settings.CATALOG_SNAPSHOT else None
@@ -0,0 +1,1195 @@
+import asyncio
+import bisect
+import copy
+import heapq
+import itertools
+import os
+from bson import decode, json_util
+from bson.raw_bson import RawBSONDocument
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, DeleteOne, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from database import (
+    ARCHIVE_COLLECTION,
+    CARTS_COLLECTION,
+    IDEMPOTENCY_COLLECTION,
+    ORDER_COLLECTION,
+    PRODUCTS_COLLECTION,
+    PROMOCODES_COLLECTION,
+    ROLLUPS_COLLECTION,
+    USERS_COLLECTION,
+)
+from serializers import ID_STAGES, bsonjs, raw_documents, raw_json_array
+from settings import settings
+
+CART_UPDATE_ATTEMPTS = 3
+ORDER_SUMMARY_PROJECTION = {"products": 0}
+# bsonjs converts dates to {"$date": ...}, so they are converted to str on database side.
+ORDER_RAW_STAGES = [
+    {
+        "$set": {
+            "expires_at": {
+                "$dateToString": {
+                    "date": "$expires_at",
+                    "format": "%Y-%m-%dT%H:%M:%S.%L",
+                }
+            }
+        }
+    }
+]
+ORDER_RETURN_FIELDS = ["status", "global_discount", "pay_id", "pay_system"]
+# Fields of order lines set on creation of order, fields with these values are not stored in compacted archive.
+ORDER_LINE_DEFAULTS = {
+    "discount": 0,
+    "discount_summ": 0,
+    "summ_with_discount": 0,
+    "return_quantity": 0,
+    "return_summ": 0,
+    "return_status": None,
+    "return_dates": [],
+}
+# Compacted lines of archived orders get default fields on database side for raw JSON.
+ORDER_EXPAND_STAGES = [
+    {
+        "$set": {
+            "products": {
+                "$map": {
+                    "input": "$products",
+                    "in": {"$mergeObjects": [ORDER_LINE_DEFAULTS, "$$this"]},
+                }
+            }
+        }
+    }
+]
+ARCHIVED_STATUSES = ["Paid", "Returned", "Expired"]
+ROLLUP_FIELDS = ["units", "gross", "discount", "returned_units", "refunds"]
+# Rollups are rebuilt from live and archived orders by the same formulas as sale_increments()
+# and refunds of returns, returned quantity of a line is counted on the day of its last return.
+PAID_MATCH = {
+    "$match": {
+        "status": {"$in": ["Paid", "Returned"]},
+        "pay_date": {"$type": "string"},
+    }
+}
+RETURNED_MATCH = {"$match": {"status": "Returned"}}
+ROLLUP_STAGES = [
+    [
+        PAID_MATCH,
+        {"$unionWith": {"coll": "orders_archive", "pipeline": [PAID_MATCH]}},
+        {"$unwind": "$products"},
+        {
+            "$group": {
+                "_id": {
+                    "day": {"$substrBytes": ["$pay_date", 0, 10]},
+                    "pid": "$products.pid",
+                },
+                "units": {"$sum": "$products.quantity"},
+                "gross": {"$sum": "$products.summ"},
+                "net": {
+                    "$sum": {
+                        "$multiply": [
+                            "$products.summ",
+                            {
+                                "$subtract": [
+                                    1,
+                                    {"$ifNull": ["$products.discount", 0]},
+                                ]
+                            },
+                            {"$subtract": [1, {"$ifNull": ["$global_discount", 0]}]},
+                        ]
+                    }
+                },
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "day": "$_id.day",
+                "pid": "$_id.pid",
+                "units": 1,
+                "gross": 1,
+                "discount": {"$subtract": ["$gross", "$net"]},
+            }
+        },
+    ],
+    [
+        RETURNED_MATCH,
+        {"$unionWith": {"coll": "orders_archive", "pipeline": [RETURNED_MATCH]}},
+        {"$unwind": "$products"},
+        {"$match": {"products.return_quantity": {"$gt": 0}}},
+        {
+            "$group": {
+                "_id": {
+                    "day": {
+                        "$substrBytes": [
+                            {"$arrayElemAt": ["$products.return_dates", -1]},
+                            0,
+                            10,
+                        ]
+                    },
+                    "pid": "$products.pid",
+                },
+                "returned_units": {"$sum": "$products.return_quantity"},
+                "refunds": {"$sum": "$products.return_summ"},
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "day": "$_id.day",
+                "pid": "$_id.pid",
+                "returned_units": 1,
+                "refunds": 1,
+            }
+        },
+    ],
+]
+ROLLUP_MERGE = {
+    "$merge": {
+        "into": "sales_daily",
+        "on": ["day", "pid"],
+        "whenMatched": "merge",
+        "whenNotMatched": "insert",
+    }
+}
+
+
+def order_history_query(
+    uid: str, status: str = None, after: tuple[str, str] = None
+) -> dict:
+    """
+    Return query for orders of user with that uid, after order with (date, oid) if it is given.
+    """
+    query = {"uid": uid}
+
+    if status:
+        query["status"] = status
+
+    if after:
+        date, oid = after
+        query["$or"] = [
+            {"date": {"$lt": date}},
+            {"date": date, "_id": {"$lt": ObjectId(oid)}},
+        ]
+
+    return query
+
+
+def archive_query(before: str) -> dict:
+    """
+    Return query for orders moved to archive: expired orders and paid or returned orders created before that date.
+    """
+    return {
+        "$or": [
+            {"status": "Expired"},
+            {"status": {"$in": ["Paid", "Returned"]}, "date": {"$lt": before}},
+        ]
+    }
+
+
+def is_archived(order: dict, before: str) -> bool:
+    return order["status"] == "Expired" or (
+        order["status"] in ("Paid", "Returned") and order["date"] < before
+    )
+
+
+def compact_order(order: dict) -> dict:
+    """
+    Return copy of order without fields of lines equal to ORDER_LINE_DEFAULTS.
+    """
+    lines = [
+        {
+            name: value
+            for name, value in line.items()
+            if name not in ORDER_LINE_DEFAULTS or value != ORDER_LINE_DEFAULTS[name]
+        }
+        for line in order["products"]
+    ]
+    return {**order, "products": lines}
+
+
+def expand_order(order: dict) -> dict:
+    """
+    Add fields of ORDER_LINE_DEFAULTS missed in lines of compacted order.
+    """
+    for line in order.get("products", []):
+        for name, value in ORDER_LINE_DEFAULTS.items():
+            if name not in line:
+                line[name] = copy.copy(value)
+
+    return order
+
+
+def merge_history(hot: list, archived: list, key) -> list:
+    """
+    Return orders of both lists from newest to oldest, order found in both lists is taken from hot.
+    """
+    merged = []
+    last = None
+
+    # Orders with equal keys are returned from the first list first.
+    for order in heapq.merge(hot, archived, key=key, reverse=True):
+        order_key = key(order)
+
+        if order_key != last:
+            merged += [order]
+            last = order_key
+
+    return merged
+
+
+def history_key(order: dict) -> tuple[str, str]:
+    return order["date"], order["id"]
+
+
+def raw_history_key(document: bytes) -> tuple[str, str]:
+    order = RawBSONDocument(document)
+    return order["date"], order["id"]
+
+
+def sale_increments(order: dict) -> dict:
+    """
+    Return increments of rollups by pid for paid order.
+
+    Discount includes discounts of products and global discount.
+    """
+    increments = {}
+
+    for line in order["products"]:
+        net = (
+            line["summ"]
+            * (1 - (line.get("discount") or 0))
+            * (1 - (order.get("global_discount") or 0))
+        )
+        inc = increments.setdefault(
+            line["pid"], {"units": 0, "gross": 0, "discount": 0}
+        )
+        inc["units"] += line["quantity"]
+        inc["gross"] += line["summ"]
+        inc["discount"] += line["summ"] - net
+
+    return increments
+
+
+class MotorStorage:
+    """
+    Storage in MongoDB accessed by Motor.
+
+    Concurrent changes of one cart or order are made with conditional updates.
+    """
+
+    async def user_cid(self, uid: str) -> str | None:
+        user = await USERS_COLLECTION.find_one({"_id": ObjectId(uid)}, {"cid": 1})
+
+        if user:
+            return user["cid"]
+
+    async def find_products(self, pids: list[str] = None) -> list[dict]:
+        """
+        Return products with that pids or all products, _id is converted to str id by database.
+        """
+        query = {} if pids is None else {"_id": {"$in": list(map(ObjectId, pids))}}
+        return await PRODUCTS_COLLECTION.aggregate(
+            [{"$match": query}] + ID_STAGES
+        ).to_list(None)
+
+    async def find_promocodes(self, codes: list[str] = None) -> list[dict]:
+        """
+        Return promocodes with that codes or all promocodes.
+        """
+        query = {} if codes is None else {"code": {"$in": codes}}
+        return await PROMOCODES_COLLECTION.find(query, {"_id": 0}).to_list(None)
+
+    async def get_cart(self, cid: str) -> dict | None:
+        return await CARTS_COLLECTION.find_one({"_id": ObjectId(cid)})
+
+    async def cart_add(
+        self, cid: str, pid: str, price: float, quantity: int, snapshot: dict = None
+    ) -> bool:
+        """
+        Add quantity of product to cart and replace snapshot of product in its line, return False if cart is not found.
+        """
+        summ = price * quantity
+        fields = {"price": price, "product": snapshot} if snapshot else {"price": price}
+
+        # Line of product may be pushed by concurrent request between two updates,
+        # so repeat both while one of them matches the cart.
+        for _ in range(CART_UPDATE_ATTEMPTS):
+            result = await CARTS_COLLECTION.update_one(
+                {"_id": ObjectId(cid), "products.pid": pid},
+                {
+                    "$set": {f"products.$.{name}": v for name, v in fields.items()},
+                    "$inc": {
+                        "products.$.quantity": quantity,
+                        "products.$.summ": summ,
+                        "total": summ,
+                    },
+                },
+            )
+
+            if result.matched_count:
+                return True
+
+            result = await CARTS_COLLECTION.update_one(
+                {"_id": ObjectId(cid), "products.pid": {"$ne": pid}},
+                {
+                    "$push": {
+                        "products": {
+                            "pid": pid,
+                            "price": price,
+                            "quantity": quantity,
+                            "summ": summ,
+                            **fields,
+                        }
+                    },
+                    "$inc": {"total": summ},
+                },
+            )
+
+            if result.matched_count:
+                return True
+
+        return False
+
+    async def refresh_cart_snapshots(self, snapshots: dict) -> int:
+        """
+        Replace snapshots of products by pid in lines of carts with other version, return number of changed lines.
+        """
+        result = await CARTS_COLLECTION.bulk_write(
+            [
+                UpdateMany(
+                    {
+                        "products": {
+                            "$elemMatch": {
+                                "pid": pid,
+                                "product.version": {"$ne": snapshot["version"]},
+                            }
+                        }
+                    },
+                    {"$set": {"products.$.product": snapshot}},
+                )
+                for pid, snapshot in snapshots.items()
+            ],
+            ordered=False,
+        )
+        return result.modified_count
+
+    async def cart_remove(self, cid: str, pid: str, price: float, quantity: int) -> str:
+        """
+        Remove quantity of product from cart, return "ok", "not in cart", "insufficient quantity" or "not changed".
+        """
+        summ = price * quantity
+
+        for _ in range(CART_UPDATE_ATTEMPTS):
+            result = await CARTS_COLLECTION.update_one(
+                {
+                    "_id": ObjectId(cid),
+                    "products": {
+                        "$elemMatch": {"pid": pid, "quantity": {"$gt": quantity}}
+                    },
+                },
+                {
+                    "$inc": {
+                        "products.$.quantity": -quantity,
+                        "products.$.summ": -summ,
+                        "total": -summ,
+                    }
+                },
+            )
+
+            if not result.matched_count:
+                result = await CARTS_COLLECTION.update_one(
+                    {
+                        "_id": ObjectId(cid),
+                        "products": {"$elemMatch": {"pid": pid, "quantity": quantity}},
+                    },
+                    {"$pull": {"products": {"pid": pid}}, "$inc": {"total": -summ}},
+                )
+
+            if result.matched_count:
+                return "ok"
+
+            cart = await CARTS_COLLECTION.find_one(
+                {"_id": ObjectId(cid)}, {"products": {"$elemMatch": {"pid": pid}}}
+            )
+
+            if not cart or not cart.get("products"):
+                return "not in cart"
+            elif cart["products"][0]["quantity"] < quantity:
+                return "insufficient quantity"
+
+        return "not changed"
+
+    async def replace_cart(
+        self, cid: str, cart: dict, products: list[dict], total: float
+    ) -> bool:
+        """
+        Replace lines and total of cart, return False if cart was changed after it was read.
+        """
+        result = await CARTS_COLLECTION.update_one(
+            {
+                "_id": ObjectId(cid),
+                "products": cart["products"],
+                "total": cart["total"],
+            },
+            {"$set": {"products": products, "total": total}},
+        )
+        return bool(result.matched_count)
+
+    async def clear_cart(self, cid: str) -> None:
+        await CARTS_COLLECTION.update_one(
+            {"_id": ObjectId(cid)}, {"$set": {"products": [], "total": 0}}
+        )
+
+    async def insert_order(self, order: dict) -> str:
+        result = await ORDER_COLLECTION.insert_one(order)
+        return str(result.inserted_id)
+
+    async def order_page(
+        self,
+        uid: str,
+        limit: int,
+        after: tuple[str, str] = None,
+        status: str = None,
+        summary: bool = False,
+    ) -> tuple:
+        """
+        Return orders of user from newest to oldest and the last returned order if there are more orders.
+        """
+        pipeline = [
+            {"$match": order_history_query(uid, status, after)},
+            {"$sort": {"date": DESCENDING, "_id": DESCENDING}},
+            {"$limit": limit + 1},
+        ]
+
+        if summary:
+            pipeline += [{"$project": ORDER_SUMMARY_PROJECTION}]
+
+        pipeline += ID_STAGES
+        raw = bool(settings.ORDERS_RAW_JSON and bsonjs)
+        archived_pipeline = pipeline
+
+        if raw and not summary:
+            archived_pipeline = pipeline + ORDER_EXPAND_STAGES
+
+        # Live orders and archive are read at the same time, pages are merged by (date, id).
+        hot, archived = await asyncio.gather(
+            self._history(ORDER_COLLECTION, pipeline, raw),
+            self._history(ARCHIVE_COLLECTION, archived_pipeline, raw),
+        )
+
+        if raw:
+            documents = merge_history(hot, archived, raw_history_key)[: limit + 1]
+            orders = raw_json_array(documents[:limit]) if documents else []
+            last = decode(documents[limit - 1]) if len(documents) > limit else None
+        else:
+            archived = [expand_order(order) for order in archived]
+            documents = merge_history(hot, archived, history_key)[: limit + 1]
+            orders = documents[:limit]
+            last = documents[limit - 1] if len(documents) > limit else None
+
+        return orders, last
+
+    async def _history(self, collection, pipeline: list, raw: bool) -> list:
+        if raw:
+            # Orders are converted to JSON directly from BSON returned by database.
+            batches = await collection.aggregate_raw_batches(
+                pipeline + ORDER_RAW_STAGES
+            ).to_list(None)
+            return raw_documents(batches)
+
+        return await collection.aggregate(pipeline).to_list(None)
+
+    async def get_order(self, oid: str, fields: list[str] = None) -> dict | None:
+        projection = dict.fromkeys(fields, 1) if fields else None
+        return await ORDER_COLLECTION.find_one({"_id": ObjectId(oid)}, projection)
+
+    async def set_order_fields(
+        self, oid: str, status: str, fields: dict, match: dict = None
+    ) -> bool:
+        """
+        Set fields of order if it has that status and values of match, return False if order is not changed.
+        """
+        order = await ORDER_COLLECTION.find_one_and_update(
+            {"_id": ObjectId(oid), "status": status, **(match or {})},
+            {"$set": fields},
+            projection={"_id": 1},
+        )
+        return order is not None
+
+    async def add_unrefunded_payment(self, oid: str, payment: dict) -> None:
+        await ORDER_COLLECTION.update_one(
+            {"_id": ObjectId(oid)}, {"$push": {"unrefunded_payments": payment}}
+        )
+
+    async def expire_orders(self, now) -> int:
+        result = await ORDER_COLLECTION.update_many(
+            {"status": "Created", "expires_at": {"$lte": now}},
+            {"$set": {"status": "Expired"}},
+        )
+        return result.modified_count
+
+    async def release_payments(self, now) -> int:
+        """
+        Return orders reserved for payment before now to status "Created", e.g. if worker was stopped during payment.
+        """
+        result = await ORDER_COLLECTION.update_many(
+            {"status": "Paying", "paying_until": {"$lte": now}},
+            {"$set": {"status": "Created"}},
+        )
+        return result.modified_count
+
+    async def archive_orders(
+        self, before: str, limit: int, compact: bool = False
+    ) -> int:
+        """
+        Move batch of orders to archive, return number of moved orders.
+
+        Order is removed from live collection only if it was not changed after copying,
+        changed order is copied again by next batch.
+        """
+        orders = (
+            await ORDER_COLLECTION.find(archive_query(before))
+            .limit(limit)
+            .to_list(None)
+        )
+
+        if not orders:
+            return 0
+
+        await ARCHIVE_COLLECTION.bulk_write(
+            [
+                ReplaceOne(
+                    {"_id": order["_id"]},
+                    compact_order(order) if compact else order,
+                    upsert=True,
+                )
+                for order in orders
+            ],
+            ordered=False,
+        )
+        result = await ORDER_COLLECTION.bulk_write(
+            [
+                DeleteOne(
+                    {
+                        "_id": order["_id"],
+                        "status": order["status"],
+                        "products": order["products"],
+                    }
+                )
+                for order in orders
+            ],
+            ordered=False,
+        )
+        return result.deleted_count
+
+    async def order_line(self, oid: str, pid: str) -> dict | None:
+        """
+        Return fields of order needed for return with only line of product in products.
+        """
+        return await ORDER_COLLECTION.find_one(
+            {"_id": ObjectId(oid)},
+            {
+                **dict.fromkeys(ORDER_RETURN_FIELDS, 1),
+                "products": {"$elemMatch": {"pid": pid}},
+            },
+        )
+
+    async def add_return(
+        self,
+        oid: str,
+        pid: str,
+        return_quantity: int,
+        quantity: int,
+        return_summ: float,
+        return_date: str,
+    ) -> bool:
+        """
+        Write return to paid order, return False if returned quantity was changed after reading.
+        """
+        returned = await ORDER_COLLECTION.find_one_and_update(
+            {
+                "_id": ObjectId(oid),
+                "status": {"$in": ["Paid", "Returned"]},
+                "products": {
+                    "$elemMatch": {
+                        "pid": pid,
+                        "return_quantity": return_quantity or {"$in": [0, None]},
+                    }
+                },
+            },
+            {
+                "$push": {"products.$.return_dates": return_date},
+                "$set": {"products.$.return_status": "Returned", "status": "Returned"},
+                "$inc": {
+                    "products.$.return_quantity": quantity,
+                    "products.$.return_summ": return_summ,
+                },
+            },
+            projection={"_id": 1},
+        )
+        return returned is not None
+
+    async def cancel_return(
+        self,
+        oid: str,
+        pid: str,
+        quantity: int,
+        return_summ: float,
+        return_date: str,
+        order_status: str,
+    ) -> None:
+        await ORDER_COLLECTION.update_one(
+            {"_id": ObjectId(oid), "products.pid": pid},
+            {
+                "$inc": {
+                    "products.$.return_quantity": -quantity,
+                    "products.$.return_summ": -return_summ,
+                },
+                "$pull": {"products.$.return_dates": return_date},
+            },
+        )
+        await ORDER_COLLECTION.update_one(
+            {
+                "_id": ObjectId(oid),
+                "products": {"$elemMatch": {"pid": pid, "return_quantity": 0}},
+            },
+            {"$set": {"products.$.return_status": None}},
+        )
+
+        if order_status == "Paid":
+            await ORDER_COLLECTION.update_one(
+                {
+                    "_id": ObjectId(oid),
+                    "products.return_quantity": {"$not": {"$gt": 0}},
+                },
+                {"$set": {"status": "Paid"}},
+            )
+
+    async def inc_rollups(self, day: str, increments: dict) -> None:
+        """
+        Increment fields of rollups of day by pid, missing rollups are created.
+        """
+        await ROLLUPS_COLLECTION.bulk_write(
+            [
+                UpdateOne({"day": day, "pid": pid}, {"$inc": inc}, upsert=True)
+                for pid, inc in increments.items()
+            ],
+            ordered=False,
+        )
+
+    async def find_rollups(self, start: str, end: str, pid: str = None) -> list[dict]:
+        """
+        Return rollups of days from start to end inclusive sorted by day and pid.
+        """
+        query = {"day": {"$gte": start, "$lte": end}}
+
+        if pid:
+            query["pid"] = pid
+
+        return (
+            await ROLLUPS_COLLECTION.find(query, {"_id": 0})
+            .sort([("day", ASCENDING), ("pid", ASCENDING)])
+            .to_list(None)
+        )
+
+    async def rebuild_rollups(self) -> int:
+        """
+        Replace all rollups with rollups aggregated from orders, return number of rollups.
+        """
+        await ROLLUPS_COLLECTION.delete_many({})
+
+        for stages in ROLLUP_STAGES:
+            await ORDER_COLLECTION.aggregate(stages + [ROLLUP_MERGE]).to_list(None)
+
+        return await ROLLUPS_COLLECTION.count_documents({})
+
+    async def claim_key(self, key: str, entry: dict) -> dict | None:
+        """
+        Claim idempotency key with entry of fingerprint, owner, response, created_at and locked_until,
+        return stored entry if key is already claimed.
+
+        Claim without response whose lease is expired, e.g. of stopped worker, is taken over.
+        """
+        try:
+            await IDEMPOTENCY_COLLECTION.insert_one({"_id": key, **entry})
+            return None
+        except DuplicateKeyError:
+            pass
+
+        taken = await IDEMPOTENCY_COLLECTION.find_one_and_update(
+            {
+                "_id": key,
+                "response": None,
+                "locked_until": {"$lte": entry["created_at"]},
+            },
+            {"$set": entry},
+            projection={"_id": 1},
+        )
+
+        if taken is None:
+            return await IDEMPOTENCY_COLLECTION.find_one({"_id": key}) or entry
+
+    async def renew_key(self, key: str, owner: str, locked_until) -> bool:
+        """
+        Extend lease of key claimed by owner, return False if key is not claimed by owner.
+        """
+        result = await IDEMPOTENCY_COLLECTION.update_one(
+            {"_id": key, "owner": owner}, {"$set": {"locked_until": locked_until}}
+        )
+        return result.matched_count == 1
+
+    async def save_key(self, key: str, owner: str, response: dict) -> bool:
+        result = await IDEMPOTENCY_COLLECTION.update_one(
+            {"_id": key, "owner": owner}, {"$set": {"response": response}}
+        )
+        return result.matched_count == 1
+
+    async def release_key(self, key: str, owner: str) -> None:
+        await IDEMPOTENCY_COLLECTION.delete_one({"_id": key, "owner": owner})
+
+
+class MemoryStorage:
+    """
+    Storage in memory of process, optionally loaded from JSON exports of collections in fixtures directory.
+
+    Documents are kept in dicts by id, orders of every user are indexed by (date, oid).
+    Every method changes data without awaiting, so changes of one cart or order are atomic
+    for the event loop. Returned documents are copies and can be changed by caller.
+    """
+
+    def __init__(self, fixtures: str = None) -> None:
+        self.users = {}
+        self.products = {}
+        self.carts = {}
+        self.orders = {}
+        self.promocodes = {}
+        self.keys = {}
+        self.history = {}
+        self.expiring = {}
+        self.paying = {}
+        self.rollups = {}
+        self.archive = {}
+
+        if fixtures:
+            self.load(fixtures)
+
+    def load(self, fixtures: str) -> None:
+        """
+        Load documents from minishop.<collection>.json files of mongoexport.
+        """
+
+        def read(name: str) -> list[dict]:
+            path = os.path.join(fixtures, f"minishop.{name}.json")
+
+            if not os.path.exists(path):
+                return []
+
+            with open(path) as f:
+                return json_util.loads(f.read())
+
+        for user in read("users"):
+            self.users[str(user["_id"])] = user
+
+        for product in read("products"):
+            pid = str(product.pop("_id"))
+            self.products[pid] = {**product, "id": pid}
+
+        for cart in read("carts"):
+            self.carts[str(cart["_id"])] = cart
+
+        for order in read("orders"):
+            self._insert_order(order)
+
+        for rule in read("promocodes"):
+            rule.pop("_id", None)
+            self.promocodes[rule["code"]] = rule
+
+    async def user_cid(self, uid: str) -> str | None:
+        user = self.users.get(uid)
+
+        if user:
+            return user["cid"]
+
+    async def find_products(self, pids: list[str] = None) -> list[dict]:
+        if pids is None:
+            return [dict(product) for product in self.products.values()]
+
+        return [
+            dict(self.products[pid])
+            for pid in dict.fromkeys(pids)
+            if pid in self.products
+        ]
+
+    async def find_promocodes(self, codes: list[str] = None) -> list[dict]:
+        if codes is None:
+            return [dict(rule) for rule in self.promocodes.values()]
+
+        return [
+            dict(self.promocodes[code]) for code in codes if code in self.promocodes
+        ]
+
+    async def get_cart(self, cid: str) -> dict | None:
+        cart = self.carts.get(cid)
+
+        if cart:
+            return {**cart, "products": [dict(line) for line in cart["products"]]}
+
+    def _line(self, cart: dict, pid: str) -> dict | None:
+        for line in cart["products"]:
+            if line["pid"] == pid:
+                return line
+
+    async def cart_add(
+        self, cid: str, pid: str, price: float, quantity: int, snapshot: dict = None
+    ) -> bool:
+        cart = self.carts.get(cid)
+
+        if not cart:
+            return False
+
+        summ = price * quantity
+        line = self._line(cart, pid)
+
+        if line:
+            line["price"] = price
+            line["quantity"] += quantity
+            line["summ"] += summ
+        else:
+            line = {"pid": pid, "price": price, "quantity": quantity, "summ": summ}
+            cart["products"].append(line)
+
+        if snapshot:
+            line["product"] = dict(snapshot)
+
+        cart["total"] += summ
+        return True
+
+    async def refresh_cart_snapshots(self, snapshots: dict) -> int:
+        changed = 0
+
+        for cart in self.carts.values():
+            for line in cart["products"]:
+                snapshot = snapshots.get(line["pid"])
+
+                if (
+                    snapshot
+                    and line.get("product", {}).get("version") != snapshot["version"]
+                ):
+                    line["product"] = dict(snapshot)
+                    changed += 1
+
+        return changed
+
+    async def cart_remove(self, cid: str, pid: str, price: float, quantity: int) -> str:
+        cart = self.carts.get(cid)
+        line = self._line(cart, pid) if cart else None
+
+        if not line:
+            return "not in cart"
+        elif line["quantity"] < quantity:
+            return "insufficient quantity"
+
+        summ = price * quantity
+
+        if line["quantity"] == quantity:
+            cart["products"].remove(line)
+        else:
+            line["quantity"] -= quantity
+            line["summ"] -= summ
+
+        cart["total"] -= summ
+        return "ok"
+
+    async def replace_cart(
+        self, cid: str, cart: dict, products: list[dict], total: float
+    ) -> bool:
+        stored = self.carts.get(cid)
+
+        if (
+            not stored
+            or stored["products"] != cart["products"]
+            or stored["total"] != cart["total"]
+        ):
+            return False
+
+        stored["products"] = [dict(line) for line in products]
+        stored["total"] = total
+        return True
+
+    async def clear_cart(self, cid: str) -> None:
+        cart = self.carts.get(cid)
+
+        if cart:
+            cart["products"] = []
+            cart["total"] = 0
+
+    def _insert_order(self, order: dict) -> str:
+        order.setdefault("_id", ObjectId())
+        oid = str(order["_id"])
+        self.orders[oid] = order
+        bisect.insort(self.history.setdefault(order["uid"], []), (order["date"], oid))
+
+        self._track_status(oid, order)
+        return oid
+
+    def _track_status(self, oid: str, order: dict) -> None:
+        self.expiring.pop(oid, None)
+        self.paying.pop(oid, None)
+
+        if order["status"] == "Created" and order.get("expires_at"):
+            self.expiring[oid] = order["expires_at"]
+        elif order["status"] == "Paying":
+            self.paying[oid] = order["paying_until"]
+
+    async def insert_order(self, order: dict) -> str:
+        order["_id"] = ObjectId()
+        return self._insert_order(copy.deepcopy(order))
+
+    async def order_page(
+        self,
+        uid: str,
+        limit: int,
+        after: tuple[str, str] = None,
+        status: str = None,
+        summary: bool = False,
+    ) -> tuple:
+        keys = self.history.get(uid, [])
+        end = bisect.bisect_left(keys, after) if after else len(keys)
+        documents = []
+
+        for key in reversed(keys[:end]):
+            order = self.orders.get(key[1]) or self.archive[key[1]]
+
+            if status and order["status"] != status:
+                continue
+
+            document = {
+                name: value
+                for name, value in order.items()
+                if name != "_id" and not (summary and name == "products")
+            }
+            document["id"] = key[1]
+            documents += [expand_order(copy.deepcopy(document))]
+
+            if len(documents) > limit:
+                break
+
+        last = documents[limit - 1] if len(documents) > limit else None
+        return documents[:limit], last
+
+    async def get_order(self, oid: str, fields: list[str] = None) -> dict | None:
+        order = self.orders.get(oid)
+
+        if order is None:
+            return None
+        elif fields:
+            order = {name: order[name] for name in ["_id", *fields] if name in order}
+
+        return copy.deepcopy(order)
+
+    async def set_order_fields(
+        self, oid: str, status: str, fields: dict, match: dict = None
+    ) -> bool:
+        order = self.orders.get(oid)
+
+        if not order or order["status"] != status:
+            return False
+        elif any(order.get(name) != value for name, value in (match or {}).items()):
+            return False
+
+        order.update(copy.deepcopy(fields))
+        self._track_status(oid, order)
+        return True
+
+    async def add_unrefunded_payment(self, oid: str, payment: dict) -> None:
+        order = self.orders.get(oid)
+
+        if order:
+            order.setdefault("unrefunded_payments", []).append(dict(payment))
+
+    async def expire_orders(self, now) -> int:
+        expired = [oid for oid, date in self.expiring.items() if date <= now]
+
+        for oid in expired:
+            self.orders[oid]["status"] = "Expired"
+            del self.expiring[oid]
+
+        return len(expired)
+
+    async def release_payments(self, now) -> int:
+        released = [oid for oid, date in self.paying.items() if date <= now]
+
+        for oid in released:
+            self.orders[oid]["status"] = "Created"
+            self._track_status(oid, self.orders[oid])
+
+        return len(released)
+
+    async def archive_orders(
+        self, before: str, limit: int, compact: bool = False
+    ) -> int:
+        archived = (
+            oid for oid, order in self.orders.items() if is_archived(order, before)
+        )
+        oids = list(itertools.islice(archived, limit))
+
+        for oid in oids:
+            order = self.orders.pop(oid)
+            self.expiring.pop(oid, None)
+            self.paying.pop(oid, None)
+            self.archive[oid] = compact_order(order) if compact else order
+
+        return len(oids)
+
+    async def order_line(self, oid: str, pid: str) -> dict | None:
+        order = await self.get_order(oid, ORDER_RETURN_FIELDS + ["products"])
+
+        if order:
+            order["products"] = [
+                line for line in order["products"] if line["pid"] == pid
+            ][:1]
+
+        return order
+
+    async def add_return(
+        self,
+        oid: str,
+        pid: str,
+        return_quantity: int,
+        quantity: int,
+        return_summ: float,
+        return_date: str,
+    ) -> bool:
+        order = self.orders.get(oid)
+
+        if not order or order["status"] not in ("Paid", "Returned"):
+            return False
+
+        line = self._line(order, pid)
+
+        if not line or (line.get("return_quantity") or 0) != (return_quantity or 0):
+            return False
+
+        line.setdefault("return_dates", []).append(return_date)
+        line["return_status"] = "Returned"
+        line["return_quantity"] = (return_quantity or 0) + quantity
+        line["return_summ"] = line.get("return_summ", 0) + return_summ
+        order["status"] = "Returned"
+        return True
+
+    async def cancel_return(
+        self,
+        oid: str,
+        pid: str,
+        quantity: int,
+        return_summ: float,
+        return_date: str,
+        order_status: str,
+    ) -> None:
+        order = self.orders.get(oid)
+        line = self._line(order, pid) if order else None
+
+        if not line:
+            return
+
+        line["return_quantity"] -= quantity
+        line["return_summ"] -= return_summ
+
+        if return_date in line["return_dates"]:
+            line["return_dates"].remove(return_date)
+
+        if line["return_quantity"] == 0:
+            line["return_status"] = None
+
+        if order_status == "Paid" and not any(
+            (line.get("return_quantity") or 0) > 0 for line in order["products"]
+        ):
+            order["status"] = "Paid"
+
+    async def inc_rollups(self, day: str, increments: dict) -> None:
+        for pid, inc in increments.items():
+            rollup = self.rollups.setdefault((day, pid), {"day": day, "pid": pid})
+
+            for name, value in inc.items():
+                rollup[name] = rollup.get(name, 0) + value
+
+    async def find_rollups(self, start: str, end: str, pid: str = None) -> list[dict]:
+        return [
+            dict(self.rollups[key])
+            for key in sorted(self.rollups)
+            if start <= key[0] <= end and (not pid or key[1] == pid)
+        ]
+
+    async def rebuild_rollups(self) -> int:
+        self.rollups = {}
+
+        for order in [*self.orders.values(), *self.archive.values()]:
+            if order["status"] not in ("Paid", "Returned") or not order.get("pay_date"):
+                continue
+
+            await self.inc_rollups(order["pay_date"][:10], sale_increments(order))
+
+            for line in order["products"]:
+                if (line.get("return_quantity") or 0) > 0:
+                    await self.inc_rollups(
+                        line["return_dates"][-1][:10],
+                        {
+                            line["pid"]: {
+                                "returned_units": line["return_quantity"],
+                                "refunds": line["return_summ"],
+                            }
+                        },
+                    )
+
+        return len(self.rollups)
+
+    async def claim_key(self, key: str, entry: dict) -> dict | None:
+        stored = self.keys.get(key)
+        age = stored and (entry["created_at"] - stored["created_at"]).total_seconds()
+
+        if stored and age < settings.IDEMPOTENCY_TTL:
+            if (
+                stored["response"] is not None
+                or stored["locked_until"] > entry["created_at"]
+            ):
+                return dict(stored)
+
+        self.keys[key] = dict(entry)
+
+    async def renew_key(self, key: str, owner: str, locked_until) -> bool:
+        stored = self.keys.get(key)
+
+        if not stored or stored["owner"] != owner:
+            return False
+
+        stored["locked_until"] = locked_until
+        return True
+
+    async def save_key(self, key: str, owner: str, response: dict) -> bool:
+        stored = self.keys.get(key)
+
+        if not stored or stored["owner"] != owner:
+            return False
+
+        stored["response"] = response
+        return True
+
+    async def release_key(self, key: str, owner: str) -> None:
+        if self.keys.get(key, {}).get("owner") == owner:
+            del self.keys[key]
+
+
+def create_storage(engine: str):
+    """
+    Return storage of that engine, "motor" or "memory".
+    """
+    if engine == "motor":
+        return MotorStorage()
+    elif engine == "memory":
+        return MemoryStorage(settings.STORAGE_FIXTURES)
+
+    raise ValueError(f"Unknown storage engine {engine}")
+
+
+STORAGE = create_storage(settings.STORAGE)
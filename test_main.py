@@ -1,5 +1,36 @@
+import asyncio
+import time
+from datetime import timedelta
+from uuid import uuid4
+import orjson
+from bson import ObjectId, encode
+import httpx
 from httpx import ASGITransport, AsyncClient
+from admission import AdmissionController, AdmissionMiddleware
+from cache import (
+    CATALOG,
+    USER_CIDS,
+    LRUCache,
+    ProductCatalog,
+    ProductLoader,
+    product_snapshot,
+)
+from database import PROMOCODES_COLLECTION
+from indexes import ensure_indexes
+from loader import Generator
+from loop_watchdog import LoopWatchdog
 from main import app
+from payments import CircuitBreaker, PaymentClient, PaymentError
+from promocodes import PromocodeEngine, apply_discounts
+from scheduler import archive_orders, expire_orders, reconcile_carts, utcnow
+from serializers import FastJSONResponse, raw_documents
+from settings import settings
+from snapshot import Snapshot, write_snapshot
+from storage import STORAGE, MemoryStorage
+import admission
+import idempotency
+import payments
+import scheduler
 import pytest
 
 exist_pid = "6707956239445e8693a16362"
@@ -7,7 +38,10 @@ not_exist_pid = "6707956239475e8693a16362"
 bad_pid = "6707956239445e8693z16362"
 not_return_pid = "6707956239445e8693a16363"
 
+concurrent_pid = "6707956239445e8693a16364"
+
 exist_uid = "671210a24c0b7d4a8caa715a"
+extra_uid = "671210b74c0b7d4a8caa715b"
 not_exist_uid = "671210a24c0b8d4a8caa715a"
 bad_uid = "671210a24c0b7d4a8caa715z"
 
@@ -27,11 +61,31 @@ def anyio_backend():
 
 @pytest.fixture(scope="session")
 async def client():
+    # Lifespan is not run by transport, watchdog is started here in debug mode,
+    # so blocking calls in handlers are logged with their stacks.
+    watchdog = app.state.watchdog = LoopWatchdog(
+        settings.LOOP_LAG_INTERVAL, settings.LOOP_LAG_THRESHOLD, debug=True
+    )
+    watchdog.start()
+
     async with AsyncClient(
         transport=ASGITransport(app=app), base_url="http://test"
     ) as client:
         yield client
 
+    await watchdog.stop()
+    app.state.watchdog = None
+
+
+@pytest.mark.anyio
+@pytest.mark.skipif(
+    settings.STORAGE != "motor", reason="indexes are created in MongoDB"
+)
+async def test_ensure_indexes():
+    await ensure_indexes()
+    index = (await PROMOCODES_COLLECTION.index_information())["promocodes_code"]
+    assert index["unique"]
+
 
 # Products
 @pytest.mark.anyio
@@ -52,6 +106,232 @@ async def test_get_non_exist_product(client):
     assert "error" in response.json()
 
 
+@pytest.mark.anyio
+async def test_catalog_cache(client):
+    CATALOG.invalidate()
+    misses = CATALOG.stats()["misses"]
+    await client.get(f"/products/{exist_pid}/")
+    hits = CATALOG.stats()["hits"]
+    response = await client.get(f"/products/{exist_pid}/")
+    assert "error" not in response.json()
+    assert CATALOG.stats()["misses"] == misses + 1
+    assert CATALOG.stats()["hits"] == hits + 1
+
+
+@pytest.mark.anyio
+async def test_product_loader(client):
+    CATALOG.invalidate()
+    products = await ProductLoader().load_many(
+        [exist_pid, not_return_pid, exist_pid, not_exist_pid]
+    )
+    assert [p["id"] if p else None for p in products] == [
+        exist_pid,
+        not_return_pid,
+        exist_pid,
+        None,
+    ]
+
+
+@pytest.mark.anyio
+async def test_catalog_snapshot(tmp_path):
+    path = str(tmp_path / "catalog.snapshot")
+    product = {"name": "Snapshot", "color": "red", "price": 1.0, "id": not_exist_pid}
+    rule = {"code": "SNAPSHOT", "pid": not_exist_pid, "discount": 0.5}
+    write_snapshot(path, 1, [product], [rule])
+    snapshot = Snapshot(path, check_interval=0)
+    catalog = ProductCatalog(10, 60, snapshot)
+    assert await catalog.get(not_exist_pid) == product
+    assert orjson.loads(await catalog.all_json()) == [product]
+    assert (await PromocodeEngine(60, snapshot=snapshot).resolve(["SNAPSHOT"]))[0] == [
+        rule
+    ]
+
+    write_snapshot(path, 2, [], [])
+    assert await catalog.all_json() == b"[]"
+    assert snapshot.version == 2
+
+
+@pytest.mark.anyio
+async def test_memory_storage():
+    storage = MemoryStorage("json")
+    cid = await storage.user_cid(extra_uid)
+    assert await storage.cart_add(cid, concurrent_pid, 10, 2)
+    assert await storage.cart_remove(cid, concurrent_pid, 10, 3) == (
+        "insufficient quantity"
+    )
+    assert await storage.cart_remove(cid, concurrent_pid, 10, 2) == "ok"
+    assert await storage.cart_remove(cid, concurrent_pid, 10, 1) == "not in cart"
+
+    for date in ["2024-01-01", "2024-01-02", "2024-01-02"]:
+        await storage.insert_order(
+            {"uid": extra_uid, "date": date, "status": "Created", "products": []}
+        )
+
+    orders, last = await storage.order_page(extra_uid, 2, summary=True)
+    assert [order["date"] for order in orders] == ["2024-01-02", "2024-01-02"]
+    assert "products" not in orders[0]
+    orders, last = await storage.order_page(extra_uid, 2, (last["date"], last["id"]))
+    assert [order["date"] for order in orders] == ["2024-01-01"] and last is None
+
+
+@pytest.mark.anyio
+async def test_cart_snapshots(monkeypatch):
+    storage = MemoryStorage("json")
+    cid = await storage.user_cid(extra_uid)
+    product = (await storage.find_products([concurrent_pid]))[0]
+    snapshot = product_snapshot(product)
+    assert await storage.cart_add(cid, concurrent_pid, product["price"], 1, snapshot)
+    assert await storage.refresh_cart_snapshots({concurrent_pid: snapshot}) == 0
+
+    changed = product_snapshot({**product, "price": product["price"] + 1})
+    assert changed["version"] != snapshot["version"]
+    assert await storage.refresh_cart_snapshots({concurrent_pid: changed}) == 1
+    cart = await storage.get_cart(cid)
+    lines = [line for line in cart["products"] if line["pid"] == concurrent_pid]
+    assert lines[0]["product"] == changed
+
+    monkeypatch.setattr(scheduler, "STORAGE", storage)
+    versions = {}
+    assert await reconcile_carts(versions) >= 1
+    # Line added with stale snapshot from cache after reconciliation.
+    assert await storage.refresh_cart_snapshots({concurrent_pid: changed}) == 1
+    assert await reconcile_carts(versions) == 0
+    assert await reconcile_carts(versions, full=True) == 1
+
+
+@pytest.mark.anyio
+async def test_rollups_backfill():
+    storage = MemoryStorage("json")
+    assert await storage.rebuild_rollups()
+    rollups = await storage.find_rollups("2024-11-08", "2024-11-08", exist_pid)
+    assert rollups[0]["units"] >= rollups[0]["returned_units"] > 0
+    assert rollups[0]["gross"] > rollups[0]["discount"] > 0
+
+
+def test_synthetic_orders():
+    generator = Generator(100, 50, 10, 30, 1.1, False, seed=1)
+    orders = list(generator.order_documents(1000))
+    pids = [line["pid"] for order in orders for line in order["products"]]
+    most_popular = str(generator.catalog[0]["_id"])
+    assert pids.count(most_popular) > len(pids) / 50
+    assert all(
+        order["total_with_discount"] <= sum(line["summ"] for line in order["products"])
+        for order in orders
+    )
+
+    generator = Generator(10, 0, 0, 30, 1.1, False, seed=1)
+    assert all(not cart["products"] for cart in generator.cart_documents())
+
+
+@pytest.mark.anyio
+async def test_health(client):
+    response = await client.get("/healthz")
+    assert response.status_code == 200
+    assert "saturation" in response.json()["pool"]
+
+    response = await client.get("/readyz")
+    assert response.status_code == 503
+    app.state.ready = True
+    response = await client.get("/readyz")
+    app.state.ready = False
+    assert response.json()["status"] == "ready"
+
+
+@pytest.mark.anyio
+async def test_metrics(client, monkeypatch):
+    monkeypatch.setattr(settings, "SERVER_TIMING", True)
+    response = await client.get(f"/cart/{exist_uid}/")
+    assert response.headers["server-timing"].startswith("db;dur=")
+
+    response = await client.get("/metrics")
+    assert 'route="/cart/{uid}/"' in response.text
+    assert "minishop_db_operations_per_request_count" in response.text
+
+
+@pytest.mark.anyio
+async def test_profiling(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "PROFILE_TOKEN", "secret")
+    monkeypatch.setattr(settings, "PROFILE_DIR", str(tmp_path))
+    headers = {"X-Profile-Token": "secret"}
+    await client.get(f"/products/{exist_pid}/")
+    await client.get(f"/products/{exist_pid}/", headers=headers)
+    response = await client.get("/admin/profiles/", headers=headers)
+    profiles = response.json()
+    assert len(profiles) == 1 and "products_pid" in profiles[0]["name"]
+
+    response = await client.get(
+        f"/admin/profiles/{profiles[0]['speedscope']}", headers=headers
+    )
+    assert response.json()["$schema"].startswith("https://www.speedscope.app")
+
+    response = await client.get("/admin/profiles/")
+    assert response.status_code == 403
+
+
+@pytest.mark.anyio
+async def test_admission_priority(monkeypatch):
+    monkeypatch.setattr(settings, "ADMISSION_MAX_IN_FLIGHT", 1)
+    monkeypatch.setattr(settings, "ADMISSION_QUEUE_SIZE", 1)
+    controller = AdmissionController()
+    assert await controller.acquire(admission.CHECKOUT)
+
+    catalog = asyncio.create_task(controller.acquire(admission.CATALOG))
+    await asyncio.sleep(0)
+    checkout = asyncio.create_task(controller.acquire(admission.CHECKOUT))
+    await asyncio.sleep(0)
+    assert not await controller.acquire(admission.CART)
+    assert not await catalog
+
+    controller.release()
+    assert await checkout
+    assert controller.rejected == {("queue_full", "cart"): 1, ("evicted", "catalog"): 1}
+
+
+@pytest.mark.anyio
+async def test_admission_user_rate(monkeypatch):
+    monkeypatch.setattr(settings, "ADMISSION_USER_RATE", 0.5)
+    monkeypatch.setattr(settings, "ADMISSION_USER_BURST", 2)
+    transport = ASGITransport(app=AdmissionMiddleware(app, AdmissionController()))
+
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        body = {"uid": extra_uid, "pid": exist_pid, "quantity": 1}
+        responses = [await client.post("/cart/add/", json=body) for _ in range(3)]
+        products = await client.get(f"/products/{exist_pid}/")
+
+    assert [response.status_code for response in responses] == [200, 200, 429]
+    assert "error" not in responses[0].json()
+    assert responses[2].headers["retry-after"] == "2"
+    assert products.status_code == 200
+
+
+@pytest.mark.anyio
+async def test_loop_watchdog():
+    async def blocking_handler():
+        time.sleep(0.3)
+
+    watchdog = LoopWatchdog(interval=0.01, threshold=0.05, debug=True)
+    watchdog.start()
+    await asyncio.sleep(0.05)
+    await blocking_handler()
+    await asyncio.sleep(0.05)
+    await watchdog.stop()
+
+    assert watchdog.stalls >= 1
+    assert any("blocking_handler" in stack for stack in watchdog.dumps)
+
+
+def test_raw_documents():
+    documents = [{"id": str(i), "total": i * 1.5} for i in range(3)]
+    batches = [encode(documents[0]) + encode(documents[1]), encode(documents[2])]
+    assert raw_documents(batches) == [encode(document) for document in documents]
+
+
+def test_fast_json_response():
+    oid = ObjectId()
+    response = FastJSONResponse({"id": oid, "orders": orjson.Fragment(b"[1,2]")})
+    assert orjson.loads(response.body) == {"id": str(oid), "orders": [1, 2]}
+
+
 @pytest.mark.anyio
 async def test_get_product_bad_pid(client):
     response = await client.get(f"/products/{bad_pid}/")
@@ -71,6 +351,31 @@ async def test_get_not_exist_uid(client):
     assert "error" in response.json()
 
 
+@pytest.mark.anyio
+async def test_user_cid_cache(client):
+    USER_CIDS.invalidate()
+    hits = USER_CIDS.stats()["hits"]
+    await client.get(f"/cart/{exist_uid}/")
+    await client.get(f"/cart/{exist_uid}/")
+    assert USER_CIDS.stats()["hits"] == hits + 1
+    assert USER_CIDS.stats()["size"] == 1
+
+
+@pytest.mark.anyio
+async def test_cache_collapses_concurrent_loads():
+    loads = []
+
+    async def load(key):
+        loads.append(key)
+        await asyncio.sleep(0.01)
+        return key.upper()
+
+    cache = LRUCache(max_size=2, ttl=60)
+    result = await asyncio.gather(*[cache.get_or_load("a", load) for _ in range(10)])
+    assert result == ["A"] * 10
+    assert loads == ["a"]
+
+
 @pytest.mark.anyio
 async def test_get_cart_bad_uid(client):
     response = await client.get(f"/cart/{bad_uid}/")
@@ -86,6 +391,59 @@ async def test_add_cart(client):
     assert "error" not in response.json()
 
 
+@pytest.mark.anyio
+async def test_add_cart_concurrent(client):
+    def cart_line(cart):
+        lines = [p for p in cart["products"] if p["id"] == concurrent_pid]
+        return lines[0]["quantity"] if lines else 0
+
+    requests_count = 300
+    price = (await client.get(f"/products/{concurrent_pid}/")).json()["price"]
+    before = (await client.get(f"/cart/{extra_uid}/")).json()
+    responses = await asyncio.gather(
+        *[
+            client.post(
+                "/cart/add/",
+                json={"uid": extra_uid, "pid": concurrent_pid, "quantity": 1},
+            )
+            for _ in range(requests_count)
+        ]
+    )
+    after = (await client.get(f"/cart/{extra_uid}/")).json()
+
+    assert all("error" not in response.json() for response in responses)
+    assert cart_line(after) == cart_line(before) + requests_count
+    assert after["total"] == before["total"] + price * requests_count
+
+
+@pytest.mark.anyio
+async def test_bulk_cart(client):
+    before = (await client.get(f"/cart/{extra_uid}/")).json()
+    price = (await client.get(f"/products/{not_return_pid}/")).json()["price"]
+    response = await client.post(
+        "/cart/bulk/",
+        json={
+            "uid": extra_uid,
+            "add": [
+                {"pid": not_return_pid, "quantity": 2},
+                {"pid": not_exist_pid, "quantity": 1},
+            ],
+            "remove": [
+                {"pid": not_return_pid, "quantity": 1},
+                {"pid": not_return_pid, "quantity": 100},
+            ],
+        },
+    )
+    after = (await client.get(f"/cart/{extra_uid}/")).json()
+
+    assert [line["status"] for line in response.json()["add"]] == ["ok", "not found"]
+    assert [line["status"] for line in response.json()["remove"]] == [
+        "ok",
+        "insufficient quantity",
+    ]
+    assert after["total"] == before["total"] + price
+
+
 @pytest.mark.anyio
 async def test_del_cart_more_quantity(client):
     response = await client.delete(f"/cart/remove/{exist_uid}/{exist_pid}/{100}/")
@@ -105,6 +463,40 @@ async def test_get_orders(client):
     assert "error" not in response.json()
 
 
+@pytest.mark.anyio
+async def test_get_orders_pages(client):
+    first = (await client.get(f"/order/{exist_uid}/", params={"limit": 1})).json()
+    second = (
+        await client.get(
+            f"/order/{exist_uid}/",
+            params={"limit": 1, "cursor": first["next_cursor"]},
+        )
+    ).json()
+
+    assert len(first["orders"]) == 1
+    assert first["next_cursor"]
+    assert second["orders"][0]["id"] != first["orders"][0]["id"]
+    assert second["orders"][0]["date"] <= first["orders"][0]["date"]
+
+
+@pytest.mark.anyio
+async def test_get_orders_summary_status(client):
+    response = await client.get(
+        f"/order/{exist_uid}/", params={"summary": True, "status": "Expired"}
+    )
+    orders = response.json()["orders"]
+
+    assert orders
+    assert all(order["status"] == "Expired" for order in orders)
+    assert all("products" not in order for order in orders)
+
+
+@pytest.mark.anyio
+async def test_get_orders_bad_cursor(client):
+    response = await client.get(f"/order/{exist_uid}/", params={"cursor": "bad"})
+    assert "error" in response.json()
+
+
 @pytest.mark.anyio
 async def test_get_orders_not_exist_uid(client):
     response = await client.get(f"/order/{not_exist_uid}/")
@@ -128,6 +520,109 @@ async def test_create_order(client):
     new_oid = response.json()["status"].split()[1]
 
 
+def test_apply_discounts():
+    engine = PromocodeEngine(ttl=60)
+    engine.load(
+        [
+            {"code": "P10", "pid": exist_pid, "discount": 0.1},
+            {"code": "G20", "pid": "Global", "discount": 0.2},
+        ]
+    )
+    order = {
+        "total": 300,
+        "products": [
+            {"pid": exist_pid, "summ": 100},
+            {"pid": not_return_pid, "summ": 200},
+        ],
+    }
+    apply_discounts(order, [engine.codes["P10"], engine.codes["G20"]])
+
+    assert order["products"][0]["discount_summ"] == 10
+    assert "discount" not in order["products"][1]
+    assert order["total"] == 290
+    assert order["total_with_discount"] == 290 * 0.8
+    assert engine.rules_for(exist_pid) == [engine.codes["P10"], engine.codes["G20"]]
+
+
+@pytest.mark.anyio
+async def test_create_order_bad_promocode(client):
+    await client.post(
+        "/cart/add/", json={"uid": exist_uid, "pid": exist_pid, "quantity": 1}
+    )
+    response = await client.post(
+        "/order/create/",
+        json={"uid": exist_uid, "promocodes": ["NOT_EXIST"], "pay_timeout": 0},
+    )
+    assert response.json() == {"error": "Promocode NOT_EXIST not found"}
+
+
+@pytest.mark.anyio
+async def test_create_order_idempotency_key(client):
+    await client.post(
+        "/cart/add/", json={"uid": exist_uid, "pid": exist_pid, "quantity": 1}
+    )
+    data = {"uid": exist_uid, "promocodes": [], "pay_timeout": 0}
+    headers = {"Idempotency-Key": uuid4().hex}
+    responses = await asyncio.gather(
+        *[client.post("/order/create/", json=data, headers=headers) for _ in range(5)]
+    )
+    replay = await client.post("/order/create/", json=data, headers=headers)
+    other = await client.post(
+        "/order/create/", json={**data, "promocodes": ["MINISHOP10"]}, headers=headers
+    )
+    oid = replay.json()["status"].split()[1]
+
+    assert all(response.json() == replay.json() for response in responses)
+    assert "error" in other.json()
+
+    pay_headers = {"Idempotency-Key": uuid4().hex}
+    pay_data = {"oid": oid, "pay_system": "VISA"}
+    first = await client.post("/order/pay/", json=pay_data, headers=pay_headers)
+    second = await client.post("/order/pay/", json=pay_data, headers=pay_headers)
+    assert first.json() == second.json() == {"status": f"Order {oid} is paid."}
+
+
+@pytest.mark.anyio
+async def test_idempotency_lease_renewal(monkeypatch):
+    calls = []
+
+    async def slow_handler():
+        calls.append(1)
+        await asyncio.sleep(0.5)
+        return {"status": "ok"}
+
+    monkeypatch.setattr(settings, "IDEMPOTENCY_LEASE", 0.1)
+    monkeypatch.setattr(settings, "IDEMPOTENCY_WAIT", 0.05)
+    key = f"test:{uuid4().hex}"
+    first = asyncio.create_task(idempotency.execute(key, "", slow_handler))
+    await asyncio.sleep(0.25)
+    second = await idempotency.execute(key, "", slow_handler)
+
+    assert "in progress" in second["response"]["error"]
+    assert (await first)["response"] == {"status": "ok"}
+    assert len(calls) == 1
+
+
+@pytest.mark.anyio
+async def test_idempotency_expired_lease(monkeypatch):
+    async def handler():
+        return {"status": "ok"}
+
+    key = uuid4().hex
+    now = utcnow()
+    stopped_claim = {
+        "fingerprint": idempotency.fingerprint({}),
+        "owner": "stopped worker",
+        "response": None,
+        "created_at": now - timedelta(seconds=120),
+        "locked_until": now - timedelta(seconds=60),
+    }
+    await STORAGE.claim_key(f"test:{key}", stopped_claim)
+    monkeypatch.setattr(settings, "IDEMPOTENCY_WAIT", 0.1)
+
+    assert await idempotency.run(key, "test", {}, handler) == {"status": "ok"}
+
+
 @pytest.mark.anyio
 async def test_pay_order(client):
     response = await client.post(
@@ -136,6 +631,89 @@ async def test_pay_order(client):
     assert "error" not in response.json()
 
 
+class FlakyGateway:
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    async def send_payment(self, oid, pay_summ, pay_system):
+        self.calls += 1
+
+        if self.calls <= self.failures:
+            raise ConnectionError("Payment system is not available")
+
+        return {"pay_status": "Successful"}
+
+
+@pytest.mark.anyio
+async def test_payment_client_retries():
+    gateway = FlakyGateway(failures=2)
+    payment_client = PaymentClient(gateway, 1, 1, 2, 0, CircuitBreaker(5, 30))
+    result = await payment_client.send_payment(new_oid, 100, "VISA")
+
+    assert result["pay_status"] == "Successful"
+    assert gateway.calls == 3
+
+
+@pytest.mark.anyio
+async def test_payment_client_circuit_breaker():
+    gateway = FlakyGateway(failures=100)
+    payment_client = PaymentClient(gateway, 1, 1, 0, 0, CircuitBreaker(2, 30))
+
+    for _ in range(3):
+        with pytest.raises(PaymentError):
+            await payment_client.send_payment(new_oid, 100, "VISA")
+
+    assert gateway.calls == 2
+    assert payment_client.breaker.state == "open"
+
+
+class StatusGateway:
+    def __init__(self, errors):
+        self.errors = errors
+
+    async def send_payment(self, oid, pay_summ, pay_system):
+        if self.errors:
+            request = httpx.Request("POST", "http://pay.test/payments/")
+            response = httpx.Response(self.errors.pop(0), request=request)
+            response.raise_for_status()
+
+        return {"pay_status": "Successful"}
+
+
+@pytest.mark.anyio
+async def test_payment_client_breaker_trial():
+    gateway = StatusGateway([500, 500])
+    payment_client = PaymentClient(gateway, 1, 1, 0, 0, CircuitBreaker(1, 0))
+
+    for _ in range(2):
+        with pytest.raises(PaymentError):
+            await payment_client.send_payment(new_oid, 100, "VISA")
+
+    result = await payment_client.send_payment(new_oid, 100, "VISA")
+    assert result["pay_status"] == "Successful"
+    assert payment_client.breaker.state == "closed"
+
+
+@pytest.mark.anyio
+async def test_payment_client_cancelled():
+    class HangingGateway:
+        async def send_payment(self, oid, pay_summ, pay_system):
+            await asyncio.sleep(10)
+
+    breaker = CircuitBreaker(1, 0)
+    breaker.failure()
+    payment_client = PaymentClient(HangingGateway(), 1, 1, 0, 0, breaker)
+    task = asyncio.create_task(payment_client.send_payment(new_oid, 100, "VISA"))
+    await asyncio.sleep(0.01)
+    task.cancel()
+
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert breaker.failures == 1 and not breaker.trial
+
+
 @pytest.mark.anyio
 async def test_pay_expired_order(client):
     response = await client.post(
@@ -144,6 +722,95 @@ async def test_pay_expired_order(client):
     assert "error" in response.json()
 
 
+@pytest.mark.anyio
+async def test_pay_order_after_timeout(client):
+    await client.post(
+        "/cart/add/", json={"uid": exist_uid, "pid": exist_pid, "quantity": 1}
+    )
+    response = await client.post(
+        "/order/create/",
+        json={"uid": exist_uid, "promocodes": [], "pay_timeout": 60},
+    )
+    oid = response.json()["status"].split()[1]
+
+    assert await expire_orders(utcnow() + timedelta(seconds=61)) >= 1
+    response = await client.post("/order/pay/", json={"oid": oid, "pay_system": "VISA"})
+    assert response.json() == {"error": f"Order {oid} expired."}
+
+
+class SlowGateway:
+    def __init__(self):
+        self.calls = 0
+
+    async def send_payment(self, oid, pay_summ, pay_system):
+        self.calls += 1
+        await asyncio.sleep(0.05)
+        return {
+            "pay_id": uuid4().hex,
+            "pay_date": "2024-11-01",
+            "pay_status": "Successful",
+        }
+
+
+@pytest.mark.anyio
+async def test_pay_order_concurrent(client, monkeypatch):
+    gateway = SlowGateway()
+    payment_client = PaymentClient(gateway, 10, 1, 0, 0, CircuitBreaker(5, 30))
+    monkeypatch.setattr(payments, "get_client", lambda: payment_client)
+    await client.post(
+        "/cart/add/", json={"uid": exist_uid, "pid": exist_pid, "quantity": 1}
+    )
+    response = await client.post(
+        "/order/create/",
+        json={"uid": exist_uid, "promocodes": [], "pay_timeout": 60},
+    )
+    oid = response.json()["status"].split()[1]
+    pay_data = {"oid": oid, "pay_system": "VISA"}
+    responses = await asyncio.gather(
+        *[client.post("/order/pay/", json=pay_data) for _ in range(2)]
+    )
+
+    assert gateway.calls == 1
+    assert sorted("error" in response.json() for response in responses) == [
+        False,
+        True,
+    ]
+
+    await STORAGE.set_order_fields(
+        oid, "Paid", {"status": "Paying", "paying_until": utcnow()}
+    )
+    await expire_orders(utcnow() + timedelta(seconds=61))
+    assert (await STORAGE.get_order(oid, ["status"]))["status"] == "Expired"
+
+
+@pytest.mark.anyio
+async def test_pay_order_lost_reservation(client, monkeypatch):
+    class LosingGateway(SlowGateway):
+        async def send_payment(self, oid, pay_summ, pay_system):
+            await STORAGE.set_order_fields(oid, "Paying", {"paying_id": "other"})
+            return await super().send_payment(oid, pay_summ, pay_system)
+
+        async def return_payment(self, pay_id, pay_summ, pay_system, return_id):
+            raise ConnectionError("Payment system is not available")
+
+    payment_client = PaymentClient(LosingGateway(), 10, 1, 0, 0, CircuitBreaker(5, 30))
+    monkeypatch.setattr(payments, "get_client", lambda: payment_client)
+    await client.post(
+        "/cart/add/", json={"uid": exist_uid, "pid": exist_pid, "quantity": 1}
+    )
+    response = await client.post(
+        "/order/create/",
+        json={"uid": exist_uid, "promocodes": [], "pay_timeout": 60},
+    )
+    oid = response.json()["status"].split()[1]
+    response = await client.post("/order/pay/", json={"oid": oid, "pay_system": "VISA"})
+    order = await STORAGE.get_order(oid, ["status", "paying_id", "unrefunded_payments"])
+
+    assert response.json() == {"error": f"Order {oid} not paid."}
+    assert order["status"] == "Paying" and order["paying_id"] == "other"
+    assert len(order["unrefunded_payments"]) == 1
+
+
 # Returns
 @pytest.mark.anyio
 async def test_order_return_expired(client):
@@ -169,6 +836,54 @@ async def test_order_return(client):
     assert "error" not in response.json()
 
 
+@pytest.mark.anyio
+async def test_order_return_concurrent(client):
+    await client.post(
+        "/cart/add/", json={"uid": exist_uid, "pid": exist_pid, "quantity": 2}
+    )
+    response = await client.post(
+        "/order/create/",
+        json={"uid": exist_uid, "promocodes": [], "pay_timeout": 0},
+    )
+    oid = response.json()["status"].split()[1]
+    await client.post("/order/pay/", json={"oid": oid, "pay_system": "VISA"})
+    responses = await asyncio.gather(
+        *[
+            client.post(f"/order/{oid}/return/", json={"pid": exist_pid, "quantity": 1})
+            for _ in range(5)
+        ]
+    )
+
+    assert sum("error" not in response.json() for response in responses) == 2
+
+
+@pytest.mark.anyio
+async def test_analytics(client):
+    response = await client.get("/analytics/products/")
+    before = {row["pid"]: row for row in response.json()}.get(exist_pid)
+    before = before or {"units": 0, "returned_units": 0}
+    await client.post(
+        "/cart/add/", json={"uid": exist_uid, "pid": exist_pid, "quantity": 2}
+    )
+    response = await client.post(
+        "/order/create/",
+        json={"uid": exist_uid, "promocodes": [], "pay_timeout": 0},
+    )
+    oid = response.json()["status"].split()[1]
+    await client.post("/order/pay/", json={"oid": oid, "pay_system": "VISA"})
+    await client.post(f"/order/{oid}/return/", json={"pid": exist_pid, "quantity": 1})
+
+    response = await client.get("/analytics/products/")
+    after = {row["pid"]: row for row in response.json()}[exist_pid]
+    assert after["units"] == before["units"] + 2
+    assert after["returned_units"] == before["returned_units"] + 1
+
+    response = await client.get(
+        "/analytics/sales/", params={"start": "2024-11-09", "end": "2024-11-08"}
+    )
+    assert "error" in response.json()
+
+
 @pytest.mark.anyio
 async def test_order_return_not_product(client):
     response = await client.post(
@@ -193,3 +908,37 @@ async def test_get_return_status_not_exist_oid(client):
 async def test_get_return_status_bad_oid(client):
     response = await client.get(f"/order/{bad_oid}/return_status/")
     assert response.status_code == 422
+
+
+# Archive
+@pytest.mark.anyio
+async def test_archive_orders(client, monkeypatch):
+    await client.post(
+        "/cart/add/", json={"uid": exist_uid, "pid": exist_pid, "quantity": 1}
+    )
+    response = await client.post(
+        "/order/create/",
+        json={"uid": exist_uid, "promocodes": [], "pay_timeout": 60},
+    )
+    oid = response.json()["status"].split()[1]
+    await expire_orders(utcnow() + timedelta(seconds=61))
+
+    monkeypatch.setattr(settings, "ARCHIVE_BATCH_SIZE", 1)
+    assert await archive_orders() >= 1
+    response = await client.post("/order/pay/", json={"oid": oid, "pay_system": "VISA"})
+    assert response.json() == {"error": f"Order {oid} not found."}
+
+    response = await client.get(f"/order/{exist_uid}/", params={"limit": 100})
+    orders = {order["id"]: order for order in response.json()["orders"]}
+    assert orders[oid]["status"] == "Expired"
+    assert orders[oid]["products"][0]["return_dates"] == []
+
+
+@pytest.mark.anyio
+async def test_archive_compact():
+    storage = MemoryStorage("json")
+    assert await storage.archive_orders("2025-01-01", 100, compact=True) == 3
+    assert "return_dates" not in storage.archive[expired_oid]["products"][0]
+
+    orders, _ = await storage.order_page(exist_uid, 10)
+    assert all("return_dates" in line for order in orders for line in order["products"])